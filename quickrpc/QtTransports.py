@@ -10,10 +10,10 @@ import sys
 import logging
 from PyQt4.QtCore import QProcess
 from PyQt4.QtNetwork import QUdpSocket, QTcpSocket, QAbstractSocket, QHostAddress
-from .transports import Transport
+from .transports import Transport, ReceiveBuffer
 from .util import paren_partition
 
-L = lambda: logging.getLogger(__name__)
+L = logging.getLogger(__name__)
 
 
 class QProcessTransport(Transport):
@@ -37,13 +37,13 @@ class QProcessTransport(Transport):
     def __init__(self, cmdline, sendername='qprocess'):
         self.cmdline = cmdline
         self.sendername = sendername
-        self.leftover = b''
+        self.inbuffer = ReceiveBuffer()
         self.process = QProcess()
         self.process.readyRead.connect(self.on_ready_read)
         self.process.finished.connect(self.on_finished)
 
     def start(self):
-        L().debug('starting: %r'%self.cmdline)
+        L.debug('starting: %r', self.cmdline)
         self.process.start(self.cmdline)
         
     def stop(self, kill=False):
@@ -56,26 +56,26 @@ class QProcessTransport(Transport):
     def send(self, data, receivers=None):
         if receivers is not None and self.sendername not in receivers:
             return
-        L().debug('message to child processs: %s'%data)
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug('message to child processs: %s', data)
         self.process.write(data.decode('utf8'))
 
     def on_ready_read(self):
         data = self.process.readAllStandardOutput().data()
         errors = self.process.readAllStandardError().data().decode('utf8')
         if errors:
-            L().error('Error from child process:\n%s' % errors)
+            L.error('Error from child process:\n%s', errors)
         pdata = data.decode('utf8')
         if len(pdata) > 100:
             pdata = pdata[:100] + '...'
         #if pdata.startswith('{'):
-        L().debug('message from child process: %s'%pdata)
-        self.leftover = self.received(
-            sender=self.sendername,
-            data=self.leftover + data
-        )
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug('message from child process: %s', pdata)
+        self.inbuffer.append(data)
+        self.inbuffer.deliver(self, self.sendername)
 
     def on_finished(self):
-        L().info('Child process exited.')
+        L.info('Child process exited.')
 
 
 class QTcpTransport(Transport):
@@ -95,7 +95,7 @@ class QTcpTransport(Transport):
     def __init__(self, host, port, sendername='qtcp'):
         self.address = (host, port)
         self.sendername = sendername
-        self.leftover = b''
+        self.inbuffer = ReceiveBuffer()
         self.socket = QTcpSocket()
         self.socket.readyRead.connect(self.on_ready_read)
         self.socket.error.connect(self.on_error)
@@ -103,9 +103,9 @@ class QTcpTransport(Transport):
 
     def start(self):
         if self.socket.state() != QAbstractSocket.UnconnectedState:
-            L().debug('start(): Socket is not in UnconnectedState, doing nothing')
+            L.debug('start(): Socket is not in UnconnectedState, doing nothing')
             return
-        L().debug('connecting to: %s'%(self.address,))
+        L.debug('connecting to: %s', self.address)
         self.socket.connectToHost(self.address[0], self.address[1])
         
     def stop(self):
@@ -115,7 +115,8 @@ class QTcpTransport(Transport):
     def send(self, data, receivers=None):
         if receivers is not None and self.sendername not in receivers:
             return
-        L().debug('message to tcp server: %s'%data)
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug('message to tcp server: %s', data)
         self.socket.write(data.decode('utf8'))
 
     def on_ready_read(self):
@@ -124,17 +125,16 @@ class QTcpTransport(Transport):
         if len(pdata) > 100:
             pdata = pdata[:100] + b'...'
         #if pdata.startswith('{'):
-        L().debug('message from tcp server: %s'%pdata)
-        self.leftover = self.received(
-            sender=self.sendername,
-            data=self.leftover + data
-        )
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug('message from tcp server: %s', pdata)
+        self.inbuffer.append(data)
+        self.inbuffer.deliver(self, self.sendername)
         
     def on_connect(self):
-         L().info('QTcpSocket: Established connection to %s'%(self.address,))
+         L.info('QTcpSocket: Established connection to %s', self.address)
 
     def on_error(self, error):
-        L().info('QTcpSocket raised error: %s'%error)
+        L.info('QTcpSocket raised error: %s', error)
         
         
 class QUdpTransport(Transport):
@@ -156,16 +156,16 @@ class QUdpTransport(Transport):
 
     def __init__(self, port):
         self.port = port
-        self.leftover = b''
+        self.inbuffer = ReceiveBuffer()
         self.socket = QUdpSocket()
         self.socket.readyRead.connect(self.on_ready_read)
         self.socket.error.connect(self.on_error)
 
     def start(self):
         if self.socket.state() != QAbstractSocket.UnconnectedState:
-            L().debug('QUdpSocket.start(): Socket is not in UnconnectedState, doing nothing')
+            L.debug('QUdpSocket.start(): Socket is not in UnconnectedState, doing nothing')
             return
-        L().debug('QUdpTransport: binding to port %d'%(self.port,))
+        L.debug('QUdpTransport: binding to port %d', self.port)
         self.socket.bind(self.port, QUdpSocket.ShareAddress)
         
     def stop(self):
@@ -173,7 +173,8 @@ class QUdpTransport(Transport):
         self.socket.close()
 
     def send(self, data, receivers=None):
-        L().debug('message to udp %s: %s'%(receivers,data))
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug('message to udp %s: %s', receivers, data)
         data = data.decode('utf8')
         if receivers:
             for receiver in receivers:
@@ -189,11 +190,10 @@ class QUdpTransport(Transport):
             pdata = data
             if len(pdata) > 100:
                 pdata = pdata[:100] + b'...'
-            L().debug('UDP message from %s: %s'%(sender, pdata))
-            self.leftover = self.received(
-                sender=sender,
-                data=self.leftover + data
-            )
+            if L.isEnabledFor(logging.DEBUG):
+                L.debug('UDP message from %s: %s', sender, pdata)
+            self.inbuffer.append(data)
+            self.inbuffer.deliver(self, sender)
 
     def on_error(self, error):
-        L().info('QTcpSocket raised error: %s'%error)
+        L.info('QTcpSocket raised error: %s', error)
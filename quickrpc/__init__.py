@@ -25,8 +25,11 @@ from . import transports
 # import, so that subclasses become known
 from . import network_transports
 from . import bus_transport
+from . import asyncio_transports
 from . import codecs
 from . import terse_codec
+from . import msgpack_codec
+from . import schema_codec
 from .remote_api import RemoteAPI, incoming, outgoing
 
 __all__ = [
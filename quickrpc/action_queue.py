@@ -1,9 +1,15 @@
 '''ActionQueue: a background worker that manages its own worker thread automatically.'''
-from threading import Thread, Lock, Event
-from queue import Queue, Empty
+import logging
+import time
+from collections import deque
+from threading import Thread, Lock, Condition, Event
+
+L = logging.getLogger(__name__)
 
 __all__ = [
     'ActionQueue',
+    'ShardedActionQueue',
+    'KeyedActionQueue',
     ]
 
 class ActionQueue:
@@ -14,39 +20,259 @@ class ActionQueue:
 
     .put() returns immediately. The work items are processed in a background
     thread, in the order in which they arrived. Only one work item is processed
-    at a time.
+    at a time. Exceptions raised by a work item are logged.
+
+    The background thread is started when there is work to do. When the queue
+    is empty, it waits for new work for ``idle_timeout`` seconds before it is
+    teared down, so that bursty traffic does not start a new thread each
+    time. Set ``idle_timeout=0`` to stop the thread as soon as the queue
+    drains.
 
-    The background thread is started when there is work to do, and teared down
-    when the queue is empty.
+    The worker takes up to ``batch_size`` queued actions at once, saving
+    locking overhead under load.
+
+    :meth:`stats` tells the queue depth and how busy the worker is.
     '''
 
-    def __init__(self):
-        self._queue = Queue()
+    def __init__(self, name='ActionQueue', idle_timeout=1.0, batch_size=64):
+        self.name = name
+        self.idle_timeout = idle_timeout
+        self.batch_size = batch_size
+        self._queue = deque()
         self._thread = None
+        # set while a worker thread exists
         self._running = Event()
-        self._startstop_lock = Lock()
+        self._lock = Lock()
+        self._wakeup = Condition(self._lock)
+        # worker is waiting for work
+        self._idle = False
+        # actions taken from the queue, but not started yet
+        self._batch_pending = 0
+        # action currently executing
+        self._busy = False
+        # total seconds spent in actions
+        self._busy_time = 0.0
 
-    def put(self, action):
+    def put(self, action, key=None):
         '''Put an action into the queue.
 
         Parameters:
             action (func): a callable without params. The return value is not used.
+            key: ignored; for compatibility with :class:`ShardedActionQueue`.
         '''
-        with self._startstop_lock:
-            self._queue.put(action)
-            if not self._running.is_set():
-                self._thread = Thread(target=self._run_worker, name='ActionQueue')
+        with self._lock:
+            self._queue.append(action)
+            if self._thread is None:
+                self._thread = Thread(target=self._run_worker, name=self.name)
+                self._running.set()
                 self._thread.start()
-                self._running.wait()
+            elif self._idle:
+                self._wakeup.notify()
 
     def _run_worker(self):
-        self._running.set()
         while True:
-            with self._startstop_lock:
-                try:
-                    action = self._queue.get_nowait()
-                except Empty:
+            with self._lock:
+                if not self._queue and self.idle_timeout > 0:
+                    self._idle = True
+                    self._wakeup.wait_for(lambda: self._queue, self.idle_timeout)
+                    self._idle = False
+                if not self._queue:
+                    self._thread = None
                     self._running.clear()
                     return
-            action()
+                queue = self._queue
+                batch = [queue.popleft() for _ in range(min(len(queue), self.batch_size))]
+                self._batch_pending = len(batch)
+            for action in batch:
+                self._batch_pending -= 1
+                self._busy = True
+                start = time.monotonic()
+                try:
+                    action()
+                except Exception:
+                    L.error('%s: action raised an exception', self.name, exc_info=True)
+                finally:
+                    self._busy_time += time.monotonic() - start
+                    self._busy = False
+
+    def _load(self):
+        '''number of actions running or waiting.'''
+        return len(self._queue) + self._batch_pending + self._busy
+
+    def stats(self):
+        '''Returns a dict with the current load:
+
+            * ``workers``: number of worker threads (here: 1)
+            * ``busy``: number of workers executing an action right now
+            * ``pending``: number of queued actions, not yet started
+            * ``busy_time``: total seconds spent executing actions. Sample it 
+              twice to get the utilization in between.
+        '''
+        return {
+            'workers': 1,
+            'busy': int(self._busy),
+            'pending': len(self._queue) + self._batch_pending,
+            'busy_time': self._busy_time,
+        }
+
+
+class ShardedActionQueue:
+    '''A pool of :class:`ActionQueue` workers, sharded by key.
+
+    ``.put(action, key)`` assigns the action to one of ``workers`` queues.
+    While a key has unfinished actions, new actions of that key go to the
+    same queue, so that they are processed in order, one at a time. A key
+    without unfinished actions goes to the least loaded queue. Thus actions
+    with different keys are processed in parallel, unless all workers are
+    busy.
+
+    Like for ActionQueue, the worker threads only run when there is work (or
+    was recently, see ``idle_timeout``). ``idle_timeout`` and ``batch_size``
+    are passed on to the ActionQueues.
+    '''
+
+    def __init__(self, workers=4, name='ActionQueue', **kwargs):
+        if workers < 1:
+            raise ValueError('Need at least one worker')
+        self._queues = [ActionQueue(name='%s-%d'%(name, i), **kwargs) for i in range(workers)]
+        self._lock = Lock()
+        # key -> [queue, number of unfinished actions]
+        self._assigned = {}
+
+    def put(self, action, key=None):
+        '''Put an action into the queue of the given key.'''
+        def run():
+            try:
+                action()
+            finally:
+                with self._lock:
+                    assigned[1] -= 1
+                    if not assigned[1]:
+                        del self._assigned[key]
+        with self._lock:
+            assigned = self._assigned.get(key)
+            if assigned is None:
+                queue = min(self._queues, key=ActionQueue._load)
+                assigned = self._assigned[key] = [queue, 0]
+            assigned[1] += 1
+            assigned[0].put(run)
+
+    def stats(self):
+        '''Returns the summed-up :meth:`ActionQueue.stats` of all workers.
+
+        Additionally, ``per_worker`` holds the list of individual stats.
+        '''
+        per_worker = [queue.stats() for queue in self._queues]
+        result = {
+            key: sum(stats[key] for stats in per_worker)
+            for key in ['workers', 'busy', 'pending', 'busy_time']
+        }
+        result['per_worker'] = per_worker
+        return result
+
+
+class KeyedActionQueue:
+    '''A pool of worker threads executing actions serially per key.
+
+    ``.put(action, key)`` enqueues the action for its key. Actions with the
+    same key are processed in order, one at a time; actions with different
+    keys are processed in parallel by up to ``workers`` threads. Unlike
+    :class:`ShardedActionQueue`, a slow key does not hold up other keys,
+    since any free worker picks up the next key that has work.
+
+    Keys must be hashable. Workers are started on demand and exit after
+    ``idle_timeout`` seconds without work, like for :class:`ActionQueue`.
+    A worker runs up to ``batch_size`` queued actions of a key in one go
+    before it moves on to the next key.
+    '''
+
+    def __init__(self, workers=4, name='ActionQueue', idle_timeout=1.0, batch_size=64):
+        if workers < 1:
+            raise ValueError('Need at least one worker')
+        self.name = name
+        self.workers = workers
+        self.idle_timeout = idle_timeout
+        self.batch_size = batch_size
+        self._lock = Lock()
+        self._wakeup = Condition(self._lock)
+        # key -> deque of actions. A key is present while it has actions
+        # queued or one executing.
+        self._actions = {}
+        # keys with work to do and none executing, in order of arrival
+        self._ready = deque()
+        self._threads = 0
+        self._idle = 0
+        self._busy = 0
+        self._busy_time = 0.0
+
+    def put(self, action, key=None):
+        '''Put an action into the queue of the given key.'''
+        with self._lock:
+            actions = self._actions.get(key)
+            if actions is not None:
+                # the key is ready or executing; it will get to this one.
+                actions.append(action)
+                return
+            self._actions[key] = deque([action])
+            self._ready.append(key)
+            if self._idle:
+                self._wakeup.notify()
+            # Idle workers may already be notified for other ready keys;
+            # start another one if there are more ready keys than idle workers.
+            if len(self._ready) > self._idle and self._threads < self.workers:
+                self._threads += 1
+                Thread(target=self._run_worker, name='%s-%d'%(self.name, self._threads)).start()
+
+    def _run_worker(self):
+        lock = self._lock
+        lock.acquire()
+        try:
+            while True:
+                if not self._ready and self.idle_timeout > 0:
+                    self._idle += 1
+                    self._wakeup.wait_for(lambda: self._ready, self.idle_timeout)
+                    self._idle -= 1
+                if not self._ready:
+                    self._threads -= 1
+                    return
+                key = self._ready.popleft()
+                actions = self._actions[key]
+                # Only this worker pops from actions until the key is
+                # handed back, so the batch can run without the lock.
+                count = min(len(actions), self.batch_size)
+                self._busy += 1
+                lock.release()
+                start = time.monotonic()
+                try:
+                    for _ in range(count):
+                        action = actions.popleft()
+                        try:
+                            action()
+                        except Exception:
+                            L.error('%s: action raised an exception', self.name, exc_info=True)
+                finally:
+                    lock.acquire()
+                    self._busy_time += time.monotonic() - start
+                    self._busy -= 1
+                    if actions:
+                        # back in line, to be fair to the other keys
+                        self._ready.append(key)
+                    else:
+                        del self._actions[key]
+        finally:
+            lock.release()
 
+    def stats(self):
+        '''Returns a dict like :meth:`ActionQueue.stats`.
+
+        ``workers`` is the number of currently running worker threads.
+        Additionally, ``keys`` is the number of keys that have work.
+        '''
+        with self._lock:
+            return {
+                'workers': self._threads,
+                'busy': self._busy,
+                'pending': sum(len(actions) for actions in self._actions.values()),
+                'busy_time': self._busy_time,
+                'keys': len(self._actions),
+            }
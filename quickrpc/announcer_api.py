@@ -4,7 +4,7 @@ __all__ = ['AnnouncerAPI', 'make_announcer', 'make_udp_announcer']
 import logging
 from .remote_api import RemoteAPI, incoming, outgoing
 from .codecs import TerseCodec
-L = lambda: logging.getLogger(__name__)
+L = logging.getLogger(__name__)
 
 
 class AnnouncerAPI(RemoteAPI):
@@ -57,7 +57,7 @@ def make_announcer(transport, description='', filter_func=None, codec=TerseCodec
     
     def on_seek(sender, filter=''):
         if filter_func(filter):
-            L().info('Sending advertisement to %s'%sender)
+            L.info('Sending advertisement to %s', sender)
             api.advertise(receivers=None, description=api.description)
     api.seek.connect(on_seek)
     return api
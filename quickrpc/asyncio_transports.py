@@ -0,0 +1,321 @@
+'''Transports running on an asyncio event loop.
+
+These transports do not start any threads. Receiving and decoding happen in
+the ``buffer_updated`` callback of an :class:`asyncio.BufferedProtocol`, 
+i.e. on the event loop thread. Data is read directly into a per-connection 
+:class:`.ReceiveBuffer`.
+
+Start and stop them from within the loop using ``await transport.astart()``
+and ``await transport.astop()``. If the event loop is passed in as ``loop``,
+the regular blocking :meth:`~AsyncioTransport.start` and
+:meth:`~AsyncioTransport.stop` can be used from other threads, too.
+
+Combine with ``RemoteAPI(..., use_asyncio=True)`` to get awaitable
+outgoing calls and coroutine incoming handlers.
+
+Classes defined here:
+ * :any:`AsyncioTransport`: base class
+ * :any:`AsyncioTcpClientTransport`: connects to a TCP server.
+ * :any:`AsyncioTcpServerTransport`: accepts TCP connections.
+'''
+
+__all__ = [
+    'AsyncioTransport',
+    'AsyncioTcpClientTransport',
+    'AsyncioTcpServerTransport',
+]
+
+import asyncio
+import logging
+import threading
+from .transports import Transport, TransportError, ReceiveBuffer
+from .promise import from_future
+
+L = logging.getLogger(__name__)
+
+
+class _ConnectionProtocol(asyncio.BufferedProtocol):
+    '''Protocol for one stream connection, forwarding to the owning AsyncioTransport.'''
+    buffersize = 65536
+
+    def __init__(self, owner, name=''):
+        self.owner = owner
+        self.name = name
+        self.inbuffer = ReceiveBuffer()
+        self._view = None
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.owner.send_high_watermark is not None:
+            transport.set_write_buffer_limits(self.owner.send_high_watermark, self.owner.send_low_watermark)
+        if self.owner._reading_paused:
+            transport.pause_reading()
+        if not self.name:
+            self.name = '%s:%s'%transport.get_extra_info('peername')[:2]
+        self.owner._connection_made(self)
+
+    def get_buffer(self, sizehint):
+        self._view = self.inbuffer.writable(max(sizehint, self.buffersize))
+        return self._view
+
+    def buffer_updated(self, nbytes):
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug('%d bytes from %s', nbytes, self.name)
+        # release, so that the receive buffer can be reused.
+        self._view.release()
+        self.inbuffer.written(nbytes)
+        self.inbuffer.deliver(self.owner, self.name)
+
+    def connection_lost(self, exc):
+        self.owner._connection_lost(self, exc)
+
+    def write(self, data):
+        self.transport.write(data)
+
+
+class AsyncioTransport(Transport):
+    '''Base class for transports running on an asyncio event loop.
+
+    In a subclass, implement the coroutines :meth:`aopen` and :meth:`aclose`,
+    as well as :meth:`send`.
+
+    ``loop`` is the event loop to run on. If not given, the loop that
+    :meth:`astart` is awaited in is used.
+
+    :meth:`send` can be called from any thread. If called from a foreign
+    thread, the write is handed over to the event loop.
+
+    The send watermarks are passed on to the asyncio transport's write buffer
+    limits; :meth:`send` never blocks. The receive watermarks are not used,
+    since received data is processed right away.
+    '''
+    def __init__(self, loop=None):
+        Transport.__init__(self)
+        self.loop = loop
+        self._reading_paused = False
+
+    async def aopen(self):
+        '''Open the communication channel. Override me.'''
+
+    async def aclose(self):
+        '''Close the communication channel. Override me.'''
+
+    async def astart(self):
+        '''Open the transport on the running event loop. Returns True.'''
+        self.loop = asyncio.get_running_loop()
+        self._thread = threading.current_thread()
+        await self.aopen()
+        self.running = True
+        return True
+
+    async def astop(self):
+        '''Close the transport.'''
+        if not self.running:
+            return
+        self.running = False
+        await self.aclose()
+
+    def start(self, block=True, timeout=10):
+        '''Start the transport on :attr:`loop` from another thread.
+
+        If ``block`` is True, waits until startup is complete and returns True.
+        Otherwise, returns a :class:`.Promise`.
+        '''
+        fut = self._run_threadsafe(self.astart())
+        if block:
+            return fut.result(timeout=timeout)
+        return from_future(fut)
+
+    def stop(self, block=True):
+        '''Stop the transport on :attr:`loop` from another thread.'''
+        if self._on_loop_thread():
+            raise TransportError('Use "await transport.astop()" on the event loop thread.')
+        fut = self._run_threadsafe(self.astop())
+        if block:
+            fut.result()
+
+    def run(self):
+        raise TransportError('Asyncio transports run on the event loop; use .astart().')
+
+    def _run_threadsafe(self, coro):
+        if self.loop is None:
+            coro.close()
+            raise TransportError('No event loop set. Pass loop=... or use "await transport.astart()".')
+        if self._on_loop_thread():
+            coro.close()
+            raise TransportError('Cannot block on the event loop thread. Use "await transport.astart()".')
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def _protocols(self):
+        '''The currently connected protocols. Override me.'''
+        return []
+
+    @property
+    def send_buffered(self):
+        return sum(p.transport.get_write_buffer_size() for p in self._protocols() if p.transport)
+
+    def pause_reading(self):
+        self._reading_paused = True
+        self._call_on_loop(self._set_reading, False)
+
+    def resume_reading(self):
+        self._reading_paused = False
+        self._call_on_loop(self._set_reading, True)
+
+    def _set_reading(self, reading):
+        for protocol in self._protocols():
+            if protocol.transport and not protocol.transport.is_closing():
+                if reading:
+                    protocol.transport.resume_reading()
+                else:
+                    protocol.transport.pause_reading()
+
+    def _call_on_loop(self, func, *args):
+        if self._on_loop_thread():
+            func(*args)
+        elif self.loop is not None:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def _on_loop_thread(self):
+        return self._thread is not None and self._thread is threading.current_thread()
+
+    def _write(self, protocol, data):
+        '''write data to the protocol's connection, from any thread.'''
+        if self._on_loop_thread():
+            protocol.write(data)
+        else:
+            self.loop.call_soon_threadsafe(protocol.write, data)
+
+    def _connection_made(self, protocol):
+        pass
+
+    def _connection_lost(self, protocol, exc):
+        pass
+
+
+class AsyncioTcpClientTransport(AsyncioTransport):
+    '''Transport that connects to a TCP server, running on an asyncio event loop.
+
+    The transport stops when the remote side closes the connection.
+    '''
+    shorthand = 'aiotcp'
+    @classmethod
+    def fromstring(cls, expression):
+        '''aiotcp:<host>:<port>'''
+        _, host, port = expression.split(':')
+        return cls(host=host, port=int(port))
+
+    def __init__(self, host, port, connect_timeout=10, loop=None):
+        AsyncioTransport.__init__(self, loop=loop)
+        self.address = (host, port)
+        self.name = '%s:%s'%self.address
+        self.connect_timeout = connect_timeout
+        self._protocol = None
+
+    async def aopen(self):
+        L.debug('AsyncioTcpClientTransport.aopen() called')
+        try:
+            _, self._protocol = await asyncio.wait_for(
+                self.loop.create_connection(lambda: _ConnectionProtocol(self, self.name), *self.address),
+                self.connect_timeout,
+            )
+        except (ConnectionRefusedError, asyncio.TimeoutError):
+            L.error('Connection to %s failed', self.name)
+            raise
+        L.info('Connected to %s', self.name)
+
+    async def aclose(self):
+        if self._protocol:
+            L.info('Closing connection to %s.', self.name)
+            self._protocol.transport.close()
+            self._protocol = None
+
+    def send(self, data, receivers=None):
+        if receivers is not None and not self.name in receivers:
+            return
+        if not self.running:
+            raise IOError('Tried to send over non-running transport!')
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug('AsyncioTcpClientTransport .send to %s: %r', self.name, data)
+        self._write(self._protocol, data)
+
+    def _protocols(self):
+        return [self._protocol] if self._protocol else []
+
+    def _connection_lost(self, protocol, exc):
+        if self._protocol is protocol:
+            L.info('Connection to %s closed by remote side.', self.name)
+            self._protocol = None
+            self.running = False
+
+
+class AsyncioTcpServerTransport(AsyncioTransport):
+    '''Transport that accepts TCP connections, running on an asyncio event loop.
+
+    Sender/receiver names are ``<host>:<port>`` of the client, like for
+    :class:`.TcpServerTransport`. Use :meth:`close` for server-side disconnect.
+    '''
+    shorthand = 'aiotcpserv'
+    @classmethod
+    def fromstring(cls, expression):
+        '''aiotcpserv:<interface>:<port>
+
+        Leave <interface> empty to listen on all interfaces.
+        '''
+        _, iface, port = expression.split(':')
+        return cls(port=int(port), interface=iface)
+
+    def __init__(self, port, interface='', loop=None):
+        AsyncioTransport.__init__(self, loop=loop)
+        self.addr = (interface, port)
+        self.name = '%s:%s'%self.addr
+        # name --> _ConnectionProtocol
+        self.connections = {}
+        self._server = None
+
+    async def aopen(self):
+        self._server = await self.loop.create_server(
+            lambda: _ConnectionProtocol(self), self.addr[0] or None, self.addr[1],
+        )
+        self.server_address = self._server.sockets[0].getsockname()
+        L.info('AsyncioTcpServerTransport listening on %s:%s', *self.server_address[:2])
+
+    async def aclose(self):
+        self._server.close()
+        for protocol in list(self.connections.values()):
+            protocol.transport.close()
+        await self._server.wait_closed()
+        self._server = None
+
+    def send(self, data, receivers=None):
+        if receivers is None:
+            targets = list(self.connections.values())
+        else:
+            targets = [self.connections[r] for r in receivers if r in self.connections]
+        for protocol in targets:
+            if L.isEnabledFor(logging.DEBUG):
+                L.debug('AsyncioTcpServerTransport .send to %s: %r', protocol.name, data)
+            self._write(protocol, data)
+
+    def _protocols(self):
+        return list(self.connections.values())
+
+    def close(self, name):
+        '''close the connection with the given sender/receiver name.'''
+        protocol = self.connections.get(name)
+        if protocol is None:
+            return
+        if self._on_loop_thread():
+            protocol.transport.close()
+        else:
+            self.loop.call_soon_threadsafe(protocol.transport.close)
+
+    def _connection_made(self, protocol):
+        L.info('TCP connect from %s', protocol.name)
+        self.connections[protocol.name] = protocol
+
+    def _connection_lost(self, protocol, exc):
+        L.debug('Closed TCP connection to %s', protocol.name)
+        if self.connections.get(protocol.name) is protocol:
+            del self.connections[protocol.name]
@@ -11,13 +11,12 @@ import logging
 import threading
 import itertools as it
 from queue import Queue, Empty, Full
-from .transports import Transport, TransportError
+from .transports import Transport, TransportError, ReceiveBuffer, FillLevel, _recv_watermark
 
 _bus_instances = {}
 
 
-def L():
-    return logging.getLogger(__name__)
+L = logging.getLogger(__name__)
 
 
 class _StopSignal:
@@ -25,9 +24,17 @@ class _StopSignal:
 
 
 class Bus:
+    '''A bus connecting :class:`InternalTransport` peers.
+
+    ``peers`` is replaced (not modified) when peers come and go, so that it
+    can be iterated without locking. Peers are indexed by name for
+    targeted sends.
+    '''
     def __init__(self, name=''):
         self.name = name
         self.peers = []
+        # peer name -> tuple of peers with that name. Replaced, not modified.
+        self._peer_index = {}
         self._auto_name_counter = it.count()
         self._peer_lock = threading.Lock()
 
@@ -55,26 +62,38 @@ class Bus:
     def add_peer(self, peer):
         '''Add peer to the bus. Threadsafe.'''
         with self._peer_lock:
-            self.peers.append(peer)
+            self.peers = self.peers + [peer]
+            self._reindex()
 
     def remove_peer(self, peer):
         '''Remove peer. Threadsafe.'''
         with self._peer_lock:
-            self.peers.remove(peer)
+            peers = list(self.peers)
+            peers.remove(peer)
+            self.peers = peers
+            self._reindex()
+
+    def _reindex(self):
+        index = {}
+        for peer in self.peers:
+            index[peer.name] = index.get(peer.name, ()) + (peer,)
+        self._peer_index = index
 
     def send(self, sender_name, data, receivers=None):
         '''Send message to the bus. Threadsafe.'''
-        with self._peer_lock:
-            receivers = receivers or [
-                peer.name for peer in self.peers if peer.name != sender_name
-            ]
-            peernames = set(peer.name for peer in self.peers)
+        if receivers:
+            index = self._peer_index
+            targets = {}
             for r in receivers:
-                if r not in peernames:
+                peers = index.get(r)
+                if peers is None:
                     raise IOError('Sending to bus %s: Unknown receiver %s' % (self.name, r))
-            for peer in self.peers:
-                if peer.name in receivers:
-                    peer.enqueue(sender_name, data)
+                for peer in peers:
+                    targets[peer] = True
+        else:
+            targets = [peer for peer in self.peers if peer.name != sender_name]
+        for peer in targets:
+            peer.enqueue(sender_name, data)
 
 
 class InternalTransport(Transport):
@@ -96,12 +115,18 @@ class InternalTransport(Transport):
 
     ``bus`` and ``queue_size`` are applied on ``start()`` of transport. They
     MUST not be changed while running.
+
+    Above ``recv_high_watermark`` queued bytes, peers sending to this 
+    transport block until the backlog dropped to ``recv_low_watermark``.
     '''
 
     shorthand = 'internal'
+    recv_high_watermark = _recv_watermark('recv_high_watermark')
+    recv_low_watermark = _recv_watermark('recv_low_watermark')
 
     def __init__(self, bus_name='internal', sender_name='', queue_size=1000):
         super().__init__()
+        self._recv_fill = FillLevel()
         self.bus = Bus.get_instance(bus_name or 'internal')
         self.name = str(sender_name) or self.bus.auto_name()
         self.queue_size = queue_size
@@ -127,24 +152,31 @@ class InternalTransport(Transport):
         if not self.bus:
             raise IOError('Bus is not set')
         self.bus.add_peer(self)
-        L().debug('InternalTransport connected to %s as %s', self.bus.name, self.name)
+        L.debug('InternalTransport connected to %s as %s', self.bus.name, self.name)
 
     def run(self):
         '''Process incoming data.'''
         self.running = True
         while self.running:
-            try:
-                indata = self._queue.get(timeout=30.0)
-            except Empty:
-                continue
+            indata = self._queue.get()
             if indata is _StopSignal:
                 break
             sender, data = indata
-            leftover = self._leftovers.get(sender, b'')
-            leftover = self.received(sender, leftover + data) or b''
-            self._leftovers[sender] = leftover
+            buffer = self._leftovers.get(sender)
+            if buffer is None:
+                buffer = self._leftovers[sender] = ReceiveBuffer()
+            buffer.append(data)
+            try:
+                buffer.deliver(self, sender)
+            except Exception:
+                L.error('InternalTransport: error while processing data from %s, discarding it', sender, exc_info=True)
+                buffer.clear()
+            finally:
+                self._recv_fill.remove(len(data))
         self.bus.remove_peer(self)
-        L().debug('InternalTransport %s finished', self.name)
+        # let blocked senders go
+        self._recv_fill.remove(self._recv_fill.level)
+        L.debug('InternalTransport %s finished', self.name)
 
     def stop(self):
         '''Stop running transport.'''
@@ -163,6 +195,16 @@ class InternalTransport(Transport):
             raise IOError('Transport is not running.')
         self.bus.send(self.name, bytes(data), receivers)
 
+    @property
+    def recv_buffered(self):
+        return self._recv_fill.level
+
     def enqueue(self, sender, data):
         '''Add data to the receive queue. For internal use.'''
+        fill = self._recv_fill
+        if fill.paused and self._thread is not threading.current_thread():
+            # stop "reading" from the bus: the sending peer waits.
+            while self.running and not fill.wait(0.1):
+                pass
+        fill.add(len(data))
         self._queue.put((sender, data))
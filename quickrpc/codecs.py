@@ -12,19 +12,26 @@ __all__ = [
     'DecodeError',
     'EncodeError',
     'Message',
+    'LazyMessage',
     'Reply', 
     'ErrorReply',
     'RemoteError',
     'JsonRpcCodec',
+    'JsonRpcDecoder',
 ]
 
 import logging
 import json 
 import base64
+import itertools as it
+import functools
+import re
+import struct
+import weakref
 from traceback import format_exception
 from .util import subclasses
 
-L = lambda: logging.getLogger(__name__)
+L = logging.getLogger(__name__)
 
 # Wouldn't it be great if traceback could contain that by itself :-/
 _fmt_exc = lambda e: '\n'.join(format_exception(type(e), e, e.__traceback__))
@@ -41,19 +48,46 @@ class RemoteError(Exception):
 
 
 class Message(object):
+    __slots__ = ('method', 'kwargs', 'id', 'secinfo')
     def __init__(self, method, kwargs, id=0, secinfo=None):
         self.method = method
         self.kwargs = kwargs
         self.id = id
         self.secinfo = secinfo or {}
 
+_message_kwargs = Message.kwargs
+
+class LazyMessage(Message):
+    '''Message whose kwargs are only decoded when accessed.
+
+    ``parse`` is a callable returning the kwargs. It may raise
+    :class:`DecodeError`, which then surfaces upon access of ``.kwargs``.
+    '''
+    __slots__ = ('_parse',)
+    def __init__(self, method, parse, id=0, secinfo=None):
+        Message.__init__(self, method, None, id, secinfo)
+        self._parse = parse
+
+    @property
+    def kwargs(self):
+        if self._parse is not None:
+            _message_kwargs.__set__(self, self._parse())
+            self._parse = None
+        return _message_kwargs.__get__(self)
+    @kwargs.setter
+    def kwargs(self, value):
+        _message_kwargs.__set__(self, value)
+        self._parse = None
+
 class Reply(object):
+    __slots__ = ('result', 'id', 'secinfo')
     def __init__(self, result, id, secinfo=None):
         self.result = result
         self.id = int(id)
         self.secinfo = secinfo or {}
 
 class ErrorReply(object):
+    __slots__ = ('exception', 'id', 'errorcode', 'secinfo')
     def __init__(self, exception, id, errorcode=0, secinfo=None):
         self.exception = exception
         self.id = int(id)
@@ -78,6 +112,12 @@ class Codec(object):
     Python data is retrieved from bytes by :any:`decode`. This returns a list of 
     objects, which can be instances of :any:`Message`, :any:`Reply` and 
     :any:`ErrorReply`.
+
+    Transports pass received data as a bytes-like buffer (usually a 
+    :class:`memoryview`) to :any:`decode_buffer`, which returns the number of 
+    consumed bytes instead of a copy of the remainder. The default 
+    implementation falls back to :any:`decode`; codecs should override it to 
+    avoid copying the buffer.
     
     *Security*
     
@@ -140,8 +180,43 @@ class Codec(object):
             .result, .id, .secinfo (dict)
         ErrorReply attributes
             .exception, .id, .errorcode, .secinfo (dict)
+
+        Codecs with a lazy decode mode return :any:`LazyMessage` objects, 
+        whose .kwargs are decoded on first access.
         '''
     
+    def decode_buffer(self, data, sec_in=None):
+        '''decode messages from a bytes-like buffer.
+
+        Return:
+        [messages], consumed
+        where consumed is the number of bytes at the start of ``data`` that
+        were processed. The remaining bytes will be passed again, together 
+        with the next received bytes.
+
+        ``data`` is only valid during the call. See :any:`decode` for the 
+        message list.
+        '''
+        data = bytes(data)
+        messages, remainder = self.decode(data, sec_in=sec_in)
+        return messages, len(data) - len(remainder)
+
+    def decoder(self):
+        '''Returns a decoder for the data stream of a single sender.
+
+        The decoder has a :any:`decode_buffer` method and may keep state 
+        between calls, e.g. how far the remainder was already scanned. By 
+        default, the codec itself is returned.
+        '''
+        return self
+
+    def bind_api(self, api):
+        '''Called by :class:`.RemoteAPI` when the codec is assigned to it.
+
+        Codecs which derive their encoding from the API (e.g.
+        :class:`.SchemaCodec`) hook in here. Does nothing by default.
+        '''
+
     def encode(self, method, kwargs=None, id=0, sec_out=None):
         '''encode a method call with given kwargs.
         
@@ -157,15 +232,42 @@ class Codec(object):
         Returns: frame data (bytes)
         '''
 
+    def call_encoder(self, method):
+        '''Returns a function ``encode(kwargs, id=0, sec_out=None)`` for calls of method.
+
+        :class:`.RemoteAPI` keeps one per outgoing method, so that codecs can 
+        prepare everything that does not depend on the arguments (e.g. the 
+        encoded method name) once. By default, :any:`encode` is used.
+        '''
+        return functools.partial(self.encode, method)
+
+    def encode_batch(self, calls, sec_out=None):
+        '''encode several method calls at once.
+
+        ``calls`` is a list of ``(method, kwargs, id)`` tuples. Codecs that 
+        support it put all of them into a single frame. By default, the 
+        calls are encoded one by one and concatenated.
+
+        Returns: frame data (bytes)
+        '''
+        return b''.join(
+            self.encode(method, kwargs=kwargs, id=id, sec_out=sec_out)
+            for method, kwargs, id in calls
+        )
+
     def encode_reply(self, in_reply_to, result, sec_out=None):
         '''encode reply to the Message'''
 
     def encode_error(self, in_reply_to, exception, errorcode=0, sec_out=None):
         '''encode error caused by the given Message.'''
 
-def TerseCodec():
+def TerseCodec(**kwargs):
     from .terse_codec import TerseCodec
-    return TerseCodec()
+    return TerseCodec(**kwargs)
+
+def MsgpackCodec(**kwargs):
+    from .msgpack_codec import MsgpackCodec
+    return MsgpackCodec(**kwargs)
 
 
 class MyJsonEncoder(json.JSONEncoder):
@@ -177,6 +279,130 @@ class MyJsonEncoder(json.JSONEncoder):
 class MyJsonDecoder(json.JSONDecoder):
     pass
 
+class _AttachmentEncoder(MyJsonEncoder):
+    '''Collects bytes values into the given list, replacing them by a reference.'''
+    def __init__(self, *args, attachments, **kwargs):
+        MyJsonEncoder.__init__(self, *args, **kwargs)
+        self.attachments = attachments
+
+    def default(self, obj):
+        if isinstance(obj, (bytes, bytearray, memoryview)):
+            self.attachments.append(obj)
+            return {'__att': len(self.attachments) - 1}
+        return MyJsonEncoder.default(self, obj)
+
+def _split_attachments(data):
+    '''splits the payload into json text and attachments (all memoryviews).'''
+    header_size = _frame_length.size
+    if len(data) < header_size:
+        raise DecodeError('Attachment payload too short')
+    length, = _frame_length.unpack_from(data, 0)
+    pos = header_size + length
+    if pos > len(data):
+        raise DecodeError('Truncated json text')
+    text = data[header_size:pos]
+    attachments = []
+    while pos < len(data):
+        if len(data) - pos < header_size:
+            raise DecodeError('Truncated attachment header')
+        length, = _frame_length.unpack_from(data, pos)
+        start = pos + header_size
+        pos = start + length
+        if pos > len(data):
+            raise DecodeError('Truncated attachment')
+        attachments.append(data[start:pos].toreadonly())
+    if attachments and hasattr(data.obj, 'lent'):
+        # a ReceiveBuffer's storage: it must not be overwritten anymore.
+        data.obj.lent = True
+    return text, attachments
+
+def _attachment_hook(val, attachments):
+    if '__att' in val:
+        try:
+            return attachments[val['__att']]
+        except (IndexError, TypeError):
+            raise ValueError('Invalid attachment reference %r'%(val['__att'],))
+    return _json_object_hook(val)
+
+# length header of length-prefixed frames
+_frame_length = struct.Struct('!I')
+_MAX_FRAME_LENGTH = 2**32 - 1
+# default limit for received frames
+_DEFAULT_MAX_FRAME_LENGTH = 64 * 2**20
+
+def _length_frames(data, max_length=_MAX_FRAME_LENGTH):
+    '''yields (frame_start, telegram_start, telegram_end, frame_end) for each complete length-prefixed frame.
+
+    Raises DecodeError if a frame is announced to be longer than ``max_length``.
+    '''
+    start = 0
+    header_size = _frame_length.size
+    while len(data) - start >= header_size:
+        length, = _frame_length.unpack_from(data, start)
+        if length > max_length:
+            raise DecodeError('Frame of %d bytes exceeds the limit of %d bytes'%(length, max_length))
+        end = start + header_size + length
+        if end > len(data):
+            break
+        yield start, start + header_size, end, end
+        start = end
+
+def _decode_frames(data, frames, decode_one, sec_in, copy=True):
+    '''decode the telegrams in the given frames, pairing rpc.secinfo headers with their payload.
+
+    ``frames`` yields (frame_start, telegram_start, telegram_end, frame_end),
+    like :func:`_length_frames`. ``decode_one(telegram, secinfo)`` returns a
+    message, a list of messages (batch) or a DecodeError. The telegrams are
+    passed as bytes, or as views of ``data`` if ``copy`` is False. Empty 
+    telegrams are skipped.
+
+    Returns messages, consumed, and the frame of a dangling rpc.secinfo 
+    header (or None).
+    '''
+    messages = []
+    secinfo = None
+    # end of the last frame; start of the pending rpc.secinfo header
+    start = header_start = 0
+    header_frame = None
+    for frame in frames:
+        frame_start, telegram_start, telegram_end, start = frame
+        telegram = data[telegram_start:telegram_end]
+        if copy:
+            telegram = bytes(telegram)
+        if not telegram:
+            continue
+        if secinfo is not None:
+            if sec_in is None:
+                messages.append(DecodeError('Got secured message without knowing how to process it.'))
+                secinfo = None
+                continue
+            new_telegram = sec_in(bytes(telegram), secinfo)
+            if new_telegram is not None:
+                telegram = new_telegram
+        message = decode_one(telegram, secinfo)
+        secinfo = None
+        if isinstance(message, list):
+            # batch
+            messages.extend(message)
+        elif isinstance(message, Message) and message.method == 'rpc.secinfo':
+            secinfo = message.kwargs or {}
+            header_start = frame_start
+            header_frame = frame
+            # keep around for next iteration (message follows)
+        else:
+            messages.append(message)
+    if secinfo is None:
+        return messages, start, None
+    else:
+        # dangling secinfo - received header without message
+        # leave header message in the remainder
+        return messages, header_start, header_frame
+
+def _json_object_hook(val):
+    if '__bytes' in val:
+        return base64.b64decode(val['__bytes'].encode('utf8'))
+    return val
+
 
 class JsonRpcCodec(Codec):
     '''Json codec: convert to json
@@ -219,21 +445,90 @@ class JsonRpcCodec(Codec):
        response back per JSON-RPC spec. :-)
      - Msg from "unaware" peer: will implicitly be treated as no-security message.
     
+    *Length-prefixed framing*
+
+    With ``framing='length'``, each frame is preceded by its length as 4-byte 
+    unsigned big-endian integer instead of being terminated by the delimiter:
+
+    ``<LEN><header><LEN><payload>``
+
+    The payload may then contain any bytes, and the receiver finds frame 
+    boundaries without scanning the data. The secinfo header scheme is the 
+    same as above, with the header and the payload being separate frames.
+    Both sides must use the same framing.
+
+    *Batches*
+
+    :meth:`encode_batch` encodes several calls as JSON-RPC 2.0 batch, i.e. a 
+    json array of call objects, in one frame (with one secinfo header). 
+    Received batches are expanded into the individual messages, which share
+    the secinfo. Replies to batched calls are sent individually.
+
+    *Attachments*
+
+    With ``attachments=True`` (requires length framing), bytes values are 
+    not base64-encoded but appended to the JSON text as raw segments and 
+    referenced by index, ``{"__att": <index>}``. The payload of each frame is
+
+    ``<JSONLEN><json><LEN1><bytes1><LEN2><bytes2>...``
+
+    with all lengths being 4-byte unsigned big-endian integers. On the 
+    receiving side, attachments are returned as read-only :class:`memoryview`
+    objects pointing into the receive buffer, i.e. they are not copied. 
+    Convert them using ``bytes()`` if needed. Holding on to them keeps the 
+    receive buffer in memory.
+
+    *Frame size limit*
+
+    Incoming frames (resp. telegrams without delimiter so far) longer than 
+    ``max_frame_length`` bytes make :meth:`decode_buffer` raise 
+    :class:`.DecodeError`, since the stream cannot be resynchronized. 
+    Transports drop the connection then.
     '''
     shorthand = 'jrpc'
     @classmethod
     def fromstring(cls, expression):
-        '''jrpc:delimiter
+        '''jrpc:delimiter or jrpc:<options>
         
         delimiter is the character splitting the telegrams and must not occur
         within any telegram. Default = <null>.
+
+        options is a comma-separated list of:
+
+            * ``len``: use length-prefixed framing instead of a delimiter.
+            * ``att``: transfer bytes as raw attachments (implies ``len``).
+
+        Thus a delimiter spelled like an option (e.g. ``len``) cannot be 
+        given here; use the constructor for that.
         '''
         _, _, delim = expression.partition(':')
+        options = delim.split(',')
+        if delim and all(option in cls._options for option in options):
+            kwargs = {}
+            for option in options:
+                kwargs.update(cls._options[option])
+            return cls(**kwargs)
         delim = delim.encode('ascii')
         return cls(delimiter = delim or b'\0')
 
-    def __init__(self, delimiter=b'\0'):
+    # fromstring option --> constructor kwargs
+    _options = {
+        'len': {'framing': 'length'},
+        'att': {'framing': 'length', 'attachments': True},
+    }
+
+    def __init__(self, delimiter=b'\0', framing='delimiter', attachments=False, max_frame_length=_DEFAULT_MAX_FRAME_LENGTH):
+        if framing not in ('delimiter', 'length'):
+            raise ValueError('Invalid framing %r'%(framing,))
+        if attachments and framing != 'length':
+            raise ValueError('Attachments require framing="length"')
+        self.framing = framing
+        self.attachments = attachments
         self.delimiter = delimiter
+        self.max_frame_length = max_frame_length
+        self._delim_re = re.compile(re.escape(delimiter))
+        # raw_decode keeps no state, so one instance can be shared.
+        self._json_decoder = MyJsonDecoder(object_hook=_json_object_hook)
 
     def encode(self, method, kwargs, id=0, sec_out=None):
         return self._encode_generic(id=id, method=method, params=kwargs, sec_out=sec_out)
@@ -252,17 +547,50 @@ class JsonRpcCodec(Codec):
                 sec_out=sec_out
             )
 
-    def _encode_generic(self, id=0, sec_out=None, **fields):
+    def encode_batch(self, calls, sec_out=None):
+        '''encodes the calls as one JSON-RPC batch (json array) in a single frame.'''
+        return self._encode_payload(
+            [self._message_dict(id=id, method=method, params=kwargs) for method, kwargs, id in calls],
+            sec_out
+        )
+
+    def _message_dict(self, id=0, **fields):
         data = { 'jsonrpc': '2.0', }
         data.update(fields)
         if id: data['id'] = id
-        data = json.dumps(data, cls=MyJsonEncoder).encode('utf8')
+        return data
+
+    def call_encoder(self, method):
+        '''pre-encodes the message head; params and id are filled in per call.'''
+        if self.attachments:
+            return Codec.call_encoder(self, method)
+        head = b'{"jsonrpc": "2.0", "method": %s, "params": '%json.dumps(method).encode('utf8')
+        dumps = MyJsonEncoder().encode
+        def encode(kwargs, id=0, sec_out=None):
+            params = dumps(kwargs).encode('utf8')
+            if id:
+                data = b'%s%s, "id": %d}'%(head, params, id)
+            else:
+                data = head + params + b'}'
+            return self._frame_payload(data, sec_out)
+        return encode
+
+    def _encode_generic(self, id=0, sec_out=None, **fields):
+        return self._encode_payload(self._message_dict(id=id, **fields), sec_out)
+
+    def _encode_payload(self, data, sec_out):
+        return self._frame_payload(self._dumps(data), sec_out)
+
+    def _frame_payload(self, data, sec_out):
+        '''applies security and framing to the serialized payload.'''
         if sec_out:
             secinfo, new_data = sec_out(data)
         else:
             secinfo, new_data = {}, None
         if not new_data is None:
             data = new_data
+        if self.framing == 'length':
+            return self._encode_length_framed(data, secinfo)
         if self.delimiter in data:
             raise EncodeError('Data must not contain the message delimiter %r'%(self.delimiter,))
         if secinfo:
@@ -271,54 +599,101 @@ class JsonRpcCodec(Codec):
                 'method': 'rpc.secinfo',
                 'params': secinfo
             }
-            header = json.dumps(header, cls=MyJsonEncoder).encode('utf8')
+            header = self._dumps(header)
             return b''.join([header, self.delimiter, data, self.delimiter])
         else:
             return data + self.delimiter
 
+    def _dumps(self, obj):
+        '''serialize the message dict, including attachments.'''
+        if not self.attachments:
+            return json.dumps(obj, cls=MyJsonEncoder).encode('utf8')
+        attachments = []
+        text = json.dumps(obj, cls=_AttachmentEncoder, attachments=attachments).encode('utf8')
+        parts = [_frame_length.pack(len(text)), text]
+        for attachment in attachments:
+            parts.append(_frame_length.pack(len(attachment)))
+            parts.append(attachment)
+        return b''.join(parts)
+
     def decode(self, data, sec_in=None):
-        telegrams = data.split(self.delimiter)
-        messages = []
-        secinfo = None
-        for telegram in telegrams[:-1]:
-            if not telegram:
-                continue
-            if secinfo is not None:
-                if sec_in is None:
-                    messages.append(DecodeError('Got secured message without knowing how to process it.'))
-                    secinfo = None
-                    continue
-                new_telegram = sec_in(telegram, secinfo)
-                if new_telegram is not None:
-                    telegram = new_telegram
-            message = self._decode_one(telegram, secinfo)
-            secinfo = None
-            if isinstance(message, Message) and message.method == 'rpc.secinfo':
-                secinfo = message.kwargs or {}
-                # keep around for next iteration (message follows)
-            else:
-                messages.append(message)
-        if secinfo is None:
-            return messages, telegrams[-1]
+        messages, consumed = self.decode_buffer(data, sec_in=sec_in)
+        return messages, bytes(data[consumed:])
+
+    def _encode_length_framed(self, data, secinfo):
+        if len(data) > _MAX_FRAME_LENGTH:
+            raise EncodeError('Frame too long (%d bytes)'%len(data))
+        if secinfo:
+            header = {
+                'jsonrpc': '2.0',
+                'method': 'rpc.secinfo',
+                'params': secinfo
+            }
+            header = self._dumps(header)
+            return b''.join([_frame_length.pack(len(header)), header, _frame_length.pack(len(data)), data])
         else:
-            # dangling secinfo - received header without message
-            # put header message back into remainder
-            return messages, self.delimiter.join(telegrams[-2:])
-    
+            return _frame_length.pack(len(data)) + data
+
+    def decode_buffer(self, data, sec_in=None):
+        if self.framing == 'length':
+            frames = _length_frames(data, self.max_frame_length)
+        else:
+            frames = self._delimited_frames(data)
+        messages, consumed, _ = self._decode_telegrams(data, frames, sec_in)
+        self._check_remainder(len(data) - consumed)
+        return messages, consumed
+
+    def _check_remainder(self, length):
+        '''raises DecodeError if an unterminated telegram is longer than allowed.'''
+        if length > self.max_frame_length:
+            raise DecodeError('Telegram of more than %d bytes without delimiter'%(self.max_frame_length,))
+
+    def decoder(self):
+        if self.framing == 'length':
+            # finding the frames is cheap, nothing to remember.
+            return self
+        return JsonRpcDecoder(self)
+
+    def _delimited_frames(self, data, pos=0, start=0):
+        '''yields (frame_start, telegram_start, telegram_end, frame_end) for each delimiter found from pos on.
+
+        ``start`` is where the first frame begins.
+        '''
+        # re works on any buffer, i.e. scans a memoryview without copying it.
+        for match in self._delim_re.finditer(data, pos):
+            yield start, start, match.start(), match.end()
+            start = match.end()
+
+    def _decode_telegrams(self, data, frames, sec_in):
+        '''decode the telegrams in the given frames (see :func:`_decode_frames`).'''
+        # with attachments, keep the views; attachments will point into them.
+        return _decode_frames(data, frames, self._decode_one, sec_in, copy=not self.attachments)
+
     def _decode_one(self, data, secinfo):
+        json_decoder = self._json_decoder
+        if self.attachments:
+            try:
+                data, attachments = _split_attachments(memoryview(data))
+            except DecodeError as e:
+                return e
+            if attachments:
+                json_decoder = MyJsonDecoder(object_hook=lambda val: _attachment_hook(val, attachments))
         try:
-            data = data.decode('utf8')
+            data = str(data, 'utf8')
         except UnicodeDecodeError as e:
             return DecodeError("UTF8 decoding failed")
-        def obj_hook(val):
-            if '__bytes' in val:
-                return base64.b64decode(val['__bytes'].encode('utf8'))
-            return val
-        decoder = MyJsonDecoder(object_hook=obj_hook)
         try:
-            jdict, idx = decoder.raw_decode(data)
-        except json.JSONDecodeError as e:
+            jdict, idx = json_decoder.raw_decode(data)
+        except ValueError as e:
+            # JSONDecodeError or bad attachment reference
             return DecodeError('Not a valid json string: "%s"'%data)
+        if isinstance(jdict, list):
+            if not jdict:
+                return DecodeError('empty batch')
+            return [self._decode_dict(item, secinfo) for item in jdict]
+        return self._decode_dict(jdict, secinfo)
+
+    def _decode_dict(self, jdict, secinfo):
         if not isinstance(jdict, dict):
             return DecodeError('json toplevel object is not a dict')
         if jdict.get('jsonrpc', '') != '2.0':
@@ -349,3 +724,64 @@ class JsonRpcCodec(Codec):
         else:
             return DecodeError('Message does not contain method, result or error key.')
 
+
+
+class JsonRpcDecoder(object):
+    '''Decodes the data stream of one sender for a :class:`JsonRpcCodec`.
+
+    Remembers how far the undecoded remainder was already searched for the
+    delimiter, so that on the next call only the newly appended bytes are 
+    scanned.
+
+    This requires that the next data passed in starts with the remainder 
+    left by the previous call, as a transport's :class:`.ReceiveBuffer` 
+    guarantees. The scan position is only reused if ``data`` is a memoryview 
+    into the same buffer object as before; otherwise the whole data is scanned.
+    The buffer is only referenced weakly; buffers that do not support weak
+    references are always scanned completely.
+    '''
+    def __init__(self, codec):
+        self.codec = codec
+        # weak reference to the buffer object the remainder lives in
+        self._source = None
+        # length of the remainder
+        self._pending = 0
+        # number of bytes of the remainder that were searched for delimiters
+        self._scanned = 0
+        # frame of a dangling rpc.secinfo header
+        self._header_frame = None
+
+    def decode_buffer(self, data, sec_in=None):
+        '''Like :meth:`Codec.decode_buffer`.'''
+        source = data.obj if isinstance(data, memoryview) else None
+        codec = self.codec
+        if source is None or self._source is None or source is not self._source() or len(data) < self._pending:
+            frames = codec._delimited_frames(data)
+        else:
+            # a delimiter might straddle the end of the scanned part.
+            scan_from = max(0, self._scanned - len(codec.delimiter) + 1)
+            if self._header_frame:
+                header_end = self._header_frame[3]
+                frames = it.chain(
+                    [self._header_frame],
+                    codec._delimited_frames(data, max(scan_from, header_end), header_end)
+                )
+            else:
+                frames = codec._delimited_frames(data, scan_from)
+        messages, consumed, header_frame = codec._decode_telegrams(data, frames, sec_in)
+        codec._check_remainder(len(data) - consumed)
+        if consumed == len(data):
+            self._source = None
+            self._pending = self._scanned = 0
+            self._header_frame = None
+        else:
+            try:
+                self._source = weakref.ref(source)
+            except TypeError:
+                self._source = None
+            self._pending = len(data) - consumed
+            self._scanned = self._pending
+            if header_frame:
+                header_frame = tuple(pos - consumed for pos in header_frame)
+            self._header_frame = header_frame
+        return messages, consumed
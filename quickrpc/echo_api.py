@@ -13,7 +13,7 @@ Use `telnet localhost 8888` to test tcp functionality.
 Use `tail -F echo_api.log` in another terminal to watch logged events.
 '''
 import logging
-L = lambda: logging.getLogger(__name__)
+L = logging.getLogger(__name__)
 from threading import Event
 from .import transport, RemoteAPI, incoming, outgoing
 
@@ -35,7 +35,7 @@ class EchoAPI(RemoteAPI):
 
 
 def test():
-    L().info('Start echo_api.test')
+    L.info('Start echo_api.test')
     stop_event = Event()
 
     print('serving on port 8888')
@@ -60,7 +60,7 @@ def test():
     finally:
         api.transport.stop()
     
-    L().info('Exit echo_api.test')
+    L.info('Exit echo_api.test')
 
 if __name__ == '__main__':
     import logging
@@ -0,0 +1,431 @@
+'''MessagePack codec, implemented in pure Python.
+
+The wire format follows the MessagePack spec (https://msgpack.org), so that
+peers can use any MessagePack library for decoding. No third-party package is
+required.
+'''
+import logging
+import struct
+from .codecs import Codec, Message, LazyMessage, Reply, ErrorReply, DecodeError, EncodeError, RemoteError, _fmt_exc
+from .codecs import _frame_length, _length_frames, _decode_frames, _MAX_FRAME_LENGTH, _DEFAULT_MAX_FRAME_LENGTH
+L = logging.getLogger(__name__)
+
+# Message types, as in the MessagePack-RPC spec.
+_REQUEST = 0
+_RESPONSE = 1
+_NOTIFICATION = 2
+
+
+class MsgpackCodec(Codec):
+    '''MessagePack codec: compact binary encoding.
+
+    Messages are encoded like MessagePack-RPC, except that params are a map of
+    the keyword arguments:
+
+        * Request: ``[0, id, method, params]``
+        * Notification (id=0): ``[2, method, params]``
+        * Reply: ``[1, id, nil, result]``
+        * Error: ``[1, id, {"code": .., "message": .., "data": ..}, nil]``
+
+    Each message is a frame with a 4-byte unsigned big-endian length prefix.
+
+    Supported values: None, bool, int (64 bit), float, str, bytes, list,
+    tuple (decoded as list) and dict. bytes are transferred as raw binary,
+    floats as 64-bit IEEE doubles, i.e. without loss of precision.
+
+    *Security*
+
+    Like for :class:`.JsonRpcCodec`, a notification frame
+    ``[2, "rpc.secinfo", <secinfo>]`` is sent before the payload frame if
+    ``sec_out`` returns secinfo. The payload can be any bytes.
+
+    *Lazy decoding*
+
+    With ``lazy=True``, the params of incoming calls are decoded only when
+    their ``.kwargs`` are accessed (see :class:`.LazyMessage`). This saves
+    the work for messages which are rejected or forwarded.
+
+    Frames longer than ``max_frame_length`` are rejected like in 
+    :class:`.JsonRpcCodec`.
+    '''
+    shorthand = 'msgpack'
+    @classmethod
+    def fromstring(cls, expression):
+        '''msgpack:[lazy]'''
+        _, _, options = expression.partition(':')
+        return cls(lazy=_lazy_option(options))
+
+    def __init__(self, lazy=False, max_frame_length=_DEFAULT_MAX_FRAME_LENGTH):
+        self.lazy = lazy
+        self.max_frame_length = max_frame_length
+
+    def encode(self, method, kwargs, id=0, sec_out=None):
+        if id:
+            msg = [_REQUEST, id, method, kwargs]
+        else:
+            msg = [_NOTIFICATION, method, kwargs]
+        return self._encode_generic(msg, sec_out)
+
+    def call_encoder(self, method):
+        '''pre-encodes the method name.'''
+        packed_method = packb(method)
+        request_head = packb(_REQUEST)
+        notification_head = b'\x93' + packb(_NOTIFICATION) + packed_method
+        def encode(kwargs, id=0, sec_out=None):
+            if id:
+                data = b''.join([b'\x94', request_head, packb(id), packed_method, packb(kwargs)])
+            else:
+                data = notification_head + packb(kwargs)
+            return self._frame(data, sec_out)
+        return encode
+
+    def encode_reply(self, in_reply_to, result, sec_out=None):
+        return self._encode_generic([_RESPONSE, in_reply_to.id, None, result], sec_out)
+
+    def encode_error(self, in_reply_to, exception, errorcode=0, sec_out=None):
+        error = {
+            'code': errorcode,
+            'message': str(exception),
+            'data': _fmt_exc(exception),
+        }
+        return self._encode_generic([_RESPONSE, in_reply_to.id, error, None], sec_out)
+
+    def _encode_generic(self, msg, sec_out):
+        return self._frame(self._pack(msg), sec_out)
+
+    def _frame(self, data, sec_out):
+        '''applies security and framing to the packed payload.'''
+        if sec_out:
+            secinfo, new_data = sec_out(data)
+        else:
+            secinfo, new_data = {}, None
+        if not new_data is None:
+            data = new_data
+        if len(data) > _MAX_FRAME_LENGTH:
+            raise EncodeError('Frame too long (%d bytes)'%len(data))
+        if secinfo:
+            header = self._pack(self._secinfo_header(secinfo))
+            return b''.join([_frame_length.pack(len(header)), header, _frame_length.pack(len(data)), data])
+        else:
+            return _frame_length.pack(len(data)) + data
+
+    def _pack(self, msg):
+        return packb(msg)
+
+    def _payload(self, data):
+        '''returns the MessagePack data of the payload. Raises DecodeError.'''
+        return data
+
+    def _secinfo_header(self, secinfo):
+        return [_NOTIFICATION, 'rpc.secinfo', secinfo]
+
+    def decode(self, data, sec_in=None):
+        messages, consumed = self.decode_buffer(data, sec_in=sec_in)
+        return messages, bytes(data[consumed:])
+
+    def decode_buffer(self, data, sec_in=None):
+        frames = _length_frames(data, self.max_frame_length)
+        messages, consumed, _ = _decode_frames(data, frames, self._decode_one, sec_in)
+        return messages, consumed
+
+    def _decode_one(self, data, secinfo):
+        try:
+            data = self._payload(data)
+            if self.lazy:
+                # all but params
+                msg, idx, remaining = unpack_head(data, -1)
+                if remaining == 1 and (msg[:1] == [_REQUEST] and len(msg) == 3 or msg[:1] == [_NOTIFICATION] and len(msg) == 2):
+                    return LazyMessage(
+                        method=msg[-1],
+                        parse=lambda: unpack_tail(data, idx, 1)[0] or {},
+                        id=msg[1] if msg[0] == _REQUEST else 0,
+                        secinfo=secinfo
+                    )
+                if remaining:
+                    msg += unpack_tail(data, idx, remaining)
+            else:
+                msg = unpackb(data)
+        except DecodeError as e:
+            return e
+        if not isinstance(msg, list) or not msg:
+            return DecodeError('toplevel object is not a list')
+        kind = msg[0]
+        if kind == _REQUEST and len(msg) == 4:
+            _, id, method, params = msg
+            return Message(method=method, kwargs=params or {}, id=id, secinfo=secinfo)
+        elif kind == _NOTIFICATION and len(msg) == 3:
+            _, method, params = msg
+            return Message(method=method, kwargs=params or {}, id=0, secinfo=secinfo)
+        elif kind == _RESPONSE and len(msg) == 4:
+            _, id, error, result = msg
+            if error is None:
+                return Reply(result=result, id=id, secinfo=secinfo)
+            if not isinstance(error, dict):
+                error = {'message': str(error)}
+            e = RemoteError(error.get('message', 'Unknown error'), error.get('data', ''))
+            return ErrorReply(
+                    exception=e,
+                    id=id,
+                    errorcode=error.get('code', 0),
+                    secinfo=secinfo
+                    )
+        else:
+            return DecodeError('Unknown message type %r'%(kind,))
+
+
+def _lazy_option(options):
+    if options not in ('', 'lazy'):
+        raise ValueError('Unknown codec option: %s'%options)
+    return options == 'lazy'
+
+
+def packb(obj):
+    '''Returns the MessagePack encoding of obj.'''
+    parts = []
+    _pack(obj, parts.append)
+    return b''.join(parts)
+
+def unpackb(data):
+    '''Decodes one MessagePack object that makes up all of data.'''
+    try:
+        obj, idx = _unpack(data, 0)
+    except (IndexError, struct.error):
+        raise DecodeError('Truncated MessagePack data')
+    except RecursionError:
+        raise DecodeError('MessagePack data nested too deeply')
+    if idx != len(data):
+        raise DecodeError('%d extra bytes after MessagePack object'%(len(data) - idx))
+    return obj
+
+def unpack_head(data, count):
+    '''Decodes the first count items of the MessagePack array that makes up data.
+
+    Negative count leaves out the last -count items. Returns ``(items, index
+    after the items, number of remaining items)``. Decode the remaining items
+    with :func:`unpack_tail`.
+    '''
+    try:
+        code = data[0]
+        if 0x90 <= code <= 0x9f:
+            n, idx = code & 0x0f, 1
+        elif code in _array_codes:
+            n, idx = _unpack_length(data, 1, _array_codes[code])
+        else:
+            raise DecodeError('toplevel object is not a list')
+        if count < 0:
+            count = max(n + count, 0)
+        count = min(count, n)
+        items, idx = _unpack_array(data, idx, count)
+    except (IndexError, struct.error):
+        raise DecodeError('Truncated MessagePack data')
+    except RecursionError:
+        raise DecodeError('MessagePack data nested too deeply')
+    return items, idx, n - count
+
+def unpack_tail(data, idx, n):
+    '''Decodes n array items starting at idx, which must make up the rest of data.'''
+    try:
+        items, idx = _unpack_array(data, idx, n)
+    except (IndexError, struct.error):
+        raise DecodeError('Truncated MessagePack data')
+    except RecursionError:
+        raise DecodeError('MessagePack data nested too deeply')
+    if idx != len(data):
+        raise DecodeError('%d extra bytes after MessagePack object'%(len(data) - idx))
+    return items
+
+
+class _Omitted(object):
+    '''Type of :data:`_OMITTED`.'''
+    __slots__ = ()
+    def __repr__(self):
+        return '<omitted>'
+
+# Marks a value that was left out, e.g. an argument slot of the 
+# :class:`.SchemaCodec`. Encoded as extension type 0 with a zero byte.
+_OMITTED = _Omitted()
+_OMITTED_CODE = b'\xd4\x00\x00'
+
+_s_u8 = struct.Struct('>B').pack
+_s_u16 = struct.Struct('>BH').pack
+_s_u32 = struct.Struct('>BI').pack
+_s_u64 = struct.Struct('>BQ').pack
+_s_i8 = struct.Struct('>Bb').pack
+_s_i16 = struct.Struct('>Bh').pack
+_s_i32 = struct.Struct('>Bi').pack
+_s_i64 = struct.Struct('>Bq').pack
+_s_f64 = struct.Struct('>Bd').pack
+
+def _pack_len(n, fix_code, fix_max, code8, code16, code32, write):
+    '''writes the type/length header of a str, bin, array or map.'''
+    if fix_code is not None and n <= fix_max:
+        write(_s_u8(fix_code | n))
+    elif code8 is not None and n < 0x100:
+        write(struct.pack('>BB', code8, n))
+    elif n < 0x10000:
+        write(_s_u16(code16, n))
+    elif n < 0x100000000:
+        write(_s_u32(code32, n))
+    else:
+        raise EncodeError('Object too large for MessagePack (%d items)'%n)
+
+def _pack(obj, write):
+    # bool first, since it is a subclass of int
+    if obj is None:
+        write(b'\xc0')
+    elif obj is _OMITTED:
+        write(_OMITTED_CODE)
+    elif obj is True:
+        write(b'\xc3')
+    elif obj is False:
+        write(b'\xc2')
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            write(_s_u8(obj))
+        elif -32 <= obj < 0:
+            write(_s_u8(obj & 0xff))
+        elif obj >= 0:
+            if obj < 0x100:
+                write(struct.pack('>BB', 0xcc, obj))
+            elif obj < 0x10000:
+                write(_s_u16(0xcd, obj))
+            elif obj < 0x100000000:
+                write(_s_u32(0xce, obj))
+            elif obj < 0x10000000000000000:
+                write(_s_u64(0xcf, obj))
+            else:
+                raise EncodeError('Integer too large for MessagePack: %d'%obj)
+        else:
+            if obj >= -0x80:
+                write(_s_i8(0xd0, obj))
+            elif obj >= -0x8000:
+                write(_s_i16(0xd1, obj))
+            elif obj >= -0x80000000:
+                write(_s_i32(0xd2, obj))
+            elif obj >= -0x8000000000000000:
+                write(_s_i64(0xd3, obj))
+            else:
+                raise EncodeError('Integer too small for MessagePack: %d'%obj)
+    elif isinstance(obj, float):
+        write(_s_f64(0xcb, obj))
+    elif isinstance(obj, str):
+        data = obj.encode('utf8')
+        _pack_len(len(data), 0xa0, 31, 0xd9, 0xda, 0xdb, write)
+        write(data)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        data = bytes(obj)
+        _pack_len(len(data), None, 0, 0xc4, 0xc5, 0xc6, write)
+        write(data)
+    elif isinstance(obj, (list, tuple)):
+        _pack_len(len(obj), 0x90, 15, None, 0xdc, 0xdd, write)
+        for item in obj:
+            _pack(item, write)
+    elif isinstance(obj, dict):
+        _pack_len(len(obj), 0x80, 15, None, 0xde, 0xdf, write)
+        for key, value in obj.items():
+            _pack(key, write)
+            _pack(value, write)
+    else:
+        raise EncodeError('Cannot encode object of type %s'%type(obj).__name__)
+
+
+_u8 = struct.Struct('>B').unpack_from
+_u16 = struct.Struct('>H').unpack_from
+_u32 = struct.Struct('>I').unpack_from
+_u64 = struct.Struct('>Q').unpack_from
+_i8 = struct.Struct('>b').unpack_from
+_i16 = struct.Struct('>h').unpack_from
+_i32 = struct.Struct('>i').unpack_from
+_i64 = struct.Struct('>q').unpack_from
+_f32 = struct.Struct('>f').unpack_from
+_f64 = struct.Struct('>d').unpack_from
+
+# code --> (unpack function, size) for fixed-size scalars
+_scalars = {
+    0xcc: (_u8, 1), 0xcd: (_u16, 2), 0xce: (_u32, 4), 0xcf: (_u64, 8),
+    0xd0: (_i8, 1), 0xd1: (_i16, 2), 0xd2: (_i32, 4), 0xd3: (_i64, 8),
+    0xca: (_f32, 4), 0xcb: (_f64, 8),
+}
+# code --> (unpack function for the length, size of the length)
+_lengths8 = (_u8, 1)
+_lengths16 = (_u16, 2)
+_lengths32 = (_u32, 4)
+_str_codes = {0xd9: _lengths8, 0xda: _lengths16, 0xdb: _lengths32}
+_bin_codes = {0xc4: _lengths8, 0xc5: _lengths16, 0xc6: _lengths32}
+_array_codes = {0xdc: _lengths16, 0xdd: _lengths32}
+_map_codes = {0xde: _lengths16, 0xdf: _lengths32}
+
+def _unpack(data, idx):
+    '''decodes the object starting at idx. Returns (object, index after the object).'''
+    code = data[idx]
+    idx += 1
+    if code < 0x80:
+        return code, idx
+    elif code >= 0xe0:
+        return code - 0x100, idx
+    elif 0xa0 <= code <= 0xbf:
+        return _unpack_str(data, idx, code & 0x1f)
+    elif 0x90 <= code <= 0x9f:
+        return _unpack_array(data, idx, code & 0x0f)
+    elif 0x80 <= code <= 0x8f:
+        return _unpack_map(data, idx, code & 0x0f)
+    elif code == 0xc0:
+        return None, idx
+    elif code == 0xd4:
+        # fixext 1
+        if data[idx:idx+2] != _OMITTED_CODE[1:]:
+            raise DecodeError('Unsupported MessagePack extension type %d'%_i8(data, idx)[0])
+        return _OMITTED, idx + 2
+    elif code == 0xc2:
+        return False, idx
+    elif code == 0xc3:
+        return True, idx
+    elif code in _scalars:
+        unpack, size = _scalars[code]
+        return unpack(data, idx)[0], idx + size
+    elif code in _str_codes:
+        n, idx = _unpack_length(data, idx, _str_codes[code])
+        return _unpack_str(data, idx, n)
+    elif code in _bin_codes:
+        n, idx = _unpack_length(data, idx, _bin_codes[code])
+        if idx + n > len(data):
+            raise IndexError()
+        return bytes(data[idx:idx+n]), idx + n
+    elif code in _array_codes:
+        n, idx = _unpack_length(data, idx, _array_codes[code])
+        return _unpack_array(data, idx, n)
+    elif code in _map_codes:
+        n, idx = _unpack_length(data, idx, _map_codes[code])
+        return _unpack_map(data, idx, n)
+    else:
+        raise DecodeError('Unsupported MessagePack type code 0x%02x'%code)
+
+def _unpack_length(data, idx, lengthtype):
+    unpack, size = lengthtype
+    return unpack(data, idx)[0], idx + size
+
+def _unpack_str(data, idx, n):
+    if idx + n > len(data):
+        raise IndexError()
+    try:
+        return str(data[idx:idx+n], 'utf8'), idx + n
+    except UnicodeDecodeError:
+        raise DecodeError('UTF8 decoding failed')
+
+def _unpack_array(data, idx, n):
+    result = []
+    for _ in range(n):
+        item, idx = _unpack(data, idx)
+        result.append(item)
+    return result, idx
+
+def _unpack_map(data, idx, n):
+    result = {}
+    for _ in range(n):
+        key, idx = _unpack(data, idx)
+        value, idx = _unpack(data, idx)
+        try:
+            result[key] = value
+        except TypeError:
+            raise DecodeError('Unhashable map key of type %s'%type(key).__name__)
+    return result, idx
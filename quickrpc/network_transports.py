@@ -1,14 +1,19 @@
-__all__ = ['UdpTransport', 'TcpServerTransport', 'TcpClientTransport']
+__all__ = ['UdpTransport', 'TcpServerTransport', 'SelectorTcpServerTransport', 'TcpClientTransport']
 
 import logging
 
+import heapq
+import itertools as it
+import selectors
 import socket as sk
+import time
+from collections import deque
 from select import select
 from socketserver import ThreadingTCPServer, BaseRequestHandler
-from threading import Thread, Event
-from .transports import Transport, MuxTransport
+from threading import Thread, Event, Lock, current_thread
+from .transports import Transport, MuxTransport, Waker, FillLevel, ReceiveBuffer, _all_fulfilled
 
-L = lambda: logging.getLogger(__name__)
+L = logging.getLogger(__name__)
 
 class UdpTransport(Transport):
     '''transport that communicates over UDP datagrams.
@@ -28,10 +33,12 @@ class UdpTransport(Transport):
     def __init__(self, port):
         Transport.__init__(self)
         self.port = port
+        # only exists while open
+        self._waker = None
 
     def open(self):
         self.socket = sk.socket(sk.AF_INET, sk.SOCK_DGRAM)
-        self.socket.settimeout(0.5)
+        self.socket.setblocking(False)
         self.socket.setsockopt(sk.SOL_SOCKET, sk.SO_BROADCAST, 1)
         self.socket.setsockopt(sk.SOL_SOCKET, sk.SO_REUSEADDR, 1)
         self.socket.setsockopt(sk.SOL_SOCKET, sk.IP_MULTICAST_LOOP, 1)
@@ -41,39 +48,150 @@ class UdpTransport(Transport):
             # SO_REUSEPORT not available.
             pass
         self.socket.bind(('', self.port))
+        self._waker = Waker()
 
     def run(self):
         self.running = True
         while self.running:
+            readable, _, _ = select([self.socket, self._waker], [], [])
+            if self._waker in readable:
+                self._waker.drain()
+            if self.socket not in readable:
+                continue
             try:
                 data, addr = self.socket.recvfrom(2048)
-            except sk.timeout:
+            except (BlockingIOError, InterruptedError):
                 continue
             host, port = addr
             # not using leftover data  here, since udp packets are
             # not guaranteed to arrive in order.
-            L().debug('message from udp %s: %s'%(host, data))
+            if L.isEnabledFor(logging.DEBUG):
+                L.debug('message from udp %s: %s', host, data)
             self.received(data=data, sender=host)
         self.socket.close()
+        self._waker.close()
+
+    def stop(self, block=True):
+        self.running = False
+        if self._waker:
+            self._waker.wake()
+        Transport.stop(self, block=block)
 
     def send(self, data, receivers=None):
-        L().debug('message to udp %r: %s'%(receivers, data))
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug('message to udp %r: %s', receivers, data)
         if receivers:
             for receiver in receivers:
                 self.socket.sendto(data, (receiver, self.port))
         else:
             self.socket.sendto(data, ('<broadcast>', self.port))
 
+class _WriteQueue(object):
+    '''Outbound buffer of a stream connection.
+
+    :meth:`put` can be called from any thread and never blocks. The
+    transport's I/O loop calls :meth:`flush` when the socket is writable,
+    which writes out as many of the queued chunks as possible with a single
+    ``sendmsg`` call. This also ensures that concurrently sent messages
+    never interleave.
+
+    The amount of queued data is tracked in :attr:`fill`, a :class:`.FillLevel`.
+    '''
+    # max. number of buffers passed to one sendmsg call (IOV_MAX is >= 1024 on common platforms)
+    MAX_BUFFERS = 1024
+
+    def __init__(self):
+        self._chunks = deque()
+        self._lock = Lock()
+        self.fill = FillLevel()
+
+    def __len__(self):
+        return self.fill.level
+
+    def put(self, data):
+        '''Queue data for sending. Returns True if the queue was empty before.'''
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        if not data:
+            return False
+        with self._lock:
+            was_empty = not self._chunks
+            self._chunks.append(data)
+        self.fill.add(len(data))
+        return was_empty
+
+    def clear(self):
+        with self._lock:
+            size = sum(len(chunk) for chunk in self._chunks)
+            self._chunks.clear()
+        self.fill.remove(size)
+
+    def flush(self, sock):
+        '''Write as much as possible to the nonblocking socket.
+
+        Returns True if the queue was emptied. Socket errors are raised.
+        '''
+        total = 0
+        try:
+            with self._lock:
+                chunks = self._chunks
+                while chunks:
+                    buffers = list(it.islice(chunks, self.MAX_BUFFERS))
+                    try:
+                        if _HAVE_SENDMSG:
+                            sent = sock.sendmsg(buffers)
+                        else:
+                            sent = sock.send(b''.join(buffers))
+                    except (BlockingIOError, InterruptedError):
+                        return False
+                    total += sent
+                    if sent == sum(len(b) for b in buffers):
+                        for _ in buffers:
+                            chunks.popleft()
+                        continue
+                    # partial write: socket buffer is full.
+                    while sent >= len(chunks[0]):
+                        sent -= len(chunks.popleft())
+                    if sent:
+                        chunks[0] = memoryview(chunks[0])[sent:]
+                    return False
+                return True
+        finally:
+            # outside of the lock, since resuming might call back into put().
+            if total:
+                self.fill.remove(total)
+
+    def flush_blocking(self, sock, timeout):
+        '''Write out everything that is left, waiting at most ``timeout`` seconds.
+
+        Returns True if the queue was emptied.
+        '''
+        deadline = time.monotonic() + timeout
+        while not self.flush(sock):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            select([], [sock], [], remaining)
+        return True
+
+_HAVE_SENDMSG = hasattr(sk.socket, 'sendmsg')
+# seconds to wait for queued data to be written when closing a server-side connection.
+_FLUSH_ON_CLOSE_TIMEOUT = 10
+
+
 class TcpClientTransport(Transport):
     '''Transport that connects to a TCP server.
 
+    :meth:`send` only queues the data; the transport's thread writes it out
+    as soon as the socket accepts it. Data still queued on :meth:`stop` is 
+    written out, waiting at most ``connect_timeout`` seconds.
+
     Optionally, a keepalive message can be configured. ``keepalive_msg`` is sent verbatim
     every ``keepalive_interval`` seconds while the connection is idle. Any sending or
     receiving resets the timer. You can change the attributes anytime.
     '''
     shorthand = 'tcp'
 
-    _CHECK_INTERVAL = 0.5
     @classmethod
     def fromstring(cls, expression):
         '''tcp:<host>:<port>'''
@@ -86,67 +204,147 @@ class TcpClientTransport(Transport):
         self.address = (host, port)
         self.name = '%s:%s'%self.address
         self.connect_timeout = connect_timeout
-        self.keepalive_msg = keepalive_msg
-        self.keepalive_interval = keepalive_interval
-        self._keepalive_countdown = keepalive_interval
+        self._waker = Waker()
+        self._outqueue = _WriteQueue()
+        self._reading_paused = False
+        self._keepalive_msg = keepalive_msg
+        self._keepalive_interval = keepalive_interval
+        self._keepalive_due = 0.
         self.buffersize = buffersize
 
+    @property
+    def keepalive_msg(self):
+        return self._keepalive_msg
+    @keepalive_msg.setter
+    def keepalive_msg(self, value):
+        self._keepalive_msg = value
+        # let the loop recompute its timeout
+        self._waker.wake()
+
+    @property
+    def keepalive_interval(self):
+        return self._keepalive_interval
+    @keepalive_interval.setter
+    def keepalive_interval(self, value):
+        self._keepalive_interval = value
+        self._keepalive_reset()
+        self._waker.wake()
+
+    def _keepalive_reset(self):
+        self._keepalive_due = time.monotonic() + self._keepalive_interval
+
+    def stop(self, block=True):
+        self.running = False
+        self._waker.wake()
+        Transport.stop(self, block=block)
+
     def send(self, data, receivers=None):
         if receivers is not None and not self.name in receivers:
             return
         if not self.running:
             raise IOError('Tried to send over non-running transport!')
-        self._keepalive_countdown = self.keepalive_interval
-        L().debug('TcpClientTransport .send to %s: %r'%(self.name, data))
-        # FIXME: do something on failure
-        self.socket.sendall(data)
+        self._keepalive_reset()
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug('TcpClientTransport .send to %s: %r', self.name, data)
+        promise = self._send_backpressure(self._outqueue.fill, self._thread)
+        if self._outqueue.put(data):
+            self._waker.wake()
+        return promise
+
+    @property
+    def send_buffered(self):
+        return len(self._outqueue)
+
+    def pause_reading(self):
+        self._reading_paused = True
+
+    def resume_reading(self):
+        self._reading_paused = False
+        self._waker.wake()
 
     def open(self):
-        L().debug('TcpClientTransport.open() called')
+        L.debug('TcpClientTransport.open() called')
         try:
             self.socket = sk.create_connection(self.address, self.connect_timeout)
         except ConnectionRefusedError:
-            L().error('Connection to %s failed'%(self.name))
+            L.error('Connection to %s failed', self.name)
             raise
-        L().info('Connected to %s'%(self.name,))
-        # Sets the timeout for .read and .write
-        self._keepalive_countdown = self.keepalive_interval
+        L.info('Connected to %s', self.name)
+        self.socket.setblocking(False)
+        self._outqueue.clear()
+        self._outqueue.fill.set_watermarks(self.send_high_watermark, self.send_low_watermark)
+        self._keepalive_reset()
 
     def run(self):
         '''run, blocking.'''
         self.running = True
-        leftover = b''
+        buffer = ReceiveBuffer()
         while self.running:
-            readable, _, _ = select([self.socket], [], [], self._CHECK_INTERVAL)
-            if not readable:
+            timeout = _keepalive_timeout(self._keepalive_msg, self._keepalive_due)
+            rlist = [self._waker] if self._reading_paused else [self.socket, self._waker]
+            wlist = [self.socket] if self._outqueue else []
+            readable, writable, _ = select(rlist, wlist, [], timeout)
+            if self._waker in readable:
+                self._waker.drain()
+            if writable:
+                try:
+                    self._outqueue.flush(self.socket)
+                except OSError:
+                    L.error('TcpClientTransport: sending to %s failed, see exc. info', self.name, exc_info=True)
+                    self._connection_lost()
+                    break
+                self._keepalive_reset()
+            if self.socket not in readable:
                 self._keepalive_tick()
                 continue
             try:
-                data = self.socket.recv(self.buffersize)
+                nbytes = buffer.recv_into(self.socket, self.buffersize)
+            except (BlockingIOError, InterruptedError):
+                continue
             except ConnectionError:
-                data = b''
-            self._keepalive_countdown = self.keepalive_interval
-            if data == b'':
-                # Connection was closed.
-                self.running=False
-                self.socket=None
-                L().info('Connection to %s closed by remote side.'%(self.name,))
+                nbytes = 0
+            self._keepalive_reset()
+            if nbytes == 0:
+                L.info('Connection to %s closed by remote side.', self.name)
+                self._connection_lost()
+                break
+            if L.isEnabledFor(logging.DEBUG):
+                L.debug('%d bytes from %s', nbytes, self.name)
+            try:
+                buffer.deliver(self, self.name)
+            except Exception:
+                L.error('TcpClientTransport: error while processing data from %s, closing connection', self.name, exc_info=True)
+                self._connection_lost()
                 break
-            L().debug('data from %s: %r'%(self.name, data))
-            leftover = self.received(sender=self.name, data=leftover+data)
 
         if self.socket:
-            L().info('Closing connection to %s.'%(self.name,))
+            L.info('Closing connection to %s.', self.name)
+            try:
+                if not self._outqueue.flush_blocking(self.socket, self.connect_timeout):
+                    L.warning('Closing %s with %d bytes left unsent', self.name, len(self._outqueue))
+            except OSError:
+                L.warning('Sending remaining data to %s failed', self.name, exc_info=True)
             self.socket.close()
-        L().debug('TcpClientTransport %s has finished'%(self.name))
+        L.debug('TcpClientTransport %s has finished', self.name)
+
+    def _connection_lost(self):
+        self.running = False
+        self.socket.close()
+        self.socket = None
+        self._outqueue.clear()
 
     def _keepalive_tick(self):
-        if self.keepalive_msg:
-            self._keepalive_countdown -= self._CHECK_INTERVAL
-            if self._keepalive_countdown <= 0:
-                L().debug('send keepalive')
-                self.socket.sendall(self.keepalive_msg)
-                self._keepalive_countdown = self.keepalive_interval
+        if self._keepalive_msg and time.monotonic() >= self._keepalive_due:
+            L.debug('send keepalive')
+            self._outqueue.put(self._keepalive_msg)
+            self._keepalive_reset()
+
+
+def _keepalive_timeout(keepalive_msg, keepalive_due):
+    '''select() timeout until the next keepalive is due; None if keepalive is off.'''
+    if not keepalive_msg:
+        return None
+    return max(0., keepalive_due - time.monotonic())
 
 
 class TcpServerTransport(MuxTransport):
@@ -196,12 +394,30 @@ class TcpServerTransport(MuxTransport):
     def open(self):
         self.server = ThreadingTCPServer(self.addr, _TcpConnection, bind_and_activate=True)
         self.server.mux = self
-        Thread(target=self.server.serve_forever, name="TcpServerTransport_Listen").start()
+        # handle_request() must not wait, _serve does that.
+        self.server.timeout = 0
+        self._listen_waker = Waker()
+        self._listening = True
+        self._listen_thread = Thread(target=self._serve, name="TcpServerTransport_Listen")
+        self._listen_thread.start()
         if self.announcer:
             try:
                 self.announcer.transport.start()
-            finally:
-                self.server.shutdown()
+            except Exception:
+                self._stop_listening()
+                raise
+
+    def _serve(self):
+        '''accept connections until self._listening is cleared.
+
+        Replaces ``server.serve_forever``, which polls every 0.5 seconds.
+        '''
+        server = self.server
+        while self._listening:
+            readable, _, _ = select([server, self._listen_waker], [], [])
+            if server in readable:
+                server.handle_request()
+        self._listen_waker.close()
 
     def run(self):
         MuxTransport.run(self)
@@ -209,7 +425,12 @@ class TcpServerTransport(MuxTransport):
         if self.announcer:
             self.announcer.transport.stop()
 
-        self.server.shutdown()
+        self._stop_listening()
+
+    def _stop_listening(self):
+        self._listening = False
+        self._listen_waker.wake()
+        self._listen_thread.join()
         self.server.server_close()
 
     def close(self, name):
@@ -217,7 +438,7 @@ class TcpServerTransport(MuxTransport):
         '''
         for transport in self.transports:
             if transport.name == name:
-                transport.transport_running.clear()
+                transport.stop()
 
 
 class _TcpConnection(BaseRequestHandler, Transport):
@@ -230,9 +451,9 @@ class _TcpConnection(BaseRequestHandler, Transport):
     The Transport also stops upon client-side close of connection.
 
     The _TcpConnection registers and unregisters itself with the TcpServerTransport.
-    '''
 
-    _CHECK_INTERVAL = 0.5
+    .send() queues the data; the connection's thread writes it out.
+    '''
 
     # BaseRequestHandler overrides
     def __init__(self, request, client_address, server):
@@ -242,7 +463,12 @@ class _TcpConnection(BaseRequestHandler, Transport):
         self.keepalive_msg = server.mux.keepalive_msg
         self.keepalive_interval = server.mux.keepalive_interval
         self.buffersize = server.mux.buffersize
-        self._keepalive_countdown = self.keepalive_interval
+        self._keepalive_due = 0.
+        self._waker = Waker()
+        self._outqueue = _WriteQueue()
+        self._outqueue.fill.set_watermarks(server.mux.send_high_watermark, server.mux.send_low_watermark)
+        self.send_backpressure = server.mux.send_backpressure
+        self._reading_paused = False
         BaseRequestHandler.__init__(self, request, client_address, server)
 
     @property
@@ -256,7 +482,9 @@ class _TcpConnection(BaseRequestHandler, Transport):
         for .start() to be called.
         '''
         self.name = '%s:%s'%self.client_address
-        L().info('TCP connect from %s'%self.name)
+        L.info('TCP connect from %s', self.name)
+        self.request.setblocking(False)
+        self._io_thread = current_thread()
 
         self.transport_running = Event()
         # add myself to the muxer, which will .start() me.
@@ -265,30 +493,60 @@ class _TcpConnection(BaseRequestHandler, Transport):
     def handle(self):
         # should be set almost-instantly; otherwise something is wrong.
         self.transport_running.wait(timeout=1.0)
-        leftover = b''
+        self._keepalive_reset()
+        buffer = ReceiveBuffer()
         while self.transport_running.is_set():
-            readable, _, _ = select([self.request], [],[], self._CHECK_INTERVAL)
-            if not readable:
+            timeout = _keepalive_timeout(self.keepalive_msg, self._keepalive_due)
+            rlist = [self._waker] if self._reading_paused else [self.request, self._waker]
+            wlist = [self.request] if self._outqueue else []
+            readable, writable, _ = select(rlist, wlist, [], timeout)
+            if self._waker in readable:
+                self._waker.drain()
+            if writable:
+                try:
+                    self._outqueue.flush(self.request)
+                except OSError:
+                    L.error('TcpServerTransport._TcpConnection: sending failed, see exc. info', exc_info=True)
+                    self._outqueue.clear()
+                    self.stop()
+                    break
+                self._keepalive_reset()
+            if self.request not in readable:
                 self._keepalive_tick()
                 continue
             try:
-                data = self.request.recv(self.buffersize)
+                nbytes = buffer.recv_into(self.request, self.buffersize)
+            except (BlockingIOError, InterruptedError):
+                continue
             except ConnectionError:
-                data = b''
-            self._keepalive_countdown = self.keepalive_interval
-            #data = data.replace(b'\r\n', b'\n')
-            if data == b'':
+                nbytes = 0
+            self._keepalive_reset()
+            if nbytes == 0:
                 # Connection was closed.
-                L().info('Connection to %s closed by remote side.'%(self.name,))
+                L.info('Connection to %s closed by remote side.', self.name)
+                self._outqueue.clear()
+                self.stop()
+                break
+            if L.isEnabledFor(logging.DEBUG):
+                L.debug('%d bytes from %s', nbytes, self.name)
+            try:
+                buffer.deliver(self, self.name)
+            except Exception:
+                L.error('TcpServerTransport: error while processing data from %s, closing connection', self.name, exc_info=True)
+                self._outqueue.clear()
                 self.stop()
                 break
-            L().debug('data from %s: %r'%(self.name, data))
-            leftover = self.received(sender=self.name, data=leftover+data)
 
     def finish(self):
-        L().debug('Closed TCP connection to %s'%self.name)
+        try:
+            if not self._outqueue.flush_blocking(self.request, _FLUSH_ON_CLOSE_TIMEOUT):
+                L.warning('Closing %s with %d bytes left unsent', self.name, len(self._outqueue))
+        except OSError:
+            L.warning('Sending remaining data to %s failed', self.name, exc_info=True)
+        L.debug('Closed TCP connection to %s', self.name)
         # Getting here implies that this transport already stopped.
         self.server.mux.remove_transport(self, stop=False)
+        self._waker.close()
 
     # Transport overrides
     def start(self):
@@ -300,25 +558,313 @@ class _TcpConnection(BaseRequestHandler, Transport):
 
     def stop(self):
         self.transport_running.clear()
+        self._waker.wake()
 
     def send(self, data, receivers=None):
         if receivers is not None and not self.name in receivers:
             return
         if not self.transport_running.is_set():
             raise IOError('Tried to send over non-running transport!')
-        self._keepalive_countdown = self.keepalive_interval
-        # FIXME: do something on failure
-        L().debug('_TcpConnection .send to %s: %r'%(self.name, data))
+        self._keepalive_reset()
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug('_TcpConnection .send to %s: %r', self.name, data)
+        promise = self._send_backpressure(self._outqueue.fill, self._io_thread)
+        if self._outqueue.put(data):
+            self._waker.wake()
+        return promise
+
+    @property
+    def send_buffered(self):
+        return len(self._outqueue)
+
+    def pause_reading(self):
+        self._reading_paused = True
+
+    def resume_reading(self):
+        self._reading_paused = False
+        self._waker.wake()
+
+    def _keepalive_reset(self):
+        self._keepalive_due = time.monotonic() + self.keepalive_interval
+
+    def _keepalive_tick(self):
+        if self.keepalive_msg and time.monotonic() >= self._keepalive_due:
+            L.debug('send keepalive')
+            self._outqueue.put(self.keepalive_msg)
+            self._keepalive_reset()
+
+
+class _SelectorConnection(object):
+    '''State of one client connection of the SelectorTcpServerTransport.'''
+    def __init__(self, sock, name):
+        self.socket = sock
+        self.name = name
+        self.inbuffer = ReceiveBuffer()
+        self.outqueue = _WriteQueue()
+        self.closing = False
+        self.keepalive_due = 0.
+
+
+class SelectorTcpServerTransport(Transport):
+    '''transport that accepts TCP connections and serves all of them from a single thread.
+
+    Drop-in alternative to :class:`TcpServerTransport`: sender/receiver names
+    are ``<host>:<port>`` of the client, use .close() for server-side
+    disconnect. Instead of one thread per connection, a single event loop
+    (``selectors.DefaultSelector``, i.e. epoll/kqueue where available)
+    handles accepting, reading, writing and keepalive of all connections.
+
+    :meth:`send` can be called from any thread. It only queues the data; the
+    event loop writes it out as soon as the socket accepts it.
+
+    Incoming data is passed on from the event loop thread, i.e. a slow message
+    handler delays all connections. Use ``async_processing`` of the
+    :class:`.RemoteAPI` if handlers take long.
+
+    The send watermarks apply to each connection's queue. The receive 
+    watermarks are not used, since received data is processed right away.
+
+    Keepalive and announcer options are the same as for :class:`TcpServerTransport`.
+
+    Threads:
+     - SelectorTcpServerTransport.run() blocks (use .start() for automatic extra Thread)
+     - no further threads are started.
+    '''
+    shorthand = 'tcpsel'
+    @classmethod
+    def fromstring(cls, expression):
+        '''tcpsel:<interface>:<port>
+
+        Leave <interface> empty to listen on all interfaces.
+        '''
+        _, iface, port = expression.split(':')
+        return cls(port=int(port), interface=iface)
+
+    def __init__(self, port, interface='', announcer=None, keepalive_msg=b'', keepalive_interval=10, buffersize=1024):
+        Transport.__init__(self)
+        self.addr = (interface, port)
+        self.name = '%s:%s'%self.addr
+        self.announcer = announcer
+        self.keepalive_msg = keepalive_msg
+        self.keepalive_interval = keepalive_interval
+        self.buffersize = buffersize
+        # name --> _SelectorConnection
+        self.connections = {}
+        # guards .connections and the write/close requests below.
+        self._lock = Lock()
+        # connections with new data in outbuf or pending close
+        self._dirty = set()
+        self._waker = None
+        self._selector = None
+        self._keepalive_heap = []
+        self._keepalive_seq = it.count()
+
+    def open(self):
+        self._selector = selectors.DefaultSelector()
+        self._waker = Waker()
+        self.server_socket = sk.socket(sk.AF_INET, sk.SOCK_STREAM)
         try:
-            self.request.sendall(data)
+            self.server_socket.bind(self.addr)
+            self.server_socket.listen(128)
+            self.server_socket.setblocking(False)
+            if self.announcer:
+                self.announcer.transport.start()
         except Exception:
-            L().error('TcpServerTransport._TcpConnection: sending failed, see exc. info', exc_info=True)
+            self.server_socket.close()
+            self._waker.close()
+            self._selector.close()
             raise
+        self.server_address = self.server_socket.getsockname()
+        self._selector.register(self.server_socket, selectors.EVENT_READ, None)
+        self._selector.register(self._waker, selectors.EVENT_READ, self._waker)
+        L.info('SelectorTcpServerTransport listening on %s:%s', *self.server_address)
 
-    def _keepalive_tick(self):
-        if self.keepalive_msg:
-            self._keepalive_countdown -= self._CHECK_INTERVAL
-            if self._keepalive_countdown <= 0:
-                L().debug('send keepalive')
-                self.request.sendall(self.keepalive_msg)
-                self._keepalive_countdown = self.keepalive_interval
+    def run(self):
+        self.running = True
+        while self.running:
+            for key, events in self._selector.select(self._select_timeout()):
+                conn = key.data
+                if conn is None:
+                    self._accept()
+                elif conn is self._waker:
+                    self._waker.drain()
+                else:
+                    if events & selectors.EVENT_READ:
+                        self._read(conn)
+                    if events & selectors.EVENT_WRITE and conn.name in self.connections:
+                        self._write(conn)
+            self._process_dirty()
+            if self.keepalive_msg:
+                self._keepalive_check()
+
+        for conn in list(self.connections.values()):
+            self._close(conn, flush=True)
+        self._selector.unregister(self.server_socket)
+        self._selector.unregister(self._waker)
+        self.server_socket.close()
+        self._selector.close()
+        self._waker.close()
+        if self.announcer:
+            self.announcer.transport.stop()
+        L.debug('SelectorTcpServerTransport has finished')
+
+    def stop(self, block=True):
+        self.running = False
+        if self._waker:
+            self._waker.wake()
+        Transport.stop(self, block=block)
+
+    def send(self, data, receivers=None):
+        with self._lock:
+            if receivers is None:
+                targets = list(self.connections.values())
+            else:
+                targets = [self.connections[r] for r in receivers if r in self.connections]
+        promises = []
+        for conn in targets:
+            promise = self._send_backpressure(conn.outqueue.fill, self._thread)
+            if promise is not None:
+                promises.append(promise)
+        with self._lock:
+            wake = False
+            for conn in targets:
+                if L.isEnabledFor(logging.DEBUG):
+                    L.debug('SelectorTcpServerTransport .send to %s: %r', conn.name, data)
+                if conn.outqueue.put(data):
+                    # otherwise, the loop already knows that conn wants to write.
+                    self._dirty.add(conn)
+                    wake = True
+        if wake:
+            self._waker.wake()
+        if promises:
+            return _all_fulfilled(promises)
+
+    @property
+    def send_buffered(self):
+        return sum(len(conn.outqueue) for conn in list(self.connections.values()))
+
+    def close(self, name):
+        '''close the connection with the given sender/receiver name.
+
+        Data that was sent before is still written out.
+        '''
+        with self._lock:
+            conn = self.connections.get(name)
+            if conn is None:
+                return
+            conn.closing = True
+            self._dirty.add(conn)
+        self._waker.wake()
+
+    # ---- event loop internals, only called on the loop thread ----
+
+    def _select_timeout(self):
+        if not (self.keepalive_msg and self._keepalive_heap):
+            return None
+        return max(0., self._keepalive_heap[0][0] - time.monotonic())
+
+    def _accept(self):
+        while True:
+            try:
+                sock, client_address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                L.error('SelectorTcpServerTransport: accept failed', exc_info=True)
+                return
+            sock.setblocking(False)
+            conn = _SelectorConnection(sock, '%s:%s'%client_address[:2])
+            conn.outqueue.fill.set_watermarks(self.send_high_watermark, self.send_low_watermark)
+            L.info('TCP connect from %s', conn.name)
+            with self._lock:
+                self.connections[conn.name] = conn
+            self._selector.register(sock, selectors.EVENT_READ, conn)
+            self._touch(conn)
+
+    def _read(self, conn):
+        try:
+            nbytes = conn.inbuffer.recv_into(conn.socket, self.buffersize)
+        except (BlockingIOError, InterruptedError):
+            return
+        except ConnectionError:
+            nbytes = 0
+        if nbytes == 0:
+            L.info('Connection to %s closed by remote side.', conn.name)
+            self._close(conn)
+            return
+        self._touch(conn)
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug('%d bytes from %s', nbytes, conn.name)
+        try:
+            conn.inbuffer.deliver(self, conn.name)
+        except Exception:
+            L.error('SelectorTcpServerTransport: error while processing data from %s, closing connection', conn.name, exc_info=True)
+            self._close(conn)
+
+    def _write(self, conn):
+        try:
+            conn.outqueue.flush(conn.socket)
+        except OSError:
+            L.error('SelectorTcpServerTransport: sending to %s failed, see exc. info', conn.name, exc_info=True)
+            conn.outqueue.clear()
+            self._close(conn)
+            return
+        self._touch(conn)
+        self._update_interest(conn)
+
+    def _process_dirty(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        for conn in dirty:
+            if conn.name in self.connections:
+                self._update_interest(conn)
+
+    def _update_interest(self, conn):
+        if conn.outqueue:
+            self._selector.modify(conn.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+        elif conn.closing:
+            self._close(conn)
+        else:
+            self._selector.modify(conn.socket, selectors.EVENT_READ, conn)
+
+    def _close(self, conn, flush=False):
+        with self._lock:
+            if self.connections.get(conn.name) is not conn:
+                return
+            del self.connections[conn.name]
+            self._dirty.discard(conn)
+        self._selector.unregister(conn.socket)
+        if flush:
+            try:
+                if not conn.outqueue.flush_blocking(conn.socket, _FLUSH_ON_CLOSE_TIMEOUT):
+                    L.warning('Closing %s with %d bytes left unsent', conn.name, len(conn.outqueue))
+            except OSError:
+                L.warning('Sending remaining data to %s failed', conn.name, exc_info=True)
+        conn.socket.close()
+        L.debug('Closed TCP connection to %s', conn.name)
+
+    def _touch(self, conn):
+        '''reset keepalive timer of the connection.'''
+        if not self.keepalive_msg:
+            return
+        due = time.monotonic() + self.keepalive_interval
+        if not conn.keepalive_due:
+            heapq.heappush(self._keepalive_heap, (due, next(self._keepalive_seq), conn))
+        conn.keepalive_due = due
+
+    def _keepalive_check(self):
+        now = time.monotonic()
+        heap = self._keepalive_heap
+        while heap and heap[0][0] <= now:
+            due, _, conn = heapq.heappop(heap)
+            if conn.name not in self.connections or self.connections[conn.name] is not conn:
+                continue
+            if conn.keepalive_due > due:
+                # activity since the entry was made; requeue with the current due time.
+                heapq.heappush(heap, (conn.keepalive_due, next(self._keepalive_seq), conn))
+                continue
+            L.debug('send keepalive to %s', conn.name)
+            conn.outqueue.put(self.keepalive_msg)
+            conn.keepalive_due = 0.
+            self._update_interest(conn)
+            self._touch(conn)
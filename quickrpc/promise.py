@@ -5,21 +5,46 @@ for something that is still being produced.
 
 This is just a barebone implementation, with method names aligned with
 :class:`concurrent.Future` from the standard lib.
+
+:func:`gather`, :func:`first` and :func:`as_completed` wait for many promises
+at once.
+
+:func:`to_future` and :func:`to_asyncio_future` convert a Promise into a
+:class:`concurrent.futures.Future` resp. :class:`asyncio.Future`, without
+blocking a thread; :func:`from_future` does the opposite. Promises can be
+awaited directly.
 '''
 
+import asyncio
+import concurrent.futures
 import logging
+import time
 from enum import Enum
-from threading import Event, current_thread
+from queue import SimpleQueue, Empty
+from threading import Event, Lock, current_thread
 
-L = lambda: logging.getLogger(__name__)
+L = logging.getLogger(__name__)
 
-__all__ = ['Promise', 'PromiseError', 'PromiseTimeoutError', 'PromiseDoneError', 'PromiseDeadlockError']
+__all__ = [
+    'Promise',
+    'PromiseError',
+    'PromiseTimeoutError',
+    'PromiseDoneError',
+    'PromiseDeadlockError',
+    'PromiseCancelledError',
+    'gather',
+    'first',
+    'as_completed',
+    'to_future',
+    'to_asyncio_future',
+    'from_future',
+]
 
 class PromiseState(Enum):
     pending = 0
     fulfilled = 1
     failed = 2
-    
+
 class PromiseError(Exception):
     '''promise-related error'''
 class PromiseTimeoutError(PromiseError, TimeoutError):
@@ -28,78 +53,101 @@ class PromiseDoneError(PromiseError, RuntimeError):
     '''raised to the promise issuer if a result or exception was already set.'''
 class PromiseDeadlockError(PromiseError, RuntimeError):
     '''raised if the result-setter thread tries to wait for the result (i.e. itself).'''
+class PromiseCancelledError(PromiseError):
+    '''the operation was cancelled; set as exception by the promise issuer.'''
+
+# Guards state changes of all promises. Held only briefly, never while
+# calling callbacks.
+_lock = Lock()
+
+# setter_thread of promises that are set by a thread not known in advance,
+# e.g. a worker of an executor. Disables the deadlock check.
+_UNKNOWN_SETTER = object()
 
 class Promise(object):
     '''Encapsulates a result that will arrive later.
 
     A Promise (also known as a Deferred or a Future) is like an order slip
     for something that is still being produced.
-    
+
     Promises are dispensed by asynchronous functions. Calling .result()
     waits until the operation is complete, then returns the result.
 
-    You can also use .then(callback) to have the promise call you with the result.
+    You can also use .then(callback) to have the promise call you with the
+    result. ``then`` can be used several times and returns a new promise,
+    so that calls can be chained.
 
     The constructor takes an argument ``setter_thread``, which should be the
     thread that will set the result later. If not given, the current thread
     is assumed (which will usually be the case). The ``setter_thread`` is
     used to provide basic deadlock protection.
     '''
-    
+    __slots__ = ('_state', '_result', '_setter_thread', '_callbacks', '_evt')
+
     def __init__(self, setter_thread=None):
         self._state = PromiseState.pending
-        self._evt = Event()
         self._result = None
         self._setter_thread = setter_thread or current_thread()
-        self._callback = lambda result: None
-        self._errback = lambda error: None
-        
+        # (callback, errback, derived promise), None if there are none.
+        self._callbacks = None
+        # only created when somebody waits.
+        self._evt = None
+
     def set_result(self, val):
         '''called by the promise issuer to set the result.'''
         self._set(PromiseState.fulfilled, val)
-        try:
-            self._callback(val)
-        except Exception as e:
-            L().error('Promise callback raised an exception', exc_info=True)
-    
+
     def set_exception(self, exception):
         '''called by the promise issuer to indicate failure.'''
         if not isinstance(exception, BaseException):
             # shrinkwrap whatever it is
             exception = Exception(repr(exception))
         self._set(PromiseState.failed, exception)
-        try:
-            self._errback(exception)
-        except Exception as e:
-            L().error('Promise errback raised an exception', exc_info=True)
-        
+
     def _set(self, state, result):
-        if self._evt.is_set():
-            raise PromiseDoneError()
-        self._state = state
-        self._result = result
-        self._evt.set()
-    
+        with _lock:
+            if self._state is not PromiseState.pending:
+                raise PromiseDoneError()
+            self._state = state
+            self._result = result
+            evt, callbacks = self._evt, self._callbacks
+            self._callbacks = None
+        if evt is not None:
+            evt.set()
+        if callbacks:
+            for callback, errback, derived in callbacks:
+                self._run_callback(callback, errback, derived)
+
+    def done(self):
+        '''True if the result or exception was set.'''
+        return self._state is not PromiseState.pending
+
     def result(self, timeout=1.0):
         '''Return the result, waiting for it if necessary.
-        
+
         If the promise failed, this will raise the exception that the issuer gave.
-        
+
         If the promise is still unfulfilled after the `timeout` (in seconds) elapsed,
         PromiseTimeoutError is raised.
 
         If the promise is unfulfilled and the calling thread is the designated
         promise-setter thread, PromiseDeadlockError is raised immediately.
         '''
-        L().debug('Promise.result: current_Thread is %r and setter_thread is %r'%(current_thread(), self._setter_thread))
-        if not self._evt.is_set() and current_thread() is self._setter_thread:
-            raise PromiseDeadlockError('The thread would wait for itself')
-        if not self._evt.wait(timeout):
-            raise PromiseTimeoutError()
-            
-        if self._state == PromiseState.fulfilled:
-            return self._result 
-        elif self._state == PromiseState.failed:
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug('Promise.result: current_Thread is %r and setter_thread is %r', current_thread(), self._setter_thread)
+        if self._state is PromiseState.pending:
+            if current_thread() is self._setter_thread:
+                raise PromiseDeadlockError('The thread would wait for itself')
+            with _lock:
+                if self._state is PromiseState.pending and self._evt is None:
+                    self._evt = Event()
+                evt = self._evt
+            if evt is not None and not evt.wait(timeout):
+                raise PromiseTimeoutError()
+
+        if self._state is PromiseState.fulfilled:
+            return self._result
+        elif self._state is PromiseState.failed:
             raise self._result
         else:
             assert False, 'unexpected Promise state'
@@ -108,20 +156,211 @@ class Promise(object):
         '''set handler to run as soon as the result is set.
 
         callback takes the result as single argument.
-        
+
         You can also set an errback that is called in case of an exception.
         If not set, the exception will be passed to callback as result.
 
         If the result already arrived, callback or errback is called immediately.
+        Otherwise, it is called on the thread setting the result. Several
+        handlers can be added; they are called in order.
+
+        Returns a new Promise for the return value of the handler. If the
+        handler raises, the new promise fails with that exception. If it
+        returns a Promise, the new promise follows that one.
         '''
-        self._callback = callback
-        self._errback = errback or callback
+        derived = Promise(setter_thread=self._setter_thread)
+        self._add_callback(callback, errback or callback, derived)
+        return derived
 
-        if self._state == PromiseState.fulfilled:
-            self._callback(self._result)
-        elif self._state == PromiseState.failed:
-            self._errback(self._result)
+    def _add_callback(self, callback, errback, derived=None):
+        '''adds handlers; None passes the result resp. exception on to derived.'''
+        with _lock:
+            if self._state is PromiseState.pending:
+                if self._callbacks is None:
+                    self._callbacks = []
+                self._callbacks.append((callback, errback, derived))
+                return
+        self._run_callback(callback, errback, derived)
 
+    def _run_callback(self, callback, errback, derived):
+        fulfilled = self._state is PromiseState.fulfilled
+        handler = callback if fulfilled else errback
+        if handler is None:
+            if derived is not None:
+                derived._set(self._state, self._result)
+            return
+        try:
+            value = handler(self._result)
+        except Exception as e:
+            L.error('Promise %s raised an exception', 'callback' if fulfilled else 'errback', exc_info=True)
+            if derived is not None:
+                derived.set_exception(e)
+            return
+        if derived is None:
+            return
+        if isinstance(value, Promise):
+            value._add_callback(None, None, derived)
+        else:
+            derived.set_result(value)
 
     __call__ = result
 
+    def __await__(self):
+        '''``await promise`` in a coroutine; see :func:`to_asyncio_future`.'''
+        return to_asyncio_future(self).__await__()
+
+
+def _common_setter(promises):
+    # promises usually come from the same transport.
+    return promises[0]._setter_thread if promises else None
+
+def _settle(promise, state, value):
+    '''sets the promise unless it is done already.'''
+    try:
+        promise._set(state, value)
+    except PromiseDoneError:
+        pass
+
+
+def gather(promises):
+    '''Returns a Promise for the list of results of all promises, in order.
+
+    It fails as soon as one of the promises fails, with the same exception.
+    The waiting thread is woken up only once, when everything is there:
+
+    >>> results = gather(promises).result(timeout=10)
+    '''
+    promises = list(promises)
+    combined = Promise(setter_thread=_common_setter(promises))
+    results = [None] * len(promises)
+    remaining = [len(promises)]
+    if not promises:
+        combined.set_result(results)
+        return combined
+    def fulfilled(idx):
+        def callback(value):
+            results[idx] = value
+            with _lock:
+                remaining[0] -= 1
+                complete = not remaining[0]
+            if complete:
+                _settle(combined, PromiseState.fulfilled, results)
+        return callback
+    failed = lambda error: _settle(combined, PromiseState.failed, error)
+    for idx, promise in enumerate(promises):
+        promise._add_callback(fulfilled(idx), failed)
+    return combined
+
+
+def first(promises):
+    '''Returns a Promise for the first result of any of the promises.
+
+    Failed promises are skipped; if all of them fail, it fails with the last
+    exception. (Like ``Promise.any`` in JavaScript.)
+    '''
+    promises = list(promises)
+    combined = Promise(setter_thread=_common_setter(promises))
+    if not promises:
+        combined.set_exception(PromiseError('No promises given'))
+        return combined
+    remaining = [len(promises)]
+    fulfilled = lambda value: _settle(combined, PromiseState.fulfilled, value)
+    def failed(error):
+        with _lock:
+            remaining[0] -= 1
+            complete = not remaining[0]
+        if complete:
+            _settle(combined, PromiseState.failed, error)
+    for promise in promises:
+        promise._add_callback(fulfilled, failed)
+    return combined
+
+
+def as_completed(promises, timeout=None):
+    '''Generator yielding the promises in the order in which they complete.
+
+    Raises PromiseTimeoutError if not all of them completed within timeout
+    seconds (None = wait forever), and PromiseDeadlockError if the calling
+    thread would have to wait for a promise that it is supposed to set itself.
+
+    >>> for promise in as_completed(promises, timeout=10):
+    ...     print(promise.result())
+    '''
+    promises = list(promises)
+    completed = SimpleQueue()
+    for promise in promises:
+        put = lambda value, promise=promise: completed.put(promise)
+        promise._add_callback(put, put)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    thread = current_thread()
+    for _ in promises:
+        if completed.empty():
+            for promise in promises:
+                if promise._setter_thread is thread and not promise.done():
+                    raise PromiseDeadlockError('The thread would wait for itself')
+        try:
+            yield completed.get(timeout=None if deadline is None else max(0., deadline - time.monotonic()))
+        except Empty:
+            raise PromiseTimeoutError()
+
+
+def to_future(promise):
+    '''Returns a :class:`concurrent.futures.Future` following the promise.
+
+    The future is set from the promise callback, so no thread is spent on
+    waiting. It can be used with ``concurrent.futures.wait`` and friends.
+    '''
+    future = concurrent.futures.Future()
+    future.set_running_or_notify_cancel()
+    promise._add_callback(future.set_result, future.set_exception)
+    return future
+
+
+def to_asyncio_future(promise, loop=None):
+    '''Returns an :class:`asyncio.Future` following the promise.
+
+    The result is handed over to ``loop`` (default: the running loop) using
+    ``call_soon_threadsafe``. Cancelling the future does not affect the
+    promise. Use e.g. ``asyncio.gather`` to await many replies at once.
+    '''
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    def callback(value):
+        loop.call_soon_threadsafe(_set_asyncio_future, future.set_result, value)
+    def errback(error):
+        loop.call_soon_threadsafe(_set_asyncio_future, future.set_exception, error)
+    promise._add_callback(callback, errback)
+    return future
+
+
+def _set_asyncio_future(setter, value):
+    '''set result / exception of an asyncio future, unless it was cancelled meanwhile.
+
+    Call it in the loop's thread, e.g. via ``call_soon_threadsafe``.
+    '''
+    if not setter.__self__.done():
+        setter(value)
+
+
+def from_future(future):
+    '''Returns a :class:`Promise` following a concurrent or asyncio Future.
+
+    A cancelled future fails the promise with :class:`PromiseCancelledError`.
+
+    An asyncio Future is set in the thread of its event loop; it is assumed
+    that this is the calling thread. (Do not wait for the promise there.)
+    '''
+    if isinstance(future, concurrent.futures.Future):
+        promise = Promise(setter_thread=_UNKNOWN_SETTER)
+    else:
+        promise = Promise()
+    def done(future):
+        if future.cancelled():
+            promise.set_exception(PromiseCancelledError('future was cancelled'))
+        elif future.exception() is not None:
+            promise.set_exception(future.exception())
+        else:
+            promise.set_result(future.result())
+    future.add_done_callback(done)
+    return promise
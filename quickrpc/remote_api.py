@@ -44,30 +44,46 @@ On the ``outgoing`` side, the call immediately returns a
 :class:`~.Promise` object.
 You then use :meth:`~.Promise.result` to get at the actual 
 result. This will block
-until the result arrived.
+until the result arrived. In a coroutine, the Promise can be awaited instead
+(see :func:`~.promise.to_asyncio_future`).
 
 (TODO: make blocking call by default, add block=False param for Promises)
 
+With ``use_asyncio=True``, outgoing calls with reply return an
+:class:`asyncio.Future` instead, and incoming handlers can be coroutines. See
+:class:`RemoteAPI` and :mod:`.asyncio_transports`.
+
 '''
+import asyncio
+import collections
+import heapq
 import logging
-from .promise import Promise
-from .action_queue import ActionQueue
+import threading
+import time
+from .promise import Promise, PromiseTimeoutError, PromiseCancelledError, _set_asyncio_future
+from .action_queue import ActionQueue, KeyedActionQueue
 import itertools as it
 import inspect
 from functools import wraps
 from .codecs import Codec, Message, Reply, ErrorReply
-from .transports import Transport
+from .transports import Transport, accepts_buffer, _Buffer
 from .security import Security
 
-L = lambda: logging.getLogger(__name__)
+L = logging.getLogger(__name__)
 
 __all__ = [
     'RemoteAPI',
+    'TooManyPendingCalls',
     'incoming',
     'outgoing',
 ]
 
 
+class TooManyPendingCalls(RuntimeError):
+    '''raised by an outgoing call if too many calls await their reply.'''
+
+
+
 class RemoteAPI(object):
     '''Describes an API i.e. a set of allowed outgoing and incoming calls.
     
@@ -83,7 +99,9 @@ class RemoteAPI(object):
     
     Methods marked as ``@outgoing`` are automatically turned into
     messages when called. The method body is executed before sending. (use e.g.
-    for validation of outgoing data).
+    for validation of outgoing data). Set :attr:`validate_outgoing` to False 
+    (on the class or the instance) to skip the body; then only the argument
+    names are checked against the signature.
     They must accept a special `receivers` argument, which is passed to the
     Transport.
     
@@ -113,15 +131,70 @@ class RemoteAPI(object):
           which handles Transport receive events. I.e. the Transport
           implementation defines the behaviour.
         * If async_processing = True, an extra Thread is used to handle messages.
+        * If async_processing = n (an int > 1), a pool of n worker threads is
+          used. Messages of the same sender are handled in order, one at a 
+          time; messages of different senders are handled in parallel.
+          ``@incoming(key=...)`` methods are ordered by their key instead of
+          the sender.
 
     The latter allows the receive handler to run concurrently to message
     handling, allowing further requests to be sent out and to await the result.
-    However it means one extra thread. In any case, only one incoming message
-    is handled at a time.
+    However it means extra thread(s). Without a worker pool, only one incoming 
+    message is handled at a time. :meth:`processing_stats` tells the queue 
+    depth and worker utilization.
     
     Recommendation is to set ``async_processing=True`` if there are any outgoing
     calls that have a reply, ``False`` if not.
 
+    Asyncio:
+
+    With ``use_asyncio=True``, the API is meant to be used from within an 
+    asyncio event loop, usually together with a transport from 
+    :mod:`.asyncio_transports`. Then:
+
+        * ``@outgoing(has_reply=True)`` calls return an :class:`asyncio.Future` 
+          that can be awaited, instead of a :class:`.Promise`.
+        * connected ``@incoming`` handlers can be coroutine functions. They are 
+          scheduled as tasks on the event loop; if the call has a reply, it is 
+          sent when the coroutine finishes.
+        * ``async_processing`` should be left off, since handlers should not block
+          the loop anyway.
+
+    Tracing:
+
+    Set :attr:`.trace` to a callable ``trace(direction, peer, message)`` to 
+    see every message. ``direction`` is ``'in'`` or ``'out'``; ``peer`` is the
+    sender resp. the receivers. ``message`` is a :class:`.Message`, 
+    :class:`.Reply` or :class:`.ErrorReply` (or the decoding exception). It is
+    called on the thread that receives resp. sends. If ``trace`` is None 
+    (default), nothing is traced at no cost.
+
+    Pending replies:
+
+    Calls with reply stay pending until the reply arrives. Set 
+    :attr:`reply_timeout` (seconds) to give up after that time; the Promise then
+    fails with :class:`.PromiseTimeoutError` (an asyncio Future with 
+    :class:`asyncio.TimeoutError`). To use a different timeout for some calls,
+    issue them within ``with api.timeout(seconds):``. :meth:`cancel` gives up
+    a single call. At most :attr:`max_pending_replies` calls can be pending; 
+    further calls raise :class:`TooManyPendingCalls`.
+
+    Flow control:
+
+    :attr:`max_in_flight` limits the number of calls with reply that were sent
+    and await their reply; :attr:`max_in_flight_per_receiver` does the same per
+    receiver (broadcast calls count for receiver None). Both are off (None) by 
+    default. If a call exceeds a limit, :attr:`in_flight_policy` decides:
+
+        * ``'block'``: wait until replies (or timeouts, cancellations) make room.
+          Not possible on the thread receiving the replies; there, 
+          :class:`TooManyPendingCalls` is raised.
+        * ``'queue'``: return the Promise immediately; the call is sent as 
+          soon as there is room, in order of issue.
+        * ``'raise'``: raise :class:`TooManyPendingCalls`.
+
+    Calls within a :meth:`batch` are counted, but never held back.
+
     Inverting:
 
     You can :meth:`.invert` the whole api,
@@ -130,7 +203,18 @@ class RemoteAPI(object):
     upon initialization by giving ``invert=True`` kwarg.
     
     '''
-    def __init__(self, codec='jrpc', transport=None, security='null', invert=False, async_processing=False):
+    # execute the body of @outgoing methods before sending.
+    validate_outgoing = True
+    # default timeout for replies in seconds; None = wait forever
+    reply_timeout = None
+    # hard limit for the number of calls awaiting their reply
+    max_pending_replies = 10000
+    # flow control of calls with reply, see class docs
+    max_in_flight = None
+    max_in_flight_per_receiver = None
+    in_flight_policy = 'block'
+
+    def __init__(self, codec='jrpc', transport=None, security='null', invert=False, async_processing=False, use_asyncio=False):
         if isinstance(codec, str):
             codec = Codec.fromstring(codec)
         if isinstance(transport, str):
@@ -140,19 +224,41 @@ class RemoteAPI(object):
         self.codec = codec
         self.transport = transport
         self.security = security
-        # FIXME: limit size of _pending_replies somehow
-        self._pending_replies = {}
+        self.use_asyncio = use_asyncio
+        self.trace = None
+        # .batch: per-thread batch of outgoing calls
+        self._local = threading.local()
+        self._pending_replies = _PendingReplies(self._expire_call)
+        self._window = _CallWindow()
         self._id_dispenser = it.count()
         # pull the 0
         next(self._id_dispenser)
-        if invert:
-            self.invert()
         # just use the presence of _action_queue as flag.
-        if async_processing:
+        if async_processing is True or async_processing == 1:
             self._action_queue = ActionQueue()
+        elif async_processing:
+            self._action_queue = KeyedActionQueue(workers=async_processing)
         else:
             self._action_queue = None
+        if invert:
+            self.invert()
+        else:
+            self._build_dispatch()
         
+    @property
+    def codec(self):
+        '''Gets/sets the codec used to (de)serialize messages.
+
+        The codec's :meth:`~.Codec.bind_api` is called upon assignment.'''
+        return self._codec
+    @codec.setter
+    def codec(self, value):
+        self._codec = value
+        # method name -> encode function, see Codec.call_encoder
+        self._call_encoders = {}
+        if self._codec:
+            self._codec.bind_api(self)
+
     @property
     def transport(self):
         '''Gets/sets the transport used to send and receive messages.
@@ -181,14 +287,42 @@ class RemoteAPI(object):
                 # The decorators add a "method" .inverted() to the field,
                 # which will yield the inverse-decorated field.
                 setattr(self, attr, field.inverted().__get__(self))
+        self._build_dispatch()
+
+    def _build_dispatch(self):
+        '''Collects the ``@incoming`` methods of this instance.
+
+        The table maps the method name to ``(bound method, has_reply, key)``.
+        '''
+        dispatch = {}
+        for attr in dir(self):
+            if attr.startswith('__'):
+                continue
+            field = getattr(self, attr, None)
+            info = getattr(field, '_remote_api_incoming', None)
+            if info is not None:
+                dispatch[attr] = (field, info['has_reply'], info['key'])
+        self._dispatch = dispatch
         
 
     # ---- handling of incoming messages ----
 
+    @accepts_buffer
     def _handle_received(self, sender, data):
         '''called by the Transport when data comes in.'''
-        messages, remainder = self.codec.decode(data, sec_in=self.security.sec_in)
+        # The decoder state is kept on the transport's receive buffer, so
+        # that it is dropped together with the connection.
+        source = data.obj if isinstance(data, memoryview) else None
+        decoder = getattr(source, 'decoder', None)
+        if decoder is None or decoder.codec is not self.codec:
+            decoder = self.codec.decoder()
+        messages, consumed = decoder.decode_buffer(data, sec_in=self.security.sec_in)
+        if isinstance(source, _Buffer) and decoder is not self.codec:
+            source.decoder = decoder if consumed < len(data) else None
+        trace = self.trace
         for message in messages:
+            if trace is not None:
+                trace('in', sender, message)
             if isinstance(message, Exception):
                 self.message_error(sender, message)
                 continue
@@ -196,43 +330,77 @@ class RemoteAPI(object):
                 self._deliver_reply(message)
             else:
                 self._handle_method(sender, message)
-        return remainder
+        return consumed
 
     def _handle_method(self, sender, message):
         try:
-            method = getattr(self, message.method)
-        except AttributeError:
-            self.message_error(sender, AttributeError("Incoming call of %s not defined on the api"%message.method), message)
-            return
-        if not hasattr(method, "_remote_api_incoming"):
-            self.message_error(sender, AttributeError("Incoming call of %s not marked as @incoming on the api"%message.method), message)
+            method, has_reply, key = self._dispatch[message.method]
+        except KeyError:
+            if hasattr(self, message.method):
+                self.message_error(sender, AttributeError("Incoming call of %s not marked as @incoming on the api"%message.method), message)
+            else:
+                self.message_error(sender, AttributeError("Incoming call of %s not defined on the api"%message.method), message)
             return
 
         def action():
-            has_reply = method._remote_api_incoming['has_reply']
             try:
                 result = method(sender, message)
             except Exception as e:
-                if has_reply: 
-                    L().debug('Exception in message handler, returning as result: '+str(e), exc_info=True)
-                    self.message_error(sender, e, message)
-                else:
-                    # Complain and continue, since the user cannot install sensible handling above from here.
-                    L().error('Exception in message handler caught: '+str(e), exc_info = True)
+                self._handler_failed(sender, message, has_reply, e)
             else:
-                if has_reply:
-                    try:
-                        data = self.codec.encode_reply(message, result, sec_out=self.security.sec_out)
-                        self.transport.send(data, receivers=[sender])
-                    except Exception as e:
-                        L().error('Exception in message handler while sending response: '+str(e), exc_info=True)
+                if inspect.isawaitable(result):
+                    if not self.use_asyncio:
+                        if inspect.iscoroutine(result):
+                            result.close()
+                        self._handler_failed(sender, message, has_reply, TypeError(
+                            'Handler of %s returned an awaitable, but the api does not use asyncio'%message.method))
+                        return
+                    asyncio.ensure_future(self._finish_async(sender, message, has_reply, result))
+                elif has_reply:
+                    self._send_reply(sender, message, result)
         if self._action_queue:
+            if key is not None:
+                try:
+                    key = key(sender, message)
+                    hash(key)
+                except Exception as e:
+                    self._handler_failed(sender, message, has_reply, e)
+                    return
+            else:
+                key = sender
             # message processed in extra thread, we return instantly after .put
-            self._action_queue.put(action)
+            self._action_queue.put(action, key=key)
         else:
             # message processed in this thread, return when done.
             action()
 
+    def _handler_failed(self, sender, message, has_reply, e):
+        if has_reply: 
+            L.debug('Exception in message handler, returning as result: %s', e, exc_info=True)
+            self.message_error(sender, e, message)
+        else:
+            # Complain and continue, since the user cannot install sensible handling above from here.
+            L.error('Exception in message handler caught: %s', e, exc_info=True)
+
+    def _send_reply(self, sender, message, result):
+        try:
+            if self.trace is not None:
+                self.trace('out', [sender], Reply(result, message.id))
+            data = self.codec.encode_reply(message, result, sec_out=self.security.sec_out)
+            self.transport.send(data, receivers=[sender])
+        except Exception as e:
+            L.error('Exception in message handler while sending response: %s', e, exc_info=True)
+
+    async def _finish_async(self, sender, message, has_reply, awaitable):
+        '''await the result of coroutine handler(s), then send the reply.'''
+        try:
+            result = await awaitable
+        except Exception as e:
+            self._handler_failed(sender, message, has_reply, e)
+        else:
+            if has_reply:
+                self._send_reply(sender, message, result)
+
     def message_error(self, sender, exception, in_reply_to=None):
         '''Called each time that an incoming message causes problems.
         
@@ -240,37 +408,197 @@ class RemoteAPI(object):
         triggered the error, None if decoding failed. If the requested method can be 
         identified and has a reply, an error reply is returned to the sender.
         '''
-        L().warning(exception)
-        if in_reply_to.id:
+        L.warning(exception)
+        if in_reply_to is not None and in_reply_to.id:
+            if self.trace is not None:
+                self.trace('out', [sender], ErrorReply(exception, in_reply_to.id))
             data = self.codec.encode_error(in_reply_to, exception, errorcode=0, sec_out=self.security.sec_out)
             self.transport.send(data, receivers=[sender])
 
     def _deliver_reply(self, reply):
         id = reply.id
-        try:
-            promise = self._pending_replies.pop(id)
-        except KeyError:
+        promise = self._pending_replies.pop(id)
+        # free the window slot in any case, e.g. for a call that timed out
+        self._release_call(id)
+        if promise is None:
             # do not raise, since it cannot be caught by user.
-            L().warning('Received reply that was never requested: %r'%(reply,))
+            L.warning('Received reply that was never requested (or timed out): %r', reply)
             return
 
         #FIXME: secinfo is discarded
         if isinstance(reply, Reply):
-            promise.set_result(reply.result)
+            _resolve(promise, 'set_result', reply.result)
         else:
             # Put the ErrorReply in the result queue.
-            promise.set_exception(reply.exception)
+            _resolve(promise, 'set_exception', reply.exception)
 
     # ---- handling of outgoing messages ----
 
+    def batch(self):
+        '''Context manager collecting outgoing calls, to send them as batch.
+
+        >>> with api.batch():
+        ...     p1 = api.foo(receivers, a=1)
+        ...     p2 = api.bar(receivers, b=2)
+
+        Outgoing calls made on the current thread within the ``with`` block 
+        are not sent immediately; they return as usual (incl. Promises). Upon 
+        leaving the block, consecutive calls with the same receivers are 
+        encoded using :meth:`.Codec.encode_batch` and sent together, i.e. in 
+        one frame for :class:`.JsonRpcCodec`. Calls are sent in the order in 
+        which they were made, so alternating receivers give more, smaller 
+        batches. If the block is left with an exception, nothing is sent.
+
+        Nested blocks join the outermost batch.
+        '''
+        return _Batch(self)
+
+    def _send_call(self, method, kwargs, call_id, receivers):
+        if self.trace is not None:
+            self.trace('out', receivers, Message(method, kwargs, call_id))
+        batch = getattr(self._local, 'batch', None)
+        if batch is not None:
+            if call_id and self._limits_in_flight():
+                self._window.take(call_id, _window_keys(receivers))
+            batch.calls.append((receivers, method, kwargs, call_id))
+            return
+        if call_id and self._limits_in_flight():
+            if not self._acquire_window(call_id, receivers, lambda: self._send_queued(method, kwargs, call_id, receivers)):
+                return
+        self._transmit(method, kwargs, call_id, receivers)
+
+    def _transmit(self, method, kwargs, call_id, receivers):
+        try:
+            encode = self._call_encoders[method]
+        except KeyError:
+            encode = self._call_encoders[method] = self.codec.call_encoder(method)
+        data = encode(kwargs, id=call_id, sec_out=self.security.sec_out)
+        self.transport.send(data, receivers=receivers)
+
+    def timeout(self, seconds):
+        '''Context manager setting the reply timeout of calls issued in the block.
+
+        >>> with api.timeout(2.0):
+        ...     promise = api.get_value(receivers)
+
+        Applies to calls made on the current thread. None means no timeout.
+        '''
+        return _Timeout(self, seconds)
+
+    def cancel(self, promise):
+        '''Gives up waiting for the reply of the call that returned promise.
+
+        The promise fails with :class:`.PromiseCancelledError` (an asyncio 
+        Future is cancelled). A reply arriving later is dropped. Returns False if 
+        the call was not pending anymore.
+        '''
+        call_id = self._pending_replies.discard(promise)
+        if call_id is None:
+            return False
+        self._release_call(call_id)
+        if isinstance(promise, asyncio.Future):
+            promise.get_loop().call_soon_threadsafe(promise.cancel)
+        else:
+            promise.set_exception(PromiseCancelledError('call was cancelled'))
+        return True
+
     def _new_request(self):
+        if len(self._pending_replies) >= self.max_pending_replies:
+            raise TooManyPendingCalls('%d calls are awaiting their reply'%len(self._pending_replies))
         call_id = next(self._id_dispenser)
-        promise = Promise(setter_thread=self.transport.receiver_thread)
-        self._pending_replies[call_id] = promise
+        if self.use_asyncio:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                loop = self.transport.loop
+            promise = loop.create_future()
+        else:
+            promise = Promise(setter_thread=self.transport.receiver_thread)
+        timeout = getattr(self._local, 'timeout', _DEFAULT)
+        if timeout is _DEFAULT:
+            timeout = self.reply_timeout
+        self._pending_replies.add(call_id, promise, timeout)
         return call_id, promise
 
+    def _expire_call(self, call_id, promise):
+        '''called by _pending_replies when the reply timed out.'''
+        self._release_call(call_id)
+        if isinstance(promise, asyncio.Future):
+            error = asyncio.TimeoutError('No reply within the timeout')
+        else:
+            error = PromiseTimeoutError('No reply within the timeout')
+        _resolve(promise, 'set_exception', error)
+
+    # ---- flow control ----
+
+    def _limits_in_flight(self):
+        return self.max_in_flight is not None or self.max_in_flight_per_receiver is not None
+
+    def _acquire_window(self, call_id, receivers, send_later):
+        '''Counts the call as in flight. Returns False if it was queued, or
+        if it expired or was cancelled while blocking.'''
+        window = self._window
+        keys = _window_keys(receivers)
+        with window.cond:
+            while window.queue or not window.fits(keys, self.max_in_flight, self.max_in_flight_per_receiver):
+                policy = self.in_flight_policy
+                if policy == 'queue':
+                    window.queue.append((call_id, keys, send_later))
+                    return False
+                if policy == 'raise' or self.transport.receiver_thread is threading.current_thread():
+                    self._pending_replies.pop(call_id)
+                    raise TooManyPendingCalls('Too many calls in flight')
+                window.cond.wait()
+                if call_id not in self._pending_replies:
+                    # timed out or cancelled meanwhile; the promise has failed already.
+                    return False
+            window.take(call_id, keys)
+        return True
+
+    def _release_call(self, call_id):
+        '''The call is not in flight anymore; sends queued calls which fit now.'''
+        window = self._window
+        if not window.calls and not window.queue:
+            # nothing tracked, e.g. flow control is off
+            return
+        with window.cond:
+            if not window.release(call_id):
+                # a blocked call might have expired: let it stop waiting.
+                window.cond.notify_all()
+                return
+            ready = []
+            while window.queue:
+                queued_id, keys, send_later = window.queue[0]
+                if not window.fits(keys, self.max_in_flight, self.max_in_flight_per_receiver):
+                    break
+                window.queue.popleft()
+                window.take(queued_id, keys)
+                ready.append(send_later)
+            window.cond.notify_all()
+        for send_later in ready:
+            send_later()
+
+    def _send_queued(self, method, kwargs, call_id, receivers):
+        try:
+            self._transmit(method, kwargs, call_id, receivers)
+        except Exception as e:
+            L.warning('Sending queued call %s failed: %s', method, e)
+            promise = self._pending_replies.pop(call_id)
+            if promise is not None:
+                self._release_call(call_id)
+                _resolve(promise, 'set_exception', e)
+
     # ---- stuff ----
 
+    def processing_stats(self):
+        '''Returns the load of the incoming message workers, or None without ``async_processing``.
+
+        See :meth:`.ActionQueue.stats` resp. :meth:`.KeyedActionQueue.stats`.
+        '''
+        if self._action_queue is None:
+            return None
+        return self._action_queue.stats()
+
     def unhandled_calls(self):
         '''Generator, returns the names of all *incoming*, unconnected methods.
 
@@ -284,10 +612,248 @@ class RemoteAPI(object):
                 yield attr
 
 
-def incoming(unbound_method=None, has_reply=False, allow_positional_args=False):
+class _Batch(object):
+    '''see RemoteAPI.batch'''
+    def __init__(self, api):
+        self.api = api
+        # (receivers, method, kwargs, id)
+        self.calls = []
+        self._outer = False
+
+    def __enter__(self):
+        local = self.api._local
+        if getattr(local, 'batch', None) is None:
+            local.batch = self
+            self._outer = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if not self._outer:
+            return
+        api = self.api
+        api._local.batch = None
+        if exc_type is not None:
+            for _, _, _, call_id in self.calls:
+                api._pending_replies.pop(call_id)
+                api._release_call(call_id)
+            return
+        # one batch per run of calls with the same receivers, so that the
+        # calls are sent in the order in which they were made.
+        group, group_receivers = [], None
+        for receivers, method, kwargs, call_id in self.calls:
+            if group and receivers != group_receivers:
+                self._send(group, group_receivers)
+                group = []
+            group.append((method, kwargs, call_id))
+            group_receivers = receivers
+        if group:
+            self._send(group, group_receivers)
+
+    def _send(self, calls, receivers):
+        api = self.api
+        data = api.codec.encode_batch(calls, sec_out=api.security.sec_out)
+        api.transport.send(data, receivers=receivers)
+
+
+class _Timeout(object):
+    '''see RemoteAPI.timeout'''
+    def __init__(self, api, seconds):
+        self.api = api
+        self.seconds = seconds
+
+    def __enter__(self):
+        local = self.api._local
+        self._previous = getattr(local, 'timeout', _DEFAULT)
+        local.timeout = self.seconds
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.api._local.timeout = self._previous
+
+_DEFAULT = object()
+
+
+class _PendingReplies(object):
+    '''call id -> Promise of the calls awaiting a reply, with expiry.
+
+    Deadlines are kept in a heap. A timer thread fails the expired entries
+    by calling ``expire(call_id, promise)``; it only runs while deadlines are pending.
+    Entries which are popped before their deadline stay in the heap and are
+    skipped when their time has come; once they outnumber the live ones, the
+    heap is rebuilt without them.
+    '''
+    def __init__(self, expire):
+        self._expire = expire
+        self._promises = {}
+        # promise --> call id, for cancelling
+        self._ids = {}
+        # heap of (deadline, call id)
+        self._deadlines = []
+        # ids of the pending calls which have a deadline in the heap
+        self._timed = set()
+        # number of heap entries of calls that are not pending anymore
+        self._dead = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+
+    def __len__(self):
+        return len(self._promises)
+
+    def __contains__(self, call_id):
+        return call_id in self._promises
+
+    def add(self, call_id, promise, timeout=None):
+        with self._lock:
+            self._promises[call_id] = promise
+            self._ids[promise] = call_id
+            if timeout is None:
+                return
+            deadline = time.monotonic() + timeout
+            heapq.heappush(self._deadlines, (deadline, call_id))
+            self._timed.add(call_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run_timer, name='PendingReplies', daemon=True)
+                self._thread.start()
+            elif self._deadlines[0][1] == call_id:
+                # new earliest deadline
+                self._wakeup.notify()
+
+    def pop(self, call_id):
+        '''removes and returns the promise of call_id, None if not pending.'''
+        with self._lock:
+            promise = self._promises.pop(call_id, None)
+            if promise is not None:
+                del self._ids[promise]
+                self._forget_deadline(call_id)
+            return promise
+
+    def discard(self, promise):
+        '''removes the promise. Returns its call id, None if it was not pending.'''
+        with self._lock:
+            call_id = self._ids.pop(promise, None)
+            if call_id is not None:
+                del self._promises[call_id]
+                self._forget_deadline(call_id)
+            return call_id
+
+    def _forget_deadline(self, call_id):
+        '''marks the heap entry of call_id as dead. Call with the lock held.'''
+        if call_id not in self._timed:
+            return
+        self._timed.remove(call_id)
+        self._dead += 1
+        if self._dead > len(self._timed):
+            self._deadlines = [entry for entry in self._deadlines if entry[1] in self._timed]
+            heapq.heapify(self._deadlines)
+            self._dead = 0
+            # the timer might wait for a removed entry, or have nothing to do anymore.
+            self._wakeup.notify()
+
+    def _run_timer(self):
+        with self._lock:
+            while self._deadlines:
+                deadline, call_id = self._deadlines[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._wakeup.wait(delay)
+                    continue
+                heapq.heappop(self._deadlines)
+                promise = self._promises.pop(call_id, None)
+                if promise is None:
+                    # replied in time
+                    self._dead -= 1
+                    continue
+                self._timed.remove(call_id)
+                del self._ids[promise]
+                self._lock.release()
+                try:
+                    self._expire(call_id, promise)
+                except Exception:
+                    L.error('Failed to expire pending call %d', call_id, exc_info=True)
+                finally:
+                    self._lock.acquire()
+            self._thread = None
+
+
+class _CallWindow(object):
+    '''Bookkeeping of calls in flight, see RemoteAPI flow control.'''
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.total = 0
+        # receiver --> number of calls in flight
+        self.per_receiver = collections.Counter()
+        # call id --> receiver keys, of the calls in flight
+        self.calls = {}
+        # (call id, receiver keys, send function) of queued calls
+        self.queue = collections.deque()
+
+    def fits(self, keys, limit, per_receiver_limit):
+        if limit is not None and self.total >= limit:
+            return False
+        if per_receiver_limit is not None:
+            return all(self.per_receiver[key] < per_receiver_limit for key in keys)
+        return True
+
+    def take(self, call_id, keys):
+        self.calls[call_id] = keys
+        self.total += 1
+        for key in keys:
+            self.per_receiver[key] += 1
+
+    def release(self, call_id):
+        '''Returns False if the call was not in flight.'''
+        keys = self.calls.pop(call_id, None)
+        if keys is None:
+            # drop it if it is still queued
+            for idx, queued in enumerate(self.queue):
+                if queued[0] == call_id:
+                    del self.queue[idx]
+                    break
+            return False
+        self.total -= 1
+        for key in keys:
+            self.per_receiver[key] -= 1
+            if not self.per_receiver[key]:
+                del self.per_receiver[key]
+        return True
+
+
+def _window_keys(receivers):
+    '''receivers that a call counts for; None stands for broadcast.'''
+    if receivers is None:
+        return (None,)
+    return tuple(set(receivers))
+
+
+def _resolve(promise, method, value):
+    '''sets result / exception of a Promise or asyncio Future (from any thread).'''
+    setter = getattr(promise, method)
+    if isinstance(promise, asyncio.Future):
+        promise.get_loop().call_soon_threadsafe(_set_asyncio_future, setter, value)
+    else:
+        setter(value)
+
+
+async def _await_replies(replies, has_reply):
+    '''await all awaitable replies in order, then pick the reply like incoming() does.'''
+    replies = [(await r) if inspect.isawaitable(r) else r for r in replies]
+    if has_reply:
+        return _pick_reply(replies)
+
+
+def _pick_reply(replies):
+    replies = [r for r in replies if r is not None]
+    if len(replies) > 1:
+        raise ValueError('Incoming call produced more than one reply!')
+    replies.append(None) # If there is no result, reply with None
+    return replies[0]
+
+
+def incoming(unbound_method=None, has_reply=False, allow_positional_args=False, key=None):
     '''Marks a method as possible incoming message.
     
-    ``@incoming(has_reply=False, allow_positional_args=False)``
+    ``@incoming(has_reply=False, allow_positional_args=False, key=None)``
     
     Incoming methods keep list of connected listeners, which are called with the 
     signature of the incoming method (excluding ``self``). The first argument
@@ -309,6 +875,9 @@ def incoming(unbound_method=None, has_reply=False, allow_positional_args=False):
     to the sender. If multiple handlers are connected, at most one of them must 
     return something.
 
+    If the api uses asyncio, handlers can be coroutine functions. The incoming
+    method then returns a coroutine, which awaits all handlers in order.
+
     Notice:
         Processing of incoming messages does not resume until all listeners returned.
         This means that if you issue a followup remote call in a listener, the
@@ -324,44 +893,57 @@ def incoming(unbound_method=None, has_reply=False, allow_positional_args=False):
     executing the handler(s). Note that the :class:`.Codec` must support positional 
     and/or mixed args as well. It is strongly recommended to use named args only.
     
+    With a worker pool (``async_processing=n``), messages are handled in order
+    per sender. ``key`` changes that for this method: messages are handled
+    in order per key, and in parallel for different keys. It is either the
+    name of an argument (e.g. ``key='account'``) or a function taking the
+    same arguments as the method (excluding ``self``) and returning a
+    hashable key.
+
     Lastly, the incoming method has a ``myapi.<method>.inverted()`` method, which
     will return the ``@outgoing`` variant of it.
     '''
     if not unbound_method:
         # when called as @decorator(...)
-        return lambda unbound_method: incoming(unbound_method=unbound_method, has_reply=has_reply, allow_positional_args=allow_positional_args)
+        return lambda unbound_method: incoming(unbound_method=unbound_method, has_reply=has_reply, allow_positional_args=allow_positional_args, key=key)
     # when called as @decorator or explicitly
     pass_secinfo = [False]
     @wraps(unbound_method)
     def fn(self, sender, message):
-        if isinstance(message.kwargs, dict):
-            args, kwargs = [], message.kwargs
+        kwargs = message.kwargs
+        if isinstance(kwargs, dict):
+            args = ()
         else:
             if not allow_positional_args:
                 raise ValueError('Please call with named parameters only!')
-            if isinstance(message.kwargs, list):
-                args, kwargs = message.kwargs, {}
+            if isinstance(kwargs, list):
+                args, kwargs = kwargs, {}
             else:
-                args, kwargs = [message.kwargs], {}
-        L().debug('incoming call of %s, args=%r, kwargs=%r'%(message.method, args, kwargs))
+                args, kwargs = [kwargs], {}
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug('incoming call of %s, args=%r, kwargs=%r', message.method, args, kwargs)
         try:
-            replies = [unbound_method(self, sender, *args, **kwargs)]
+            reply = unbound_method(self, sender, *args, **kwargs)
         except TypeError:
             # signature is wrong
             raise TypeError('incoming call with wrong signature')
+        listeners = fn._listeners
+        if not listeners:
+            if inspect.isawaitable(reply):
+                return _await_replies([reply], has_reply)
+            return reply if has_reply else None
         if pass_secinfo[0]:
             kwargs['secinfo'] = message.secinfo
-        for listener in fn._listeners:
+        replies = [reply]
+        for listener in listeners:
             replies.append(listener(sender, *args, **kwargs))
+        if any(inspect.isawaitable(r) for r in replies):
+            return _await_replies(replies, has_reply)
         if has_reply:
-            replies = [r for r in replies if r is not None]
-            if len(replies) > 1:
-                raise ValueError('Incoming call produced more than one reply!')
-            replies.append(None) # If there is no result, reply with None
-            return replies[0]
+            return _pick_reply(replies)
 
     # Presence of this attribute indicates that this method is a valid incoming target
-    fn._remote_api_incoming = {'has_reply': has_reply}
+    fn._remote_api_incoming = {'has_reply': has_reply, 'key': _key_extractor(key)}
     fn._listeners = []
     fn._unbound_method = unbound_method
     fn.pass_secinfo = lambda val: pass_secinfo.__setitem__(0, val)
@@ -371,6 +953,26 @@ def incoming(unbound_method=None, has_reply=False, allow_positional_args=False):
     return fn
 
 
+def _key_extractor(key):
+    '''turns the ``key`` of ``@incoming`` into a function ``(sender, message) -> key``.'''
+    if key is None:
+        return None
+    if isinstance(key, str):
+        name = key
+        def extract(sender, message):
+            kwargs = message.kwargs
+            return kwargs.get(name) if isinstance(kwargs, dict) else None
+        return extract
+    def extract(sender, message):
+        kwargs = message.kwargs
+        if isinstance(kwargs, dict):
+            return key(sender, **kwargs)
+        if isinstance(kwargs, list):
+            return key(sender, *kwargs)
+        return key(sender, kwargs)
+    return extract
+
+
 def outgoing(unbound_method=None, has_reply=False, allow_positional_args=False):
     '''Marks a method as possible outgoing message.
     
@@ -389,7 +991,8 @@ def outgoing(unbound_method=None, has_reply=False, allow_positional_args=False):
     support all the "atomic" builtin types, as well as dicts and lists.
     
     If ``has_reply=True``, the other side is expected to return a result value. In this case,
-    calling the outgoing method returns a :class:`.Promise` immediately.
+    calling the outgoing method returns a :class:`.Promise` immediately (an 
+    awaitable :class:`asyncio.Future` if the api uses asyncio).
     
     If ``allow_positional_args=True``, calls with positional (unnamed) 
     arguments are accepted. Otherwise such arguments raise :class:`ValueError`.
@@ -403,30 +1006,35 @@ def outgoing(unbound_method=None, has_reply=False, allow_positional_args=False):
         # when called as @decorator(...)
         return lambda unbound_method: outgoing(unbound_method=unbound_method, has_reply=has_reply, allow_positional_args=allow_positional_args)
     # when called as @decorator or explicitly
-    if allow_positional_args:
-        sig = inspect.signature(unbound_method)
-        # cut off self and sender/receiver arg
-        argnames = [p.name for p in sig.parameters.values()][2:]
-    else:
-        argnames = []
+    sig = inspect.signature(unbound_method)
+    # cut off self and sender/receiver arg
+    params = list(sig.parameters.values())[2:]
+    argnames = [p.name for p in params if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY)]
+    accepted = frozenset(argnames)
+    required = frozenset(p.name for p in params if p.name in accepted and p.default is p.empty)
+    has_varkw = any(p.kind == p.VAR_KEYWORD for p in params)
+    method_name = unbound_method.__name__
     @wraps(unbound_method)
     def fn(self, receivers=None, *args, **kwargs):
-        if args and not allow_positional_args:
-            raise ValueError('Please call with named parameters only!')
-        else:
+        if args:
+            if not allow_positional_args:
+                raise ValueError('Please call with named parameters only!')
             # map positional to named args
             for name, arg in zip(argnames, args):
                 if name in kwargs:
                     raise ValueError('argument %s given twice!'%name)
                 kwargs[name] = arg
-        # this ensures that all args and kwargs are valid
-        unbound_method(self, receivers, **kwargs)
+        if self.validate_outgoing:
+            # this ensures that all args and kwargs are valid
+            unbound_method(self, receivers, **kwargs)
+        elif not (has_varkw or kwargs.keys() <= accepted) or not required <= kwargs.keys():
+            # raises the appropriate TypeError
+            sig.bind(self, receivers, **kwargs)
         if has_reply:
             call_id, promise = self._new_request()
         else:
             call_id = 0
-        data = self.codec.encode(unbound_method.__name__, kwargs=kwargs, id=call_id, sec_out=self.security.sec_out)
-        self.transport.send(data, receivers=receivers)
+        self._send_call(method_name, kwargs, call_id, receivers)
         if has_reply:
             return promise
 
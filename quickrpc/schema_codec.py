@@ -0,0 +1,214 @@
+'''Schema codec: compact positional encoding derived from the RemoteAPI.
+
+Both peers share the same :class:`.RemoteAPI` subclass, so the names of the
+methods and of their arguments need not go over the wire. Instead, the
+codec numbers the methods and sends the arguments as positional slots in
+signature order.
+'''
+import hashlib
+import inspect
+import logging
+from .codecs import Codec, Message, LazyMessage, Reply, ErrorReply, DecodeError, EncodeError, RemoteError, _fmt_exc, _DEFAULT_MAX_FRAME_LENGTH
+from .msgpack_codec import MsgpackCodec, packb, unpackb, unpack_head, unpack_tail, _lazy_option, _OMITTED
+L = logging.getLogger(__name__)
+
+# Message kinds other than calls. Calls use the (non-negative) method id.
+_REPLY = -1
+_ERROR = -2
+_SECINFO = -3
+
+_REQUIRED = inspect.Parameter.empty
+
+
+class SchemaCodec(MsgpackCodec):
+    '''Compact binary codec using a schema compiled from the API signatures.
+
+    The codec is bound to the API by :meth:`bind_api`, which
+    :class:`.RemoteAPI` calls when the codec is assigned. Alternatively,
+    pass the API class as ``api_class``.
+
+    The schema lists all ``@incoming`` and ``@outgoing`` methods sorted by
+    name, so that an API and its inverted counterpart yield the same schema.
+    The method id is the index in that list. The arguments are the
+    parameters of the method after ``self`` and ``sender``/``receivers``, in
+    signature order. A ``**kwargs`` parameter adds one trailing slot holding
+    a map of the extra arguments.
+
+    Messages are MessagePack arrays:
+
+        * Call: ``[method_id, id, arg1, arg2, ...]`` (id=0 for notifications)
+        * Reply: ``[-1, id, result]``
+        * Error: ``[-2, id, code, message, data]``
+
+    Trailing arguments which were not given are left out. Arguments in 
+    between are sent as "omitted" marker (MessagePack extension type 0 with
+    a zero byte). Either way, they are missing from the decoded kwargs, so 
+    that the receiving method uses its own defaults.
+
+    Each payload starts with a 4-byte fingerprint of the schema. Messages
+    from a peer with a different API definition are rejected with a
+    :class:`.DecodeError`.
+
+    Framing and security work like in :class:`.MsgpackCodec`; the secinfo
+    header is ``[-3, <secinfo>]``.
+
+    Supported values and lazy decoding are as in :class:`.MsgpackCodec`.
+    '''
+    shorthand = 'schema'
+    @classmethod
+    def fromstring(cls, expression):
+        '''schema:[lazy]'''
+        _, _, options = expression.partition(':')
+        return cls(lazy=_lazy_option(options))
+
+    def __init__(self, api_class=None, lazy=False, max_frame_length=_DEFAULT_MAX_FRAME_LENGTH):
+        MsgpackCodec.__init__(self, lazy=lazy, max_frame_length=max_frame_length)
+        self.fingerprint = None
+        # method names by id
+        self.methods = []
+        # method name -> (id, argnames, defaults, has_varkw)
+        self._by_name = {}
+        if api_class is not None:
+            self.bind_api(api_class)
+
+    def bind_api(self, api):
+        '''Compiles the schema from the given API instance or class.
+
+        A codec can be shared by several APIs with identical schema; binding
+        it to a different one raises :class:`ValueError`.
+        '''
+        api_class = api if isinstance(api, type) else type(api)
+        by_name = {}
+        description = []
+        for name in sorted(dir(api_class)):
+            field = getattr(api_class, name)
+            info = getattr(field, '_remote_api_incoming', None) or getattr(field, '_remote_api_outgoing', None)
+            if info is None:
+                continue
+            # follows __wrapped__ to the undecorated method.
+            params = list(inspect.signature(field).parameters.values())[2:]
+            argnames = tuple(p.name for p in params if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY))
+            defaults = tuple(p.default for p in params if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY))
+            has_varkw = any(p.kind == p.VAR_KEYWORD for p in params)
+            by_name[name] = (len(by_name), argnames, defaults, has_varkw)
+            description.append('%s(%s%s)%s'%(
+                name,
+                ','.join(argnames),
+                ',**' if has_varkw else '',
+                '->' if info['has_reply'] else '',
+            ))
+        fingerprint = hashlib.sha1(';'.join(description).encode('utf8')).digest()[:4]
+        if self.fingerprint is not None and fingerprint != self.fingerprint:
+            raise ValueError('SchemaCodec is already bound to a different API')
+        self.fingerprint = fingerprint
+        self._by_name = by_name
+        self.methods = sorted(by_name, key=lambda name: by_name[name][0])
+        L.debug('compiled schema of %s, fingerprint %s', api_class.__name__, fingerprint.hex())
+
+    def encode(self, method, kwargs, id=0, sec_out=None):
+        try:
+            method_id, argnames, defaults, has_varkw = self._by_name[method]
+        except KeyError:
+            raise EncodeError('Method %s is not in the schema'%method)
+        kwargs = kwargs or {}
+        slots = []
+        given = 0
+        for idx, name in enumerate(argnames):
+            if name in kwargs:
+                # mark the gap
+                slots.extend([_OMITTED] * (idx - len(slots)))
+                slots.append(kwargs[name])
+                given += 1
+        if given < len(kwargs):
+            extra = {key: value for key, value in kwargs.items() if key not in argnames}
+            if not has_varkw:
+                raise EncodeError('%s got unexpected arguments %s'%(method, ', '.join(extra)))
+            slots.extend([_OMITTED] * (len(argnames) - len(slots)))
+            slots.append(extra)
+        if any(default is _REQUIRED and name not in kwargs for name, default in zip(argnames, defaults)):
+            raise EncodeError('%s: missing required argument(s)'%method)
+        return self._encode_generic([method_id, id] + slots, sec_out)
+
+    def call_encoder(self, method):
+        return Codec.call_encoder(self, method)
+
+    def encode_reply(self, in_reply_to, result, sec_out=None):
+        return self._encode_generic([_REPLY, in_reply_to.id, result], sec_out)
+
+    def encode_error(self, in_reply_to, exception, errorcode=0, sec_out=None):
+        return self._encode_generic(
+            [_ERROR, in_reply_to.id, errorcode, str(exception), _fmt_exc(exception)],
+            sec_out
+        )
+
+    def _pack(self, msg):
+        if self.fingerprint is None:
+            raise EncodeError('SchemaCodec is not bound to an API')
+        return self.fingerprint + packb(msg)
+
+    def _payload(self, data):
+        if self.fingerprint is None:
+            raise DecodeError('SchemaCodec is not bound to an API')
+        if data[:4] != self.fingerprint:
+            raise DecodeError('Schema fingerprint mismatch: peer uses a different API definition')
+        return memoryview(data)[4:]
+
+    def _secinfo_header(self, secinfo):
+        return [_SECINFO, secinfo]
+
+    def _decode_one(self, data, secinfo):
+        try:
+            data = self._payload(data)
+            if self.lazy:
+                msg, idx, remaining = unpack_head(data, 2)
+                if len(msg) == 2 and isinstance(msg[0], int) and 0 <= msg[0] < len(self.methods):
+                    method = self.methods[msg[0]]
+                    return LazyMessage(
+                        method=method,
+                        parse=lambda: self._kwargs(method, unpack_tail(data, idx, remaining)),
+                        id=msg[1],
+                        secinfo=secinfo
+                    )
+                if remaining:
+                    msg += unpack_tail(data, idx, remaining)
+            else:
+                msg = unpackb(data)
+        except DecodeError as e:
+            return e
+        if not isinstance(msg, list) or len(msg) < 2:
+            return DecodeError('toplevel object is not a list')
+        kind, id = msg[0], msg[1]
+        if not isinstance(kind, int):
+            return DecodeError('Unknown message type %r'%(kind,))
+        if 0 <= kind < len(self.methods):
+            method = self.methods[kind]
+            try:
+                kwargs = self._kwargs(method, msg[2:])
+            except DecodeError as e:
+                return e
+            return Message(method=method, kwargs=kwargs, id=id, secinfo=secinfo)
+        elif kind == _REPLY and len(msg) == 3:
+            return Reply(result=msg[2], id=id, secinfo=secinfo)
+        elif kind == _ERROR and len(msg) == 5:
+            _, _, code, message, details = msg
+            return ErrorReply(
+                    exception=RemoteError(message, details),
+                    id=id,
+                    errorcode=code,
+                    secinfo=secinfo
+                    )
+        elif kind == _SECINFO:
+            # id is the secinfo dict here
+            return Message(method='rpc.secinfo', kwargs=id, secinfo=None)
+        else:
+            return DecodeError('Unknown message type %r'%(kind,))
+
+    def _kwargs(self, method, slots):
+        '''maps the argument slots of method to kwargs. Raises DecodeError.'''
+        _, argnames, defaults, has_varkw = self._by_name[method]
+        kwargs = {name: value for name, value in zip(argnames, slots) if value is not _OMITTED}
+        if len(slots) > len(argnames):
+            if not (has_varkw and len(slots) == len(argnames) + 1 and isinstance(slots[-1], dict)):
+                raise DecodeError('Too many arguments for %s'%method)
+            kwargs.update(slots[-1])
+        return kwargs
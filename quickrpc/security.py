@@ -14,7 +14,7 @@ __all__ = [
     
     
 
-L = lambda: logging.getLogger(__name__)
+L = logging.getLogger(__name__)
 
 class SecurityError(Exception):
     '''Security-related error'''
@@ -2,8 +2,8 @@ import logging
 import base64
 import binascii
 import re
-from .codecs import Codec, Message, Reply, ErrorReply, DecodeError, EncodeError, RemoteError, _fmt_exc
-L = lambda: logging.getLogger(__name__)
+from .codecs import Codec, Message, LazyMessage, Reply, ErrorReply, DecodeError, EncodeError, RemoteError, _fmt_exc
+L = logging.getLogger(__name__)
 
  
 class TerseCodec(Codec):
@@ -24,13 +24,22 @@ class TerseCodec(Codec):
     * Commands must be terminated by newline. 
     * Newlines, double quote and backslash in strings are escaped as usual
     * Allowed dtypes: int, float, str, bytes (content base64-encoded), list, dict
+
+    With ``lazy=True``, the params of incoming calls are decoded on first
+    access of their ``.kwargs`` (see :class:`.LazyMessage`).
     '''
 
     shorthand = 'terse'
     @classmethod
     def fromstring(cls, expression):
-        '''terse:'''
-        return cls()
+        '''terse:[lazy]'''
+        _, _, options = expression.partition(':')
+        if options not in ('', 'lazy'):
+            raise ValueError('Unknown terse codec option: %s'%options)
+        return cls(lazy=(options == 'lazy'))
+
+    def __init__(self, lazy=False):
+        self.lazy = lazy
 
     def encode(self, method, kwargs, id=0, sec_out=None):
         '''encodes the call, including trailing newline'''
@@ -39,32 +48,38 @@ class TerseCodec(Codec):
     
     def encode_reply(self, in_reply_to, result, sec_out=None):
         if sec_out: raise EncodeError('Security is not supported by TerseCodec.')
-        return b'[%d]:%s'%(in_reply_to.id, _encode_value(result))
+        return b'[%d]:%s\n'%(in_reply_to.id, _encode_value(result))
     
     def encode_error(self, in_reply_to, exception, errorcode=0, sec_out=None):
         if sec_out: raise EncodeError('Security is not supported by TerseCodec.')
         text = _encode_value(str(exception))
         details = _encode_value(_fmt_exc(exception))
-        return b'[%d]! message:%s details:%s'%(in_reply_to.id, text, details)
+        return b'[%d]! message:%s details:%s\n'%(in_reply_to.id, text, details)
 
     def decode(self, data, sec_in=None):
+        messages, consumed = self.decode_buffer(data, sec_in=sec_in)
+        return messages, bytes(data[consumed:])
+
+    def decode_buffer(self, data, sec_in=None):
         if sec_in: raise DecodeError('Security is not supported by TerseCodec')
-        lines = data.split(b'\n')
-        leftover = lines.pop()
         messages = []
-        for line in lines:
+        start = 0
+        for match in _newline.finditer(data):
+            line = bytes(data[start:match.start()])
+            start = match.end()
             try:
-                obj, idx = _decode(line + b'\n')
+                obj = _decode_line(line, self.lazy)
             except DecodeError as e:
-                L().warning(e)
+                L.warning(e)
                 continue
-            else:
-                if idx <= len(line):
-                    L().warning('_decode left something over: %r'%line[idx:])
+            if obj is not None:
                 messages.append(obj)
-        if leftover:
-            L().debug('leftover data: %r'%(leftover[:50]+b" ... "+leftover[-50:]))
-        return messages, leftover
+        if start < len(data):
+            if L.isEnabledFor(logging.DEBUG):
+                L.debug('leftover data: %d bytes', len(data) - start)
+        return messages, start
+
+_newline = re.compile(b'\n')
 
 def _encode_method(method, id, params):
     return b'%s%s %s\n'%(
@@ -101,156 +116,124 @@ def _encode_dict(d):
     ) + b'}'
 
 
-def _decode(data):
-    '''returns object, idx OR raises DecodeError.
-    identifier params <NL>
-    '''
-    idx = 0
-    params = {}
-    # skip empty telegrams
-    while data[idx:idx+1] in b'\r\n':
-        idx += 1
-    if b'\n' not in data:
-        raise DecodeError('Incomplete data')
-    
-    if data[idx] == b'[':
-        idnum, idx = _decode_idnum(data, idx)
-        if data[idx] == b':':
-            return _decode_reply(data, idx+1, id=idnum)
-        elif data[idx] == b'!':
-            return _decode_error(data, idx+1, id=idnum)
+# Decoding: each line is split into tokens by a single pass of _token_re.
+# m.lastindex tells the token type, which is used as index into _converters.
+_token_re = re.compile(br'''
+      ([^\s:"'\[\]{}]+):                              # 1: key
+    | (-?\d+)(?![\d.eE])                               # 2: int
+    | (-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)        # 3: float
+    | "([^"\\]*(?:\\.[^"\\]*)*)"                     # 4: string
+    | '([^']*)'                                        # 5: bytes
+    | (\[)                                             # 6: list start
+    | (\{)                                             # 7: dict start
+    | (\])                                             # 8: list end
+    | (\})                                             # 9: dict end
+    | (\S)                                             # 10: anything else
+''', re.VERBOSE)
+_KEY, _INT, _FLOAT, _STR, _BYTES, _LIST, _DICT, _LIST_END, _DICT_END, _INVALID = range(1, 11)
+
+_header_re = re.compile(br'''
+      \[(\d+)\]([:!])                                  # reply / error: [id]: or [id]!
+    | ([^\s/\[\]]+)(?:/(\d+))?(?=\s|$)                # method[/id]
+''', re.VERBOSE)
+
+def _decode_str(token):
+    try:
+        value = token.decode('utf8')
+    except UnicodeDecodeError:
+        raise DecodeError('UTF8 decoding failed')
+    if '\\' in value:
+        # the encoder escapes backslash, double quote and newline.
+        if '\0' not in value:
+            # park escaped backslashes on a placeholder
+            value = value.replace('\\\\', '\0').replace('\\"', '"').replace('\\n', '\n').replace('\0', '\\')
         else:
-            raise DecodeError('Received invalid reply')
-    
-    return _decode_message(data, idx)
-    
-def _decode_message(data, idx):
-    method, idx = _decode_identifier(data, idx)
-    if data[idx] == b'[':
-        id = _decode_idnum(data, idx)
-    else:
-        id = 0
-    idx = _skipws(data, idx)
-    params, idx = _decode_pairs(data, idx)
-    idx = _expect(data, idx, b'\n')
-    return Message(method, params, id=id), idx
-
-def _decode_reply(data, idx, id):
-    idx = _skipws(data, idx)
-    val, idx = _decode_value(data, idx)
-    idx = _expect(data, idx, b'\n')
-    return Reply(val, id), idx
-
-def _decode_error(data, idx, id):
-    idx = _skipws(data, idx)
-    data, idx = _decode_pairs(data, idx)
-    idx = _expect(data, idx, b'\n')
-    msg = data.get('message', '')
-    details = data.get('details', '')
-    return ErrorReply(message, details), idx
-
-def _decode_pairs(data, idx, assignchar = b':'):
-    pairs = dict()
-    while True:
-        idx = _skipws(data, idx)
-        # XXX: sentinel chars from other grammar terms!
-        if data[idx:idx+1] in b'}\n':
-            return pairs, idx
-        key, value, idx = _decode_pair(data, idx, assignchar)
-        pairs[key] = value
-
-def _decode_pair(data, idx, assignchar):
-    key, idx = _decode_identifier(data, idx)
-    # this may throw DecodeError
-    idx = _expect(data, idx, assignchar)
-    value, idx = _decode_value(data, idx)
-    return key, value, idx
+            value = '\\'.join(
+                part.replace('\\"', '"').replace('\\n', '\n')
+                for part in value.split('\\\\')
+            )
+    return value
 
-def _decode_value(data, idx):
-    idx = _skipws(data, idx)
-    ch = data[idx:idx+1]
-    if ch in b'-.0123456789':
-        return _decode_num(data, idx)
-    func = {
-        b'[': _decode_list,
-        b'{': _decode_dict,
-        b'"': _decode_str,
-        b"'": _decode_bytes,
-    }.get(ch, None)
-    if func is None:
-        raise DecodeError('Unsupported Value at position %s'%idx)
-    return func(data, idx)
-
-_num_re = re.compile(br'-?\d*(\.\d*)?([eE][+-?]\d+)?')
-def _decode_num(data, idx):
-    m = _num_re.match(data, idx)
-    if not m:
-        raise DecodeError('Expected number at position %d'%idx)
-    if b'.' not in m.group() and b'e' not in m.group().lower():
-        return int(m.group()), m.end()
-    return float(m.group()), m.end()
-
-def _decode_bytes(data, idx):
-    try:
-        end = data.index(b"'", idx+1)
-    except ValueError:
-        raise DecodeError('unterminated bytes value at %d'%idx)
+def _decode_bytes(token):
     try:
-        value = base64.b64decode(data[idx+1:end])
+        return base64.b64decode(token)
     except binascii.Error:
         raise DecodeError('invalid base64 string')
-    return value, end+1
 
-_str_re = re.compile(br'(\\"|[^"])*["]')
-def _decode_str(data, idx):
-    idx = _expect(data, idx, b'"')
-    m = _str_re.match(data, idx)
-    if not m.group():
-        raise DecodeError('Expected quoted value at position %d'%idx)
-    value = m.group()[:-1].decode('utf8').replace('\\n', '\n').replace('\\"', '\"').replace('\\\\', '\\')
-    return value, m.end()
+# token type --> conversion function for scalar values, None for others
+_converters = (None, None, int, float, _decode_str, _decode_bytes, None, None, None, None, None)
 
-def _decode_dict(data, idx):
-    idx = _expect(data, idx, b'{')
-    contents, idx = _decode_pairs(data, idx, assignchar=b':')
-    idx = _expect(data, idx, b'}')
-    return contents, idx
+def _decode_line(line, lazy=False):
+    '''decodes one line (without newline). Returns the message object, or None for an empty line.
 
-def _decode_list(data, idx):
-    idx = _expect(data, idx, b'[')
-    l = []
-    while True:
-        idx = _skipws(data, idx)
-        if data[idx:idx+1] == b']':
-            break
-        value, idx = _decode_value(data, idx)
-        l.append(value)
-    idx = _expect(data, idx, b']')
-    return l, idx
+    If lazy, the params of a call are decoded on access.
 
-_id_re = re.compile(br'.*?(?=[ :\n])')
-def _decode_identifier(data, idx):
-    m = _id_re.match(data, idx)
-    if not m:
-        raise DecodeError('Expected identifier at position %d'%idx)
-    return m.group().strip().decode('utf8'), m.end()
-
-_idnum_re = re.compile(br'\[\d+\]')
-def _decode_idnum(data, idx):
-    m = _idnum_re.match(data, idx)
+    Raises DecodeError.
+    '''
+    line = line.rstrip(b'\r')
+    if not line.strip():
+        return None
+    m = _header_re.match(line)
     if not m:
-        raise DecodeError('Expected [id] at position %d'%idx)
-    return int(m.group()[1:-1].decode('ascii')), m.end()
-    
-
-def _skipws(data, idx):
-    while data[idx:idx+1] in b' \r':
-        idx += 1
-    return idx
-    
-def _expect(data, idx, chars):
-    while data[idx:idx+1] == b' ':
-        idx += 1
-    if data[idx:idx+len(chars)] != chars:
-        raise DecodeError('Expected characters "%s" at position %d'%(chars.decode('ascii'), idx))
-    return idx + len(chars)
+        raise DecodeError('Invalid message start: %r'%line[:50])
+    reply_id, kind, method, id = m.groups()
+    if method is not None:
+        if lazy:
+            pos = m.end()
+            return LazyMessage(method.decode('utf8'), lambda: _decode_tokens(line, pos, {}), id=int(id) if id else 0)
+        params = _decode_tokens(line, m.end(), {})
+        return Message(method.decode('utf8'), params, id=int(id) if id else 0)
+    if kind == b':':
+        values = _decode_tokens(line, m.end(), [])
+        if len(values) != 1:
+            raise DecodeError('Expected a single value in reply')
+        return Reply(values[0], int(reply_id))
+    else:
+        pairs = _decode_tokens(line, m.end(), {})
+        e = RemoteError(pairs.get('message', ''), pairs.get('details', ''))
+        return ErrorReply(e, int(reply_id))
+
+def _decode_tokens(line, pos, root):
+    '''decodes the values in line[pos:] into root (a dict for key:value pairs, or a list).'''
+    # stack of (container, key) of the enclosing containers
+    stack = []
+    container = root
+    in_dict = root.__class__ is dict
+    key = None
+    converters = _converters
+    for m in _token_re.finditer(line, pos):
+        kind = m.lastindex
+        convert = converters[kind]
+        if convert is not None:
+            value = convert(m.group(kind))
+        elif kind == _KEY:
+            if key is not None or not in_dict:
+                raise DecodeError('Unexpected key at position %d'%m.start())
+            key = m.group(_KEY).decode('utf8')
+            continue
+        elif kind == _LIST or kind == _DICT:
+            if in_dict and key is None:
+                raise DecodeError('Missing key at position %d'%m.start())
+            stack.append((container, key))
+            in_dict = kind == _DICT
+            container = {} if in_dict else []
+            key = None
+            continue
+        elif kind == _LIST_END or kind == _DICT_END:
+            if not stack or in_dict != (kind == _DICT_END) or key is not None:
+                raise DecodeError('Unexpected %r at position %d'%(m.group(kind), m.start()))
+            value = container
+            container, key = stack.pop()
+            in_dict = container.__class__ is dict
+        else:
+            raise DecodeError('Unsupported Value at position %d'%m.start())
+        if in_dict:
+            if key is None:
+                raise DecodeError('Missing key at position %d'%m.start())
+            container[key] = value
+            key = None
+        else:
+            container.append(value)
+    if stack or key is not None:
+        raise DecodeError('Incomplete value at end of line')
+    return root
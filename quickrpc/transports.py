@@ -11,9 +11,14 @@ Classes defined here:
  * :any:`StdioTransport`: reads from stdin, writes to stdout.
  * :any:`TcpServerTransport`: a transport that accepts tcp connections and muxes 
    them into one transport. Actually a forward to quickrpc.network_transports.
+ * :any:`SelectorTcpServerTransport`: like TcpServerTransport, but serves all 
+   connections from one thread. Forward to quickrpc.network_transports.
  * :any:`TcpClientTransport`: connects to a TCP server. This is a forward to 
    quickrpc.network_transports.
  * :any:`RestartingTcpClientTransport`: a TCP Client that reconnects automatically.
+ * :any:`Waker`: helper to interrupt a blocking ``select()`` from another thread.
+ * :any:`FillLevel`: buffer fill level with high / low watermarks, for backpressure.
+ * :any:`ReceiveBuffer`: growable receive buffer, keeping undecoded data per connection.
 
 '''
 
@@ -23,25 +28,302 @@ __all__ = [
     'RestartingTransport',
     'StdioTransport',
     'TcpServerTransport',
+    'SelectorTcpServerTransport',
     'TcpClientTransport',
     'RestartingTcpClientTransport',
+    'Waker',
+    'FillLevel',
+    'ReceiveBuffer',
+    'accepts_buffer',
+    'TransportError',
+    'BackpressureError',
 ]
 
 from collections import namedtuple
 import logging
+import os
 import queue
 import sys
 import select
+import socket
 import threading
 import time
 from .util import subclasses, paren_partition
 from .promise import Promise, PromiseDoneError
 
-L = lambda: logging.getLogger(__name__)
+L = logging.getLogger(__name__)
 
 class TransportError(Exception):
     '''Generic Transport-related error.'''
 
+class BackpressureError(TransportError):
+    '''Raised by send() if too much data is queued and ``send_backpressure='raise'``.'''
+
+
+class _StopSignal:
+    '''Queued to wake up and stop a transport waiting on a queue.'''
+
+
+class Waker(object):
+    '''Wakes up a thread blocking in ``select()`` from another thread.
+
+    Add the Waker to the set of readable file objects. :meth:`wake` makes it
+    readable, which returns from the ``select()`` call immediately;
+    :meth:`drain` resets it. Several wakeups before the drain collapse
+    into one.
+
+    Uses an eventfd where available, a socket pair otherwise.
+    '''
+    def __init__(self):
+        if hasattr(os, 'eventfd'):
+            self._fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            self._r = self._w = None
+        else:
+            self._fd = None
+            self._r, self._w = socket.socketpair()
+            self._r.setblocking(False)
+            self._w.setblocking(False)
+
+    def fileno(self):
+        return self._r.fileno() if self._fd is None else self._fd
+
+    def wake(self):
+        '''Make the waker readable. Can be called from any thread.'''
+        try:
+            if self._fd is None:
+                self._w.send(b'\0')
+            else:
+                os.eventfd_write(self._fd, 1)
+        except (BlockingIOError, OSError, ValueError):
+            # buffer full (wakeup already pending) or already closed
+            pass
+
+    def drain(self):
+        '''Consume pending wakeups.'''
+        try:
+            if self._fd is None:
+                while self._r.recv(4096):
+                    pass
+            else:
+                os.eventfd_read(self._fd)
+        except (BlockingIOError, OSError):
+            pass
+
+    def close(self):
+        if self._fd is None:
+            self._r.close()
+            self._w.close()
+        else:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class FillLevel(object):
+    '''Fill level of a buffer (in bytes) with high and low watermark.
+
+    When :attr:`level` rises above ``high``, the buffer becomes :attr:`paused`
+    and ``on_pause()`` is called. It stays paused until the level dropped to 
+    ``low`` or less; then ``on_resume()`` is called. ``high=None`` disables 
+    the watermarks. ``low`` defaults to half of ``high``.
+
+    The callbacks are called outside of the internal lock, on the thread that 
+    caused the transition.
+    '''
+    def __init__(self, high=None, low=None, on_pause=None, on_resume=None):
+        self.level = 0
+        self.paused = False
+        self.on_pause = on_pause
+        self.on_resume = on_resume
+        self._cond = threading.Condition(threading.Lock())
+        self._resume_promises = []
+        self.set_watermarks(high, low)
+
+    def set_watermarks(self, high, low=None):
+        if high is not None and low is None:
+            low = high // 2
+        self.high = high
+        self.low = low
+
+    def add(self, n):
+        '''Increase level by n bytes.'''
+        with self._cond:
+            self.level += n
+            pause = not self.paused and self.high is not None and self.level > self.high
+            if pause:
+                self.paused = True
+        if pause and self.on_pause:
+            self.on_pause()
+
+    def remove(self, n):
+        '''Decrease level by n bytes.'''
+        with self._cond:
+            self.level -= n
+            resume = self.paused and self.level <= self.low
+            if resume:
+                self.paused = False
+                self._cond.notify_all()
+                promises, self._resume_promises = self._resume_promises, []
+        if resume:
+            for promise in promises:
+                promise.set_result(True)
+            if self.on_resume:
+                self.on_resume()
+
+    def wait(self, timeout=None):
+        '''Block until not paused. Returns False on timeout.'''
+        with self._cond:
+            return self._cond.wait_for(lambda: not self.paused, timeout)
+
+    def resumed(self, setter_thread=None):
+        '''Returns a :class:`.Promise` that is fulfilled as soon as the buffer is not paused.'''
+        promise = Promise(setter_thread=setter_thread)
+        with self._cond:
+            if self.paused:
+                self._resume_promises.append(promise)
+                return promise
+        promise.set_result(True)
+        return promise
+
+
+class _Buffer(bytearray):
+    '''The storage of a :class:`ReceiveBuffer`.
+
+    ``decoder`` can hold the state of a stream decoder for the data in it
+    (see :meth:`.Codec.decoder`). It goes away together with the buffer 
+    object, i.e. when the connection is gone or the storage is replaced.
+
+    ``lent`` is set by a decoder that handed out memoryviews of the data 
+    (e.g. attachments); the delivered part of the buffer is not overwritten 
+    anymore then.
+    '''
+    __slots__ = ('decoder', 'lent', '__weakref__')
+
+    def __init__(self, size):
+        super().__init__(size)
+        self.decoder = None
+        self.lent = False
+
+
+def _recv_watermark(name):
+    '''Property for ``recv_high_watermark`` / ``recv_low_watermark`` of 
+    transports with a receive backlog, applied to ``self._recv_fill`` right 
+    away.'''
+    attr = '_' + name
+    def fget(self):
+        return getattr(self, attr, None)
+    def fset(self, value):
+        setattr(self, attr, value)
+        self._recv_fill.set_watermarks(self.recv_high_watermark, self.recv_low_watermark)
+    return property(fget, fset)
+
+
+class ReceiveBuffer(object):
+    '''Growable buffer for received, not yet decoded data of one connection.
+
+    Data is read directly into the buffer using :meth:`recv_into` or appended
+    using :meth:`append`. :meth:`deliver` passes the undecoded data to 
+    :meth:`Transport.received` as a memoryview and drops the consumed bytes
+    from the front. Consumed space is reclaimed by moving the remainder to the
+    front when more room is needed; the buffer grows by doubling. Thus each
+    byte is copied a bounded number of times, regardless how the data is 
+    chunked.
+
+    Delivered data is never overwritten once the receiver lent out 
+    memoryviews of it (e.g. a decoded attachment, see :class:`_Buffer`). New 
+    data goes after it as long as there is room; then a fresh buffer is 
+    used.
+
+    The memoryviews passed on are views of a :class:`_Buffer`, to which the
+    receiver can attach its decoder state.
+    '''
+    def __init__(self, size=4096):
+        self._buf = _Buffer(size)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def clear(self):
+        # new object: tells stateful decoders that the remainder is gone.
+        self._buf = _Buffer(len(self._buf))
+        self._start = self._end = 0
+
+    def _reserve(self, n):
+        '''make sure that there is room for n more bytes after the end.'''
+        if len(self._buf) - self._end >= n:
+            return
+        used = self._end - self._start
+        if self._start and len(self._buf) - used >= n and not self._buf.lent:
+            # compact
+            self._buf[:used] = self._buf[self._start:self._end]
+        else:
+            size = len(self._buf)
+            while size - used < n:
+                size *= 2
+            # new object instead of resizing, which is not possible while
+            # somebody holds a view.
+            buf = _Buffer(size)
+            buf[:used] = self._buf[self._start:self._end]
+            self._buf = buf
+        self._start, self._end = 0, used
+
+    def writable(self, n):
+        '''Returns a writable memoryview of at least n bytes at the end. Call :meth:`written` afterwards.'''
+        self._reserve(n)
+        return memoryview(self._buf)[self._end:]
+
+    def written(self, n):
+        '''Mark n bytes as filled after writing into :meth:`writable`.'''
+        self._end += n
+
+    def recv_into(self, sock, n):
+        '''Receive up to n bytes from the socket into the buffer. Returns the number of bytes received.'''
+        with self.writable(n) as view:
+            nbytes = sock.recv_into(view, n)
+        self._end += nbytes
+        return nbytes
+
+    def append(self, data):
+        n = len(data)
+        self._reserve(n)
+        self._buf[self._end:self._end+n] = data
+        self._end += n
+
+    def deliver(self, transport, sender):
+        '''Pass the buffered data to ``transport.received(sender, data)`` and drop what was consumed.'''
+        if self._start == self._end:
+            return
+        length = self._end - self._start
+        with memoryview(self._buf) as mv, mv[self._start:self._end] as data:
+            result = transport.received(sender, data)
+        self.consume(_consumed(length, result))
+
+    def consume(self, n):
+        '''Drop n bytes from the front.'''
+        self._start += n
+        if self._start >= self._end and not self._buf.lent:
+            self._start = self._end = 0
+
+
+def accepts_buffer(func):
+    '''Decorator marking an ``on_received`` callback that accepts any bytes-like data.
+
+    See :meth:`Transport.set_on_received`.
+    '''
+    func.accepts_buffer = True
+    return func
+
+
+def _consumed(length, result):
+    '''Number of consumed bytes, given the return value of an on_received callback.'''
+    if isinstance(result, int):
+        return result
+    if isinstance(result, (bytes, bytearray, memoryview)):
+        # leftover bytes (a tail of the data)
+        return length - len(result)
+    return length
+
 
 class Transport(object):
     '''A transport abstracts a two-way bytestream interface.
@@ -65,12 +347,46 @@ class Transport(object):
         
     The classmethod :meth:`fromstring` can be used to create a 
     :class:`Transport` instance from a string (for enhanced configurability).
+
+    *Backpressure*
+
+    Transports that queue data can limit the amount of queued bytes. Set the 
+    following attributes before starting the transport:
+
+    - ``send_high_watermark``, ``send_low_watermark``: If more than 
+      ``send_high_watermark`` bytes are waiting to be written to a connection,
+      :meth:`send` applies the ``send_backpressure`` policy until no more than
+      ``send_low_watermark`` bytes are left (default: half of the high mark).
+    - ``send_backpressure``: ``'block'`` waits until the queue drained (unless 
+      called from the transport's own thread, which would deadlock);
+      ``'raise'`` raises :class:`BackpressureError` without sending;
+      ``'promise'`` queues the data and returns a :class:`.Promise` that is 
+      fulfilled when the queue drained. The caller should wait for it before 
+      sending more.
+    - ``recv_high_watermark``, ``recv_low_watermark``: If more than 
+      ``recv_high_watermark`` received bytes are waiting to be processed,
+      the transport stops reading from its channel(s) (see 
+      :meth:`pause_reading`) until the backlog dropped to ``recv_low_watermark``.
+      They take effect immediately. Transports which process received data 
+      right away on the reading thread do not read while processing anyway,
+      so they have no backlog and ignore them.
+
+    ``None`` (the default) means unlimited. The current fill levels are 
+    available as :attr:`send_buffered` and :attr:`recv_buffered`.
     '''
     # The shorthand to use for string creation.
     shorthand = ''
 
+    send_high_watermark = None
+    send_low_watermark = None
+    send_backpressure = 'block'
+    recv_high_watermark = None
+    recv_low_watermark = None
+
     def __init__(self):
         self._on_received = None
+        self._on_received_accepts_buffer = False
+        self._on_stopped = None
         self.running = False
         # This lock guards calls to .start() and .stop().
         # E.g. someone might try to stop while we are still starting.
@@ -121,8 +437,12 @@ class Transport(object):
         
          - receive bytes from the channel (usually blocking)
          - pass the bytes to ``self.received``
-         - check periodically (e.g. each second) if ``self.running`` has been cleared
+         - check if ``self.running`` has been cleared
          - if so, close the channel and return.
+
+        To notice the stop without polling, override :meth:`stop` to interrupt 
+        the blocking receive, e.g. using a :class:`Waker` in the ``select()`` 
+        set or by putting a sentinel into the queue that is waited on.
         '''
         self.running = True
         
@@ -152,6 +472,8 @@ class Transport(object):
                 self.run()
             finally:
                 self.running = False
+                if self._on_stopped:
+                    self._on_stopped(self)
 
         self._thread = threading.Thread(target=starter, name=self.__class__.__name__)
         p = Promise(setter_thread=self._thread)
@@ -185,32 +507,99 @@ class Transport(object):
     
         The callback's signature is ``on_received(sender, data)``, where ``sender`` is a
         string describing the origin; ``data`` is the received bytes.
-        If decoding leaves trailing bytes, they should be returned. The Transport 
-        stores them and prepends them to the next received bytes.
+
+        If the callback is decorated with :func:`accepts_buffer`, ``data`` can 
+        be any bytes-like object, usually a :class:`memoryview` into the receive
+        buffer, which saves a copy. It is only valid during the call; copy it 
+        if you need to keep it.
+
+        The callback returns the number of bytes it consumed (int). Trailing 
+        bytes that were not consumed are kept and passed again, followed by 
+        newly received bytes, on the next call. Alternatively, the unconsumed
+        trailing bytes can be returned (the old convention).
         '''
         self._on_received = on_received
+        self._on_received_accepts_buffer = getattr(on_received, 'accepts_buffer', False) is True
+
+    def set_on_stopped(self, on_stopped):
+        '''Sets a function to call when the transport stopped running.
+
+        The callback's signature is ``on_stopped(transport)``. It is called on
+        the transport's thread after :meth:`run` returned, regardless whether
+        the transport was stopped or failed.
+        '''
+        self._on_stopped = on_stopped
         
     def send(self, data, receivers=None):
         '''Sends the given data to the specified receiver(s).
         
         ``receivers`` is an iterable yielding strings. ``receivers=None`` sends 
         the data to all connected peers.
+
+        Returns None; with ``send_backpressure='promise'``, a :class:`.Promise` 
+        if the send buffer is above its high watermark.
         
         TODO: specify behaviour when sending on a stopped or failed Transport.
         '''
         raise NotImplementedError("Override me")
     
+    @property
+    def send_buffered(self):
+        '''Number of bytes queued for sending and not yet written.'''
+        return 0
+
+    @property
+    def recv_buffered(self):
+        '''Number of received bytes waiting to be processed.'''
+        return 0
+
+    def pause_reading(self):
+        '''Stop reading from the channel until :meth:`resume_reading` is called.
+
+        Called by a parent transport if its receive backlog is too large. The 
+        default implementation does nothing.
+        '''
+
+    def resume_reading(self):
+        '''Resume reading after :meth:`pause_reading`.'''
+
+    def _send_backpressure(self, fill, io_thread):
+        '''Apply the send_backpressure policy before queueing data into the buffer measured by ``fill``.
+
+        ``io_thread`` is the thread draining the buffer.
+
+        Returns a Promise in ``'promise'`` mode if the buffer is paused, None otherwise.
+        '''
+        if not fill.paused:
+            return None
+        mode = self.send_backpressure
+        if mode == 'raise':
+            raise BackpressureError('%d bytes are waiting to be sent'%fill.level)
+        elif mode == 'promise':
+            return fill.resumed(setter_thread=io_thread)
+        elif mode == 'block':
+            if threading.current_thread() is not io_thread:
+                fill.wait()
+            return None
+        else:
+            raise ValueError('Invalid send_backpressure %r'%(mode,))
+
+    @accepts_buffer
     def received(self, sender, data):
         '''To be called by :meth:`run` when the subclass received data.
         
         ``sender`` is a unique string identifying the source. e.g. IP address and port.
         
-        If the given data has an undecodable "tail", it is returned.
-        In this case :meth:`run` must prepend the tail to the next received bytes from this channel,
-        because it is probably an incomplete message.
+        Returns the return value of the ``on_received`` callback, i.e. the 
+        number of consumed bytes or the undecodable tail (see 
+        :meth:`set_on_received`). The remainder is probably an incomplete 
+        message and must be passed again together with the next received 
+        bytes. Use a :class:`ReceiveBuffer` to handle this.
         '''
         if not self._on_received:
             raise AttributeError("Transport received a message but has no handler set.")
+        if not self._on_received_accepts_buffer and isinstance(data, memoryview):
+            data = bytes(data)
         return self._on_received(sender, data)
 
 
@@ -221,36 +610,47 @@ class StdioTransport(Transport):
         '''No configuration options, just use "stdio:".'''
         return cls()
 
+    def __init__(self):
+        Transport.__init__(self)
+        self._waker = Waker()
+
     def stop(self):
-        L().debug('StdioTransport.stop() called')
+        L.debug('StdioTransport.stop() called')
+        self.running = False
+        self._waker.wake()
         Transport.stop(self)
 
     def send(self, data, receivers=None):
         if receivers is not None and 'stdio' not in receivers:
             return
-        L().debug('StdioTransport.send %r'%data)
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug('StdioTransport.send %r', data)
         sys.stdout.buffer.write(data)
         sys.stdout.buffer.flush()
 
     def run(self):
         '''run, blocking.'''
-        L().debug('StdioTransport.run() called')
+        L.debug('StdioTransport.run() called')
         self.running = True
-        leftover = b''
+        buffer = ReceiveBuffer()
         while self.running:
             # FIXME: This loses bytes on startup.
             data = self._input()
             #data = input().encode('utf8') + b'\n'
             if data is None: 
                 continue
-            L().debug("received: %r"%data)
-            leftover = self.received(sender='stdio', data=leftover + data)
-        L().debug('StdioTransport has finished')
+            if L.isEnabledFor(logging.DEBUG):
+                L.debug("received: %r", data)
+            buffer.append(data)
+            buffer.deliver(self, 'stdio')
+        L.debug('StdioTransport has finished')
             
-    def _input(self, timeout=0.1):
-        '''Input with 0.1s timeout. Return None on timeout.'''
-        i, o, e = select.select([sys.stdin.buffer], [], [], timeout)
-        if i:
+    def _input(self):
+        '''Wait for input. Return None if woken up by .stop().'''
+        i, o, e = select.select([sys.stdin.buffer, self._waker], [], [])
+        if self._waker in i:
+            self._waker.drain()
+        if sys.stdin.buffer in i:
             return sys.stdin.buffer.read1(65536)
         else:
             return None
@@ -272,6 +672,18 @@ class MuxTransport(Transport):
     Removing a transport stop()s it by default.
     
     Running/Stopping the MuxTransport also runs/stops all muxed transports.
+
+    The receive watermarks apply to the queue of received data waiting to be 
+    processed by MuxTransport.run(). Above the high watermark, all muxed 
+    transports are told to :meth:`~Transport.pause_reading`. ``max_leftover``
+    limits the size of the undecoded remainder kept per sender (i.e. the 
+    maximum size of an incomplete message); a larger remainder is discarded 
+    with an error message. Default: unlimited.
+
+    Sending to specific receivers only involves the muxed transport that the
+    receiver was last heard from. Receivers that have not sent anything yet
+    are offered to all muxed transports. At most ``max_routes`` receivers
+    are remembered; beyond that, the oldest routes are forgotten.
     '''
     shorthand='mux'
     @classmethod
@@ -288,39 +700,128 @@ class MuxTransport(Transport):
         return t
         
     
+    max_leftover = None
+    max_routes = 10000
+    recv_high_watermark = _recv_watermark('recv_high_watermark')
+    recv_low_watermark = _recv_watermark('recv_low_watermark')
+
     def __init__(self):
         Transport.__init__(self)
         self.in_queue = queue.Queue()
+        # replaced, not modified, so that it can be iterated without locking.
         self.transports = []
+        self._transports_lock = threading.Lock()
+        # sender name --> muxed transport it was received from
+        self._routes = {}
         self.running = False
-        # sender --> leftover bytes
+        # sender --> ReceiveBuffer with undecoded data
         self.leftovers = {}
+        self._recv_fill = FillLevel(on_pause=self.pause_reading, on_resume=self.resume_reading)
         
     def send(self, data, receivers=None):
-        # Let everyone decide for himself.
-        for transport in self.transports:
-            transport.send(data, receivers=receivers)
+        transports = self.transports
+        if receivers is None:
+            targets = [(transport, None) for transport in transports]
+        else:
+            targets = self._route(transports, receivers)
+        promises = []
+        for transport, transport_receivers in targets:
+            promise = transport.send(data, receivers=transport_receivers)
+            if promise is not None:
+                promises.append(promise)
+        if promises:
+            return _all_fulfilled(promises)
+
+    def _route(self, transports, receivers):
+        '''groups the receivers by muxed transport.'''
+        routes = self._routes
+        by_transport = {}
+        unknown = []
+        for receiver in receivers:
+            transport = routes.get(receiver)
+            if transport is None:
+                unknown.append(receiver)
+            else:
+                by_transport.setdefault(transport, []).append(receiver)
+        targets = list(by_transport.items())
+        if unknown:
+            # Let everyone decide for himself.
+            targets += [(transport, unknown) for transport in transports]
+        return targets
+
+    def _receiver_for(self, transport):
+        '''on_received callback for a muxed transport, learning the route to the sender.'''
+        @accepts_buffer
+        def handle_received(sender, data):
+            if self._routes.get(sender) is not transport:
+                self._learn_route(sender, transport)
+            return self.handle_received(sender, data)
+        return handle_received
+
+    def _learn_route(self, sender, transport):
+        with self._transports_lock:
+            if transport not in self.transports:
+                # removed meanwhile
+                return
+            routes = self._routes
+            routes.pop(sender, None)
+            while len(routes) >= self.max_routes:
+                # forget the route learned longest ago
+                del routes[next(iter(routes))]
+            routes[sender] = transport
+
+    @property
+    def send_buffered(self):
+        return sum(transport.send_buffered for transport in self.transports)
+
+    @property
+    def recv_buffered(self):
+        return self._recv_fill.level
+
+    def pause_reading(self):
+        for transport in list(self.transports):
+            transport.pause_reading()
+
+    def resume_reading(self):
+        for transport in list(self.transports):
+            transport.resume_reading()
         
+    @accepts_buffer
     def handle_received(self, sender, data):
         '''handles INCOMING data from any of the muxed transports.
         b'' is returned as leftover ALWAYS; MuxTransport keeps
         internal remainder buffers for all senders, since the
         leftover is only available after the message was processed.
         '''
+        data = bytes(data)
         self.in_queue.put(InData(sender, data))
+        self._recv_fill.add(len(data))
         return b''
     
     def add_transport(self, transport, start=True):
         '''add and start the transport (if running).'''
-        self.transports.append(transport)
-        transport.set_on_received(self.handle_received)
+        with self._transports_lock:
+            self.transports = self.transports + [transport]
+        transport.set_on_received(self._receiver_for(transport))
+        if self._recv_fill.paused:
+            transport.pause_reading()
         if start and self.running:
             transport.start()
         return self
         
     def remove_transport(self, transport, stop=True):
         '''remove and stop the transport.'''
-        self.transports.remove(transport)
+        with self._transports_lock:
+            transports = list(self.transports)
+            transports.remove(transport)
+            self.transports = transports
+            gone = [sender for sender, t in self._routes.items() if t is transport]
+            self._routes = {
+                sender: t for sender, t in self._routes.items() if t is not transport
+            }
+        # undecoded data of the transport's peers will not be completed anymore.
+        for sender in gone:
+            self.leftovers.pop(sender, None)
         transport.set_on_received(None)
         if stop:
             transport.stop()
@@ -330,7 +831,9 @@ class MuxTransport(Transport):
     __isub__ = remove_transport
     
     def stop(self):
-        L().debug('MuxTransport.stop() called')
+        L.debug('MuxTransport.stop() called')
+        self.running = False
+        self.in_queue.put(_StopSignal)
         Transport.stop(self)
     
     def open(self):
@@ -344,14 +847,15 @@ class MuxTransport(Transport):
         a list of all failures.
         '''
         
-        L().debug('MuxTransport.run() called')
+        L.debug('MuxTransport.run() called')
         promises = []
         exceptions = []
         running = []
-        for transport in self.transports:
+        transports = self.transports
+        for transport in transports:
             promises.append(transport.start(block=False))
         # wait on all the promises
-        for transport, promise in zip(self.transports, promises):
+        for transport, promise in zip(transports, promises):
             try:
                 if promise.result():
                     running.append(transport)
@@ -359,32 +863,44 @@ class MuxTransport(Transport):
                 exceptions.append(e)
         if exceptions:
             # Oh my. Stop everything again.
-            L().error('Some transports failed to start. Aborting.')
+            L.error('Some transports failed to start. Aborting.')
             for transport in running:
                 transport.stop()
             e = TransportError()
             e.exceptions = exceptions
             raise e
         
-        L().debug('Thread overview: %s'%([t.name for t in threading.enumerate()],))
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug('Thread overview: %s', [t.name for t in threading.enumerate()])
         
     def run(self):
         self.running = True
         while self.running:
-            try:
-                indata = self.in_queue.get(timeout=0.5)
-            except queue.Empty:
-                # timeout passed, check self.running and try again.
+            indata = self.in_queue.get()
+            if indata is _StopSignal:
+                # might be left over from an earlier stop; check self.running again.
                 continue
-            L().debug('MuxTransport: received %r'%(indata,))
-            leftover = self.leftovers.get(indata.sender, b'')
-            leftover = self.received(indata.sender, leftover + indata.data)
-            self.leftovers[indata.sender] = leftover
+            if L.isEnabledFor(logging.DEBUG):
+                L.debug('MuxTransport: received %r', indata)
+            buffer = self.leftovers.get(indata.sender)
+            if buffer is None:
+                buffer = self.leftovers[indata.sender] = ReceiveBuffer()
+            try:
+                buffer.append(indata.data)
+                buffer.deliver(self, indata.sender)
+            except Exception:
+                L.error('MuxTransport: error while processing data from %s, discarding it', indata.sender, exc_info=True)
+                buffer.clear()
+            finally:
+                self._recv_fill.remove(len(indata.data))
+            if self.max_leftover is not None and len(buffer) > self.max_leftover:
+                L.error('MuxTransport: discarding %d bytes of undecoded data from %s', len(buffer), indata.sender)
+                buffer.clear()
             
         # stop all transports
         for transport in self.transports:
             transport.stop()
-        L().debug('MuxTransport has finished')
+        L.debug('MuxTransport has finished')
             
 
 class RestartingTransport(Transport):
@@ -394,10 +910,12 @@ class RestartingTransport(Transport):
     
     >>> tr = RestartingTransport(TcpClientTransport(*address), check_interval=10)
 
-    check_interval gives the Restart interval in seconds. It may not be kept exactly.
-    It cannot be lower than 1 second. Restarting is attempted as long as the transport is running.
+    check_interval gives the Restart interval in seconds, counted from the moment
+    that the child stopped or failed to start. Restarting is attempted as long as
+    the transport is running.
     
-    Adding a transport changes its on_received handler to the RestartingTransport.
+    Adding a transport changes its on_received and on_stopped handlers to the 
+    RestartingTransport.
     '''
     shorthand='restart'
     @classmethod
@@ -425,9 +943,12 @@ class RestartingTransport(Transport):
         self.check_interval = check_interval
         self.transport = transport
         self.transport.set_on_received(self.received)
-        self._poll_interval = 1
+        self.transport.set_on_stopped(self._child_stopped)
         self.name = name
         self._start_promise = None
+        self._child_running = False
+        # set whenever the child started, failed or stopped, and by .stop()
+        self._wakeup = threading.Event()
 
     @property
     def receiver_thread(self):
@@ -439,40 +960,96 @@ class RestartingTransport(Transport):
         '''True if the child transport is currently running.'''
         return self.transport.running
 
+    @property
+    def send_buffered(self):
+        return self.transport.send_buffered
+
+    @property
+    def recv_buffered(self):
+        return self.transport.recv_buffered
+
+    def pause_reading(self):
+        self.transport.pause_reading()
+
+    def resume_reading(self):
+        self.transport.resume_reading()
+
     def stop(self):
         # First stop self!
+        self.running = False
+        self._wakeup.set()
         Transport.stop(self)
         
     def open(self):
+        self._wakeup.clear()
+        self._start_child()
+
+    def _child_stopped(self, transport):
+        self._child_running = False
+        self._wakeup.set()
+
+    def _start_child(self):
+        self._child_running = True
         self._start_promise = self.transport.start(block=False)
+        wake = lambda result: self._wakeup.set()
+        self._start_promise.then(wake, wake)
 
     def run(self):
         self.running = True
-        restart_timer = self.check_interval
+        restart_due = None
         while self.running:
-            time.sleep(self._poll_interval)
+            timeout = None if restart_due is None else max(0., restart_due - time.monotonic())
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            if not self.running:
+                break
             if self._start_promise:
-                # still starting, wait for result
                 try:
-                    self._start_promise.result(timeout=1.0)
+                    self._start_promise.result(timeout=0)
                 except TimeoutError:
-                    pass
+                    # still starting
+                    continue
                 except Exception as e:
-                    L().info('Start of (%s) failed. Traceback follows. Retry in %g seconds'%(self.transport.name, self.check_interval), exc_info=True)
+                    L.info('Start of (%s) failed. Traceback follows. Retry in %g seconds', self.transport.name, self.check_interval, exc_info=True)
                     self._start_promise = None
+                    self._child_running = False
+                    restart_due = time.monotonic() + self.check_interval
                 else:
                     # started
                     self._start_promise = None
-            elif not self.transport.running:
-                restart_timer -= self._poll_interval
-                if restart_timer <= 0:
-                    L().info("trying to restart (%s)"%self.name)
-                    self._start_promise = self.transport.start(block=False)
-                    restart_timer = self.check_interval
+                    restart_due = None
+                    if not self._child_running:
+                        # already stopped again
+                        restart_due = time.monotonic() + self.check_interval
+            elif not self._child_running:
+                if restart_due is None:
+                    restart_due = time.monotonic() + self.check_interval
+                elif time.monotonic() >= restart_due:
+                    L.info("trying to restart (%s)", self.name)
+                    restart_due = None
+                    self._start_child()
         self.transport.stop()
 
     def send(self, data, receivers=None):
-        self.transport.send(data, receivers)
+        return self.transport.send(data, receivers)
+
+
+def _all_fulfilled(promises):
+    '''Returns a promise that is fulfilled when all given promises are.'''
+    if len(promises) == 1:
+        return promises[0]
+    result = Promise(setter_thread=promises[0]._setter_thread)
+    remaining = [len(promises)]
+    lock = threading.Lock()
+    def one_done(value):
+        with lock:
+            remaining[0] -= 1
+            done = remaining[0] == 0
+        if done:
+            result.set_result(True)
+    for promise in promises:
+        promise.then(one_done)
+    return result
 
 def RestartingTcpClientTransport(host, port, check_interval=10):
     '''Convenience wrapper for the most common use case. Returns TcpClientTransport wrapped in a RestartingTransport.'''
@@ -483,6 +1060,10 @@ def TcpServerTransport(port, interface='', announcer=None):
     from .network_transports import TcpServerTransport
     return TcpServerTransport(port, interface, announcer)
 
+def SelectorTcpServerTransport(port, interface='', announcer=None):
+    from .network_transports import SelectorTcpServerTransport
+    return SelectorTcpServerTransport(port, interface, announcer)
+
 def TcpClientTransport(host, port):
     from .network_transports import TcpClientTransport
     return TcpClientTransport(host, port)
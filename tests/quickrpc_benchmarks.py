@@ -0,0 +1,195 @@
+'''
+Micro-benchmarks. Run with ``python -m tests.quickrpc_benchmarks [name ...]``.
+
+Prints the time per operation for each benchmark.
+'''
+import sys
+import timeit
+
+from quickrpc.codecs import JsonRpcCodec, TerseCodec
+
+_bigdata = dict(method='my_method', kwargs={
+    'ints': list(range(1000)),
+    'floats': [i/7 for i in range(1000)],
+    'strings': ['string number %d with "quotes"'%i for i in range(200)],
+    'dicts': [{'a': i, 'b': 'x'*i, 'c': [i, i+1]} for i in range(100)],
+    'longstr': 'abc\\"def'*20000,
+})
+
+def _decode_bench(codec):
+    data = codec.encode(**_bigdata)
+    def run():
+        msgs, rest = codec.decode(data)
+        assert len(msgs) == 1 and not isinstance(msgs[0], Exception)
+    return run
+
+def bench_terse_decode():
+    return _decode_bench(TerseCodec())
+
+def bench_json_decode():
+    return _decode_bench(JsonRpcCodec())
+
+def bench_msgpack_decode():
+    from quickrpc.msgpack_codec import MsgpackCodec
+    return _decode_bench(MsgpackCodec())
+
+def bench_msgpack_lazy_decode():
+    '''kwargs are not accessed, so they are never decoded.'''
+    from quickrpc.msgpack_codec import MsgpackCodec
+    return _decode_bench(MsgpackCodec(lazy=True))
+
+def _telemetry_bench(codec):
+    data = codec.encode('sample', {'channel': 3, 'value': 1.25, 'unit': 'A'}) * 100
+    def run():
+        msgs, rest = codec.decode(data)
+        assert len(msgs) == 100
+    return run
+
+def bench_msgpack_telemetry_decode():
+    from quickrpc.msgpack_codec import MsgpackCodec
+    return _telemetry_bench(MsgpackCodec())
+
+def bench_schema_telemetry_decode():
+    from quickrpc import RemoteAPI, incoming
+    from quickrpc.schema_codec import SchemaCodec
+    class TelemetryAPI(RemoteAPI):
+        @incoming
+        def sample(self, sender, channel, value=0.0, unit='V'): pass
+    return _telemetry_bench(SchemaCodec(TelemetryAPI))
+
+def bench_incoming_dispatch():
+    '''handling of 100 decoded messages, without transport and codec.'''
+    from quickrpc import RemoteAPI, incoming
+    from quickrpc.codecs import Message
+    class API(RemoteAPI):
+        @incoming
+        def sample(self, sender, channel, value=0.0): pass
+    api = API()
+    api.sample.connect(lambda sender, channel, value=0.0: None)
+    messages = [Message('sample', {'channel': i, 'value': i/3}) for i in range(100)]
+    def run():
+        for message in messages:
+            api._handle_method('sender', message)
+    return run
+
+def bench_outgoing_tcp_send():
+    '''100 outgoing calls, queued by a (not connected) TcpClientTransport.'''
+    from quickrpc import RemoteAPI, outgoing
+    from quickrpc.network_transports import TcpClientTransport
+    class API(RemoteAPI):
+        @outgoing
+        def sample(self, receivers, channel, data=b''): pass
+    transport = TcpClientTransport('localhost', 0)
+    transport.running = True
+    api = API(codec='msgpack', transport=transport)
+    payload = bytes(range(256)) * 4
+    def run():
+        for i in range(100):
+            api.sample(None, channel=i, data=payload)
+        transport._outqueue.clear()
+    return run
+
+def _outgoing_bench(codec, validate):
+    from quickrpc import RemoteAPI, outgoing
+    class Sink:
+        def set_on_received(self, callback): pass
+        def send(self, data, receivers=None): pass
+    class API(RemoteAPI):
+        @outgoing
+        def sample(self, receivers, channel, value=0.0): pass
+    api = API(codec=codec, transport=Sink())
+    api.validate_outgoing = validate
+    def run():
+        for i in range(100):
+            api.sample(None, channel=i, value=0.5)
+    return run
+
+def bench_outgoing_json():
+    '''100 outgoing calls into a no-op transport.'''
+    return _outgoing_bench('jrpc', True)
+
+def bench_outgoing_json_novalidate():
+    return _outgoing_bench('jrpc', False)
+
+def bench_outgoing_msgpack_novalidate():
+    return _outgoing_bench('msgpack', False)
+
+def bench_promise_result():
+    '''100 results of already fulfilled promises.'''
+    from quickrpc.promise import Promise
+    promises = [Promise() for i in range(100)]
+    for i, promise in enumerate(promises):
+        promise.set_result(i)
+    def run():
+        for promise in promises:
+            promise.result()
+    return run
+
+def bench_promise_gather():
+    '''100 promises fulfilled by another thread, collected with gather().'''
+    from threading import Thread
+    from quickrpc.promise import Promise, gather
+    def run():
+        promises = []
+        def setter():
+            for i, promise in enumerate(promises):
+                promise.set_result(i)
+        thread = Thread(target=setter)
+        promises[:] = [Promise(setter_thread=thread) for i in range(100)]
+        combined = gather(promises)
+        thread.start()
+        combined.result(timeout=10)
+    return run
+
+def _action_queue_bench(idle_timeout):
+    from threading import Event
+    from quickrpc.action_queue import ActionQueue
+    aq = ActionQueue(idle_timeout=idle_timeout)
+    def run():
+        # bursts of 10 actions; the queue drains in between.
+        for burst in range(10):
+            done = Event()
+            for i in range(9):
+                aq.put(lambda: None)
+            aq.put(done.set)
+            done.wait()
+    return run
+
+def bench_action_queue_bursts():
+    '''10 bursts of 10 actions, with persistent worker.'''
+    return _action_queue_bench(1.0)
+
+def bench_action_queue_bursts_noidle():
+    '''10 bursts of 10 actions, new worker thread for each burst.'''
+    return _action_queue_bench(0)
+
+def bench_bus_targeted_send():
+    '''100 sends to one of 300 bus peers.'''
+    from quickrpc.bus_transport import Bus
+    class Peer:
+        def __init__(self, name):
+            self.name = name
+        def enqueue(self, sender, data):
+            pass
+    bus = Bus('bench')
+    for i in range(300):
+        bus.add_peer(Peer('peer%d'%i))
+    def run():
+        for i in range(100):
+            bus.send('peer0', b'data', receivers=['peer%d'%(i+1)])
+    return run
+
+
+def main(names):
+    benchmarks = {
+        name[len('bench_'):]: func
+        for name, func in globals().items()
+        if name.startswith('bench_')
+    }
+    for name in names or sorted(benchmarks):
+        run = benchmarks[name]()
+        number, total = timeit.Timer(run).autorange()
+        print('%-25s %10.3f ms'%(name, 1000*total/number))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -8,7 +8,8 @@ from quickrpc.promise import Promise
 
 @pytest.fixture
 def aq():
-    return ActionQueue()
+    # tear down the worker right away
+    return ActionQueue(idle_timeout=0)
 
 def action():
     time.sleep(0.1)
@@ -29,3 +30,119 @@ def test_aq_two_items(aq):
     assert aq._running.is_set()
     time.sleep(0.1)
     assert not aq._running.is_set()
+
+def test_aq_idle_timeout():
+    aq = ActionQueue(idle_timeout=0.2)
+    results = []
+    aq.put(lambda: results.append(1))
+    time.sleep(0.05)
+    thread = aq._thread
+    assert aq._running.is_set() and thread.is_alive()
+    # the idle worker picks up new work, errors do not stop it
+    aq.put(lambda: 1/0)
+    for i in range(2, 200):
+        aq.put(lambda i=i: results.append(i))
+    time.sleep(0.05)
+    assert aq._thread is thread
+    assert results == list(range(1, 200))
+    assert aq.stats()['pending'] == 0
+    time.sleep(0.3)
+    assert not aq._running.is_set()
+    assert not thread.is_alive()
+
+def test_sharded_ordering():
+    from quickrpc.action_queue import ShardedActionQueue
+    saq = ShardedActionQueue(workers=2)
+    results = []
+    release = threading.Event()
+    def make_action(key, i):
+        def action():
+            if key == 'slow':
+                release.wait(1)
+            results.append((key, i))
+        return action
+    # make sure the keys use different workers
+    keys = ['slow'] + [k for k in 'abcdefghijklmnopqrstuvwxyz' if hash(k) % 2 != hash('slow') % 2][:1]
+    for i in range(3):
+        for key in keys:
+            saq.put(make_action(key, i), key=key)
+    time.sleep(0.1)
+    # the fast sender is not stalled by the slow one
+    assert results == [(keys[1], i) for i in range(3)]
+    stats = saq.stats()
+    assert stats['workers'] == 2 and stats['busy'] == 1 and stats['pending'] == 2
+    release.set()
+    time.sleep(0.1)
+    assert [r for r in results if r[0] == 'slow'] == [('slow', i) for i in range(3)]
+    assert saq.stats()['busy'] == 0
+
+def test_sharded_same_bucket():
+    from quickrpc.action_queue import ShardedActionQueue
+    saq = ShardedActionQueue(workers=2)
+    saq.put(lambda: None, key='warmup')
+    time.sleep(0.05)
+    release = threading.Event()
+    fast_done = threading.Event()
+    # 0 and 2 fall into the same hash bucket
+    saq.put(lambda: release.wait(1), key=0)
+    saq.put(fast_done.set, key=2)
+    assert fast_done.wait(0.2)
+    release.set()
+    time.sleep(0.05)
+    assert saq._assigned == {}
+
+def test_keyed_ordering():
+    from quickrpc.action_queue import KeyedActionQueue
+    kaq = KeyedActionQueue(workers=2, idle_timeout=0.3)
+    results = []
+    release = threading.Event()
+    def make_action(key, i):
+        def action():
+            if key == 'slow':
+                release.wait(1)
+            results.append((key, i))
+        return action
+    for i in range(3):
+        for key in ['slow', 'a', 'b']:
+            kaq.put(make_action(key, i), key=key)
+    time.sleep(0.1)
+    # no other key is stalled by the slow one
+    assert [r for r in results if r[0] == 'a'] == [('a', i) for i in range(3)]
+    assert [r for r in results if r[0] == 'b'] == [('b', i) for i in range(3)]
+    stats = kaq.stats()
+    assert stats['workers'] == 2 and stats['busy'] == 1 and stats['pending'] == 2 and stats['keys'] == 1
+    release.set()
+    time.sleep(0.1)
+    assert [r for r in results if r[0] == 'slow'] == [('slow', i) for i in range(3)]
+    time.sleep(0.5)
+    assert kaq.stats()['workers'] == 0
+
+def test_keyed_warm_pool():
+    from quickrpc.action_queue import KeyedActionQueue
+    kaq = KeyedActionQueue(workers=4, idle_timeout=1)
+    kaq.put(lambda: None, key='warmup')
+    time.sleep(0.05)
+    assert kaq.stats()['workers'] == 1
+    release = threading.Event()
+    fast_done = threading.Event()
+    # both keys arrive while one worker is idle
+    kaq.put(lambda: release.wait(1), key='slow')
+    kaq.put(fast_done.set, key='fast')
+    assert fast_done.wait(0.2)
+    assert kaq.stats()['workers'] == 2
+    release.set()
+
+def test_keyed_batches():
+    from quickrpc.action_queue import KeyedActionQueue
+    kaq = KeyedActionQueue(workers=1, idle_timeout=0.1, batch_size=2)
+    results = []
+    release = threading.Event()
+    kaq.put(lambda: release.wait(1), key='x')
+    time.sleep(0.05)
+    for i in range(3):
+        kaq.put(lambda i=i: results.append(('a', i)), key='a')
+        kaq.put(lambda i=i: results.append(('b', i)), key='b')
+    release.set()
+    time.sleep(0.1)
+    # keys take turns, two actions at a time
+    assert results == [('a', 0), ('a', 1), ('b', 0), ('b', 1), ('a', 2), ('b', 2)]
@@ -0,0 +1,113 @@
+import pytest
+import asyncio
+
+from quickrpc import RemoteAPI, incoming, outgoing
+from quickrpc.asyncio_transports import AsyncioTcpClientTransport, AsyncioTcpServerTransport
+
+
+class CalcApi(RemoteAPI):
+    @incoming(has_reply=True)
+    def add(self, sender, a=0, b=0): pass
+
+    @incoming
+    def notify(self, sender, text=''): pass
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 5))
+
+
+def test_asyncio_remote_call():
+    async def main():
+        server_tr = AsyncioTcpServerTransport(port=0, interface='127.0.0.1')
+        server = CalcApi(transport=server_tr, use_asyncio=True)
+        notified = asyncio.Event()
+        texts = []
+
+        async def add(sender, a=0, b=0):
+            await asyncio.sleep(0.01)
+            return a + b
+        def notify(sender, text=''):
+            texts.append(text)
+            notified.set()
+        server.add.connect(add)
+        server.notify.connect(notify)
+        await server_tr.astart()
+
+        client_tr = AsyncioTcpClientTransport(*server_tr.server_address[:2])
+        client = CalcApi(transport=client_tr, invert=True, use_asyncio=True)
+        await client_tr.astart()
+
+        results = await asyncio.gather(client.add(a=1, b=2), client.add(a=3, b=4))
+        client.notify(text='hello')
+        await notified.wait()
+
+        await client_tr.astop()
+        await server_tr.astop()
+        return results, texts
+
+    results, texts = run(main())
+    assert results == [3, 7]
+    assert texts == ['hello']
+
+
+def test_asyncio_remote_error():
+    async def main():
+        server_tr = AsyncioTcpServerTransport(port=0, interface='127.0.0.1')
+        server = CalcApi(transport=server_tr, use_asyncio=True)
+        async def add(sender, a=0, b=0):
+            raise ValueError('nope')
+        server.add.connect(add)
+        await server_tr.astart()
+
+        client_tr = AsyncioTcpClientTransport(*server_tr.server_address[:2])
+        client = CalcApi(transport=client_tr, invert=True, use_asyncio=True)
+        await client_tr.astart()
+        try:
+            with pytest.raises(Exception) as excinfo:
+                await client.add(a=1, b=2)
+        finally:
+            await client_tr.astop()
+            await server_tr.astop()
+        return excinfo.value
+
+    e = run(main())
+    assert 'nope' in str(e)
+
+
+def test_asyncio_remote_close():
+    async def main():
+        server_tr = AsyncioTcpServerTransport(port=0, interface='127.0.0.1')
+        CalcApi(transport=server_tr, use_asyncio=True)
+        await server_tr.astart()
+        client_tr = AsyncioTcpClientTransport(*server_tr.server_address[:2])
+        CalcApi(transport=client_tr, invert=True, use_asyncio=True)
+        await client_tr.astart()
+        while not server_tr.connections:
+            await asyncio.sleep(0.01)
+        server_tr.close(list(server_tr.connections)[0])
+        while client_tr.running:
+            await asyncio.sleep(0.01)
+        await server_tr.astop()
+        return server_tr.connections
+
+    assert run(main()) == {}
+
+
+def test_asyncio_start_from_other_thread():
+    import threading
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        server_tr = AsyncioTcpServerTransport(port=0, interface='127.0.0.1', loop=loop)
+        CalcApi(transport=server_tr, use_asyncio=True)
+        promise = server_tr.start(block=False)
+        assert promise.result(timeout=5) is True
+        assert server_tr.running
+        server_tr.stop()
+        assert not server_tr.running
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
@@ -1,5 +1,5 @@
 import pytest
-from quickrpc.codecs import JsonRpcCodec, TerseCodec, DecodeError
+from quickrpc.codecs import JsonRpcCodec, TerseCodec, DecodeError, EncodeError
 
 _testdata=dict(method="my_method", kwargs={
     'int': 1,
@@ -88,3 +88,264 @@ def test_terse_codec():
     assert msgs[0].method == _testdata['method']
     assert msgs[0].kwargs == _testdata['kwargs']
     assert rest == b''
+
+def test_decode_buffer_returns_consumed():
+    for codec in [JsonRpcCodec(), TerseCodec()]:
+        data = codec.encode(**_testdata)
+        buf = bytearray(data * 2 + data[:5])
+        msgs, consumed = codec.decode_buffer(memoryview(buf))
+        assert len(msgs) == 2
+        assert consumed == 2*len(data)
+    jc = JsonRpcCodec()
+    data = jc.encode(method="test", kwargs={}, sec_out=sec_out)
+    header_len = data.index(b'\0') + 1
+    # dangling header is not consumed
+    msgs, consumed = jc.decode_buffer(memoryview(data[:header_len+4]), sec_in=sec_in)
+    assert msgs == [] and consumed == 0
+
+def test_json_decoder_incremental():
+    jc = JsonRpcCodec(delimiter=b'\r\n')
+    data = jc.encode(method="test", kwargs={'x': 'a'*100}, sec_out=sec_out) + jc.encode(**_testdata)
+    from quickrpc.transports import _Buffer
+    decoder = jc.decoder()
+    # a ReceiveBuffer's storage, which the decoder can recognize again
+    buf = _Buffer(len(data))
+    msgs = []
+    start = end = 0
+    # feed byte-by-byte through one buffer, like a ReceiveBuffer does
+    for byte in data:
+        buf[end] = byte
+        end += 1
+        new_msgs, consumed = decoder.decode_buffer(memoryview(buf)[start:end], sec_in=sec_in)
+        msgs += new_msgs
+        start += consumed
+    assert start == end
+    assert [msg.method for msg in msgs] == ['test', 'my_method']
+    assert msgs[0].secinfo == {'user': 'john'}
+    assert msgs[1].kwargs == _testdata['kwargs']
+
+def test_json_length_framing():
+    jc = JsonRpcCodec.fromstring('jrpc:len')
+    assert jc.framing == 'length'
+    assert JsonRpcCodec.fromstring('jrpc:,').delimiter == b','
+    # payload may contain anything, including the default delimiter
+    kwargs = dict(_testdata['kwargs'], str='a\0b')
+    secure = jc.encode(method="test", kwargs={}, sec_out=lambda payload: ({'user': 'john'}, b'123\0' + payload))
+    data = jc.encode(method="my_method", kwargs=kwargs) + secure
+    for cut in range(len(data)):
+        msgs, consumed = jc.decode_buffer(memoryview(data)[:cut], sec_in=lambda p, s: p[4:])
+        assert consumed <= cut
+    msgs, rest = jc.decode(data, sec_in=lambda p, s: p[4:])
+    assert rest == b''
+    assert msgs[0].kwargs == kwargs
+    assert msgs[1].method == 'test' and msgs[1].secinfo == {'user': 'john'}
+    # header without payload stays in the remainder
+    msgs, rest = jc.decode(data[:-5])
+    assert len(msgs) == 1
+    assert rest == secure[:-5]
+
+def test_max_frame_length():
+    from quickrpc.codecs import JsonRpcDecoder
+    from quickrpc.msgpack_codec import MsgpackCodec
+    data = JsonRpcCodec().encode(**_testdata)
+    for codec in [
+        JsonRpcCodec(framing='length', max_frame_length=20),
+        MsgpackCodec(max_frame_length=20),
+    ]:
+        long_data = codec.encode(**_testdata)
+        # rejected as soon as the header is there
+        with pytest.raises(DecodeError):
+            codec.decode_buffer(long_data[:4])
+    # without delimiter, the remainder must not grow beyond the limit
+    jc = JsonRpcCodec(max_frame_length=20)
+    assert jc.decode_buffer(data[:20]) == ([], 0)
+    with pytest.raises(DecodeError):
+        jc.decode_buffer(data[:-1])
+    with pytest.raises(DecodeError):
+        JsonRpcDecoder(jc).decode_buffer(data[:-1])
+
+def test_msgpack_codec():
+    from quickrpc.msgpack_codec import MsgpackCodec, packb, unpackb
+    # reference encodings from the MessagePack spec
+    assert packb({'a': 1}) == b'\x81\xa1a\x01'
+    assert packb([None, True, -1, 200, -200, b'\x00']) == b'\x96\xc0\xc3\xff\xcc\xc8\xd1\xff\x38\xc4\x01\x00'
+    values = [0.1, 2**64-1, -2**63, 'ä'*40, b'x'*300, list(range(20)), {str(i): i for i in range(20)}]
+    assert unpackb(packb(values)) == values
+    with pytest.raises(DecodeError):
+        unpackb(packb(values)[:-1])
+    with pytest.raises(DecodeError):
+        # nested arrays
+        unpackb(b'\x91' * 100000 + b'\xc0')
+
+    mc = MsgpackCodec.fromstring('msgpack:')
+    data = mc.encode(id=5, **_testdata)
+    msgs, rest = mc.decode(data + data[:3])
+    assert rest == data[:3]
+    assert msgs[0].method == _testdata['method']
+    assert msgs[0].kwargs == _testdata['kwargs']
+    assert msgs[0].id == 5
+    reply, = mc.decode(mc.encode_reply(msgs[0], 1/3))[0]
+    assert reply.result == 1/3 and reply.id == 5
+    error, = mc.decode(mc.encode_error(msgs[0], ValueError('foo'), errorcode=3))[0]
+    assert error.exception.message == 'foo' and error.errorcode == 3
+
+def test_msgpack_secure_codec():
+    from quickrpc.msgpack_codec import MsgpackCodec
+    mc = MsgpackCodec()
+    data = mc.encode(method="test", kwargs={}, sec_out=sec_out)
+    msgs, rest = mc.decode(data[:-1], sec_in=sec_in)
+    assert msgs == [] and rest == data[:-1]
+    msgs, rest = mc.decode(data, sec_in=sec_in)
+    assert rest == b''
+    assert msgs[0].method == 'test'
+    assert msgs[0].secinfo == {'user': 'john'}
+
+def test_json_attachments():
+    from quickrpc.transports import ReceiveBuffer, Transport, accepts_buffer
+    jc = JsonRpcCodec.fromstring('jrpc:att')
+    assert jc.attachments and jc.framing == 'length'
+    blob = bytes(range(256)) * 4
+    data = jc.encode(method='put', kwargs={'blob': blob, 'more': [b'\0', 'x']})
+    # no base64
+    assert b'__bytes' not in data and blob in data
+
+    class T(Transport): pass
+    t = T()
+    msgs = []
+    @accepts_buffer
+    def on_received(sender, data):
+        new_msgs, consumed = jc.decode_buffer(data)
+        msgs.extend(new_msgs)
+        return consumed
+    t.set_on_received(on_received)
+    buf = ReceiveBuffer(size=2 * len(data))
+    buf.append(data)
+    buf.deliver(t, 'x')
+    storage = buf._buf
+    assert storage.lent
+    # the next message goes after the lent data, without a new allocation
+    buf.append(data)
+    buf.deliver(t, 'x')
+    assert buf._buf is storage
+    # reusing the buffer must not overwrite the attachments
+    buf.append(b'\xff' * len(data) * 3)
+    assert buf._buf is not storage
+    assert isinstance(msgs[0].kwargs['blob'], memoryview)
+    assert msgs[0].kwargs['blob'] == blob
+    assert msgs[1].kwargs['blob'] == blob
+    assert msgs[0].kwargs['more'] == [b'\0', 'x']
+
+    reply = jc.encode_reply(msgs[0], {'echo': msgs[0].kwargs['blob']})
+    (msg,), rest = jc.decode(reply)
+    assert msg.result['echo'] == blob
+
+@pytest.mark.parametrize('expression', ['jrpc', 'jrpc:len', 'jrpc:att', 'msgpack', 'msgpack:lazy', 'schema', 'terse'])
+@pytest.mark.parametrize('id', [0, 7])
+@pytest.mark.parametrize('secure', [False, True])
+def test_call_encoder_matches_encode(expression, id, secure):
+    from quickrpc import RemoteAPI, incoming
+    from quickrpc.codecs import Codec
+    class API(RemoteAPI):
+        @incoming
+        def my_method(self, sender, **kwargs): pass
+    if secure and expression == 'terse':
+        pytest.skip('TerseCodec does not support security')
+    codec = Codec.fromstring(expression)
+    if expression == 'schema':
+        codec.bind_api(API)
+    kwargs = dict(_testdata['kwargs'], nested={'k': [[], -1, 'x y']})
+    encode_sec_out = sec_out if secure else None
+    data = codec.call_encoder('my_method')(kwargs, id, sec_out=encode_sec_out)
+    assert data == codec.encode('my_method', kwargs, id=id, sec_out=encode_sec_out)
+    (msg,), rest = codec.decode(data, sec_in=sec_in if secure else None)
+    assert (msg.method, msg.id, msg.kwargs) == ('my_method', id, kwargs)
+
+def test_terse_codec_structures():
+    tc = TerseCodec()
+    kwargs = {
+        'nested': {'l': [[], {}, [1, -2.5e-3, 'x y']], 'd': {'k': b'\xff'}},
+        'escapes': 'a\\"b\\\\n"\n\\',
+        'neg': -3,
+    }
+    data = tc.encode('meth', kwargs, id=7) + b'\r\n' + tc.encode('other', {})
+    (msg, other), rest = tc.decode(data)
+    assert (msg.method, msg.id, msg.kwargs) == ('meth', 7, kwargs)
+    assert (other.method, other.kwargs) == ('other', {})
+    (reply,), rest = tc.decode(tc.encode_reply(msg, [1, 'two']))
+    assert (reply.id, reply.result) == (7, [1, 'two'])
+    (error,), rest = tc.decode(tc.encode_error(msg, ValueError('bad')))
+    assert error.id == 7 and error.exception.message == 'bad'
+    # broken lines are skipped
+    msgs, rest = tc.decode(b'meth a:[1 2\nmeth b:}\nmeth c:1 d\nmeth x:1\n')
+    assert [m.kwargs for m in msgs] == [{'x': 1}]
+
+def test_schema_codec():
+    from quickrpc import RemoteAPI, incoming, outgoing
+    from quickrpc.msgpack_codec import MsgpackCodec
+    from quickrpc.schema_codec import SchemaCodec
+    class TelemetryAPI(RemoteAPI):
+        @incoming
+        def sample(self, sender, channel, value=0.0, unit='V'): pass
+        @incoming(has_reply=True)
+        def query(self, sender, key, **options): pass
+    class OtherAPI(TelemetryAPI):
+        @incoming
+        def sample(self, sender, channel, value=0.0): pass
+
+    # binding to an (inverted) instance yields the same schema
+    sc = SchemaCodec(TelemetryAPI)
+    api = TelemetryAPI(codec='schema:', invert=True)
+    assert api.codec.fingerprint == sc.fingerprint
+    assert sc.methods == ['query', 'sample']
+
+    data = sc.encode('sample', {'channel': 3, 'unit': 'A'})
+    assert len(data) < len(MsgpackCodec().encode('sample', {'channel': 3, 'unit': 'A'}))
+    (msg,), rest = sc.decode(data)
+    # the receiver applies its own default for value
+    assert (msg.method, msg.kwargs) == ('sample', {'channel': 3, 'unit': 'A'})
+    (msg,), rest = sc.decode(sc.encode('query', {'key': 'k', 'depth': 2}, id=4))
+    assert (msg.id, msg.kwargs) == (4, {'key': 'k', 'depth': 2})
+    (reply,), rest = sc.decode(sc.encode_reply(msg, [1.5]))
+    assert (reply.id, reply.result) == (4, [1.5])
+    (error,), rest = sc.decode(sc.encode_error(msg, ValueError('bad'), errorcode=2))
+    assert (error.id, error.errorcode, error.exception.message) == (4, 2, 'bad')
+    (msg,), rest = sc.decode(sc.encode('sample', {'unit': 'mA', 'channel': 1}))
+    assert msg.kwargs == {'channel': 1, 'unit': 'mA'}
+    for method, kwargs in [('sample', {}), ('sample', {'channel': 1, 'foo': 2}), ('nosuch', {})]:
+        with pytest.raises(EncodeError):
+            sc.encode(method, kwargs)
+
+    data = sc.encode('sample', {'channel': 1}, sec_out=sec_out)
+    (msg,), rest = sc.decode(data, sec_in=sec_in)
+    assert msg.secinfo == {'user': 'john'} and msg.kwargs == {'channel': 1}
+
+    other = SchemaCodec(OtherAPI)
+    (error,), rest = other.decode(sc.encode('sample', {'channel': 1}))
+    assert isinstance(error, DecodeError)
+    with pytest.raises(ValueError):
+        other.bind_api(TelemetryAPI)
+
+def test_lazy_decoding():
+    from quickrpc.codecs import Codec, Message, LazyMessage
+    from quickrpc.msgpack_codec import MsgpackCodec
+    from quickrpc.schema_codec import SchemaCodec
+    from quickrpc import RemoteAPI, incoming
+    class API(RemoteAPI):
+        @incoming
+        def my_method(self, sender, **kwargs): pass
+    for codec in [MsgpackCodec.fromstring('msgpack:lazy'), Codec.fromstring('terse:lazy'), SchemaCodec(API, lazy=True)]:
+        (msg,), rest = codec.decode(codec.encode(id=3, **_testdata))
+        assert isinstance(msg, LazyMessage)
+        assert (msg.method, msg.id) == ('my_method', 3)
+        assert msg._parse is not None
+        assert msg.kwargs == _testdata['kwargs']
+        assert msg._parse is None
+        # broken params only fail upon access
+        data = codec.encode('my_method', {'x': 'abc'})
+        (msg,), rest = codec.decode(data.replace(b'abc', b'\xff\xfe\xfd'))
+        assert msg.method == 'my_method'
+        with pytest.raises(DecodeError):
+            msg.kwargs
+    msg = Message('m', {})
+    with pytest.raises(AttributeError):
+        msg.foo = 1
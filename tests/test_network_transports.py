@@ -0,0 +1,173 @@
+import pytest
+import socket
+import time
+from unittest.mock import Mock, call
+
+from quickrpc.network_transports import SelectorTcpServerTransport
+from quickrpc.transports import BackpressureError
+
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def recv_exactly(sock, n, timeout=2.0):
+    sock.settimeout(timeout)
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+@pytest.fixture
+def sel_server():
+    tr = SelectorTcpServerTransport(port=0, interface='127.0.0.1')
+    received = []
+    def on_received(sender, data):
+        received.append((sender, data))
+        # keep incomplete lines as leftover
+        head, sep, tail = data.rpartition(b'\n')
+        return tail
+    tr.set_on_received(on_received)
+    tr.received_data = received
+    tr.start()
+    yield tr
+    tr.stop()
+
+def connect(tr):
+    sock = socket.create_connection(tr.server_address)
+    name = '%s:%s' % sock.getsockname()
+    assert wait_for(lambda: name in tr.connections)
+    return sock, name
+
+
+def test_selector_fromstring():
+    tr = SelectorTcpServerTransport.fromstring('tcpsel::8888')
+    assert tr.addr == ('', 8888)
+
+def test_selector_receive_with_leftover(sel_server):
+    sock, name = connect(sel_server)
+    sock.sendall(b'hello ')
+    assert wait_for(lambda: len(sel_server.received_data) == 1)
+    sock.sendall(b'world\n')
+    assert wait_for(lambda: len(sel_server.received_data) == 2)
+    assert sel_server.received_data == [(name, b'hello '), (name, b'hello world\n')]
+    sock.close()
+
+def test_selector_send_targeted_and_broadcast(sel_server):
+    s1, n1 = connect(sel_server)
+    s2, n2 = connect(sel_server)
+    sel_server.send(b'one', receivers=[n1])
+    sel_server.send(b'all')
+    sel_server.send(b'nobody', receivers=['unknown:1'])
+    assert recv_exactly(s1, 6) == b'oneall'
+    assert recv_exactly(s2, 3) == b'all'
+    s1.close()
+    s2.close()
+
+def test_selector_close(sel_server):
+    sock, name = connect(sel_server)
+    sel_server.send(b'bye', receivers=[name])
+    sel_server.close(name)
+    assert recv_exactly(sock, 10) == b'bye'
+    assert wait_for(lambda: name not in sel_server.connections)
+    sock.close()
+
+def test_selector_remote_close(sel_server):
+    sock, name = connect(sel_server)
+    sock.close()
+    assert wait_for(lambda: name not in sel_server.connections)
+
+def test_selector_keepalive():
+    tr = SelectorTcpServerTransport(port=0, interface='127.0.0.1', keepalive_msg=b'ka', keepalive_interval=0.1)
+    tr.set_on_received(Mock(return_value=b''))
+    tr.start()
+    try:
+        sock, name = connect(tr)
+        assert recv_exactly(sock, 4) == b'kaka'
+        sock.close()
+    finally:
+        tr.stop()
+
+def test_selector_stop_is_immediate(sel_server):
+    t0 = time.monotonic()
+    sel_server.stop()
+    assert time.monotonic() - t0 < 0.2
+
+def test_tcpserver_and_client_stop_immediately():
+    from quickrpc.network_transports import TcpServerTransport, TcpClientTransport
+    server = TcpServerTransport(port=0, interface='127.0.0.1')
+    server.set_on_received(Mock(return_value=b''))
+    server.start()
+    client = TcpClientTransport(*server.server.server_address)
+    received = []
+    client.set_on_received(lambda sender, data: received.append(data) or b'')
+    client.start()
+    assert wait_for(lambda: len(server.transports) == 1)
+    server.send(b'hi')
+    assert wait_for(lambda: received == [b'hi'])
+    t0 = time.monotonic()
+    client.stop()
+    server.stop()
+    assert time.monotonic() - t0 < 0.2
+
+def test_udp_waker_lives_while_open():
+    from quickrpc.network_transports import UdpTransport
+    tr = UdpTransport(port=0)
+    assert tr._waker is None
+    wakers = []
+    for _ in range(2):
+        try:
+            tr.start()
+        except OSError as e:
+            pytest.skip('UDP socket options not supported here: %s'%e)
+        wakers.append(tr._waker)
+        t0 = time.monotonic()
+        tr.stop()
+        assert time.monotonic() - t0 < 0.2
+        # closed after run()
+        assert wakers[-1].fileno() == -1
+    assert wakers[0] is not wakers[1]
+
+def test_concurrent_sends_do_not_interleave(sel_server):
+    import threading
+    from quickrpc.network_transports import TcpClientTransport
+    client = TcpClientTransport(*sel_server.server_address)
+    client.set_on_received(Mock(return_value=b''))
+    client.start()
+    def sender(char):
+        for i in range(200):
+            client.send(char * 5000 + b'\n')
+    threads = [threading.Thread(target=sender, args=(c,)) for c in (b'a', b'b', b'c', b'd')]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    client.stop()
+    assert wait_for(lambda: not sel_server.connections)
+    lines = b''.join(data.rpartition(b'\n')[0] + b'\n' for sender, data in sel_server.received_data if b'\n' in data)
+    lines = lines.split(b'\n')[:-1]
+    assert len(lines) == 800
+    assert all(len(set(line)) == 1 and len(line) == 5000 for line in lines)
+
+def test_selector_send_backpressure_raise(sel_server):
+    sel_server.send_high_watermark = 1 << 16
+    sel_server.send_backpressure = 'raise'
+    sock, name = connect(sel_server)
+    chunk = b'x' * (1 << 16)
+    # the client never reads, so eventually the queue fills up.
+    with pytest.raises(BackpressureError):
+        for _ in range(1000):
+            sel_server.send(chunk)
+    assert sel_server.send_buffered > 1 << 16
+    # read everything; the queue drains and sending works again.
+    sock.settimeout(2.0)
+    assert wait_for(lambda: sock.recv(1 << 20) and sel_server.send_buffered <= 1 << 15)
+    sel_server.send(b'ok')
+    sock.close()
@@ -1,5 +1,6 @@
 import pytest
 import threading
+import time
 from unittest.mock import Mock, call
 from quickrpc.promise import Promise, PromiseDoneError, PromiseTimeoutError, PromiseDeadlockError
 
@@ -62,3 +63,126 @@ def test_promise_errback_shortcircuit(p, mock):
     p.set_exception(e)
     assert mock.mock_calls == [call.foo(e)]
 
+def test_promise_event_is_lazy(p):
+    p.set_result(1)
+    p.result()
+    assert p._evt is None
+
+def test_promise_multiple_callbacks(p, mock):
+    p.then(mock.foo)
+    p.then(mock.bar)
+    p.set_result(1)
+    assert mock.mock_calls == [call.foo(1), call.bar(1)]
+
+def test_promise_chaining(p):
+    inner = Promise()
+    derived = p.then(lambda x: x+1).then(lambda x: inner)
+    failed = p.then(lambda x: 1/0)
+    p.set_result(1)
+    assert not derived.done()
+    inner.set_result(5)
+    assert derived.result() == 5
+    with pytest.raises(ZeroDivisionError):
+        failed.result()
+
+def test_promise_chaining_errback(p):
+    recovered = p.then(lambda x: 'ok', lambda e: 'recovered')
+    passed_on = p.then(None, None)
+    p.set_exception(MyError())
+    assert recovered.result() == 'recovered'
+    with pytest.raises(MyError):
+        passed_on.result()
+
+def test_gather():
+    from quickrpc.promise import gather
+    promises = [Promise(), Promise()]
+    combined = gather(promises)
+    promises[1].set_result(2)
+    assert not combined.done()
+    promises[0].set_result(1)
+    assert combined.result() == [1, 2]
+    assert gather([]).result() == []
+    promises = [Promise(), Promise()]
+    combined = gather(promises)
+    promises[1].set_exception(MyError())
+    with pytest.raises(MyError):
+        combined.result()
+
+def test_first():
+    from quickrpc.promise import first
+    promises = [Promise(), Promise()]
+    combined = first(promises)
+    promises[0].set_exception(MyError())
+    assert not combined.done()
+    promises[1].set_result(2)
+    assert combined.result() == 2
+    promises = [Promise(), Promise()]
+    combined = first(promises)
+    promises[0].set_exception(MyError())
+    promises[1].set_exception(MyError())
+    with pytest.raises(MyError):
+        combined.result()
+
+def test_as_completed():
+    from quickrpc.promise import as_completed
+    t = threading.Thread()
+    promises = [Promise(setter_thread=t), Promise(setter_thread=t)]
+    def setter():
+        promises[1].set_result(2)
+        promises[0].set_result(1)
+    threading.Timer(0.05, setter).start()
+    assert [p.result() for p in as_completed(promises, timeout=1)] == [2, 1]
+    with pytest.raises(PromiseTimeoutError):
+        list(as_completed([Promise(setter_thread=t)], timeout=0.05))
+    with pytest.raises(PromiseDeadlockError):
+        list(as_completed([Promise()]))
+
+def test_to_future():
+    import concurrent.futures
+    from quickrpc.promise import to_future
+    p = Promise(setter_thread=threading.Thread())
+    future = to_future(p)
+    threading.Timer(0.05, p.set_result, (1,)).start()
+    assert future.result(timeout=1) == 1
+    p = Promise()
+    future = to_future(p)
+    p.set_exception(MyError())
+    assert isinstance(future.exception(timeout=0), MyError)
+
+def test_to_asyncio_future():
+    import asyncio
+    from quickrpc.promise import gather
+    promises = [Promise(setter_thread=threading.Thread()) for i in range(3)]
+    def setter():
+        for i, p in enumerate(promises):
+            p.set_result(i)
+    async def main():
+        threading.Timer(0.05, setter).start()
+        results = await asyncio.gather(*promises)
+        # awaiting in bulk via gather()
+        return results, await gather(promises)
+    assert asyncio.run(main()) == ([0, 1, 2], [0, 1, 2])
+
+def test_from_future():
+    import asyncio
+    import concurrent.futures
+    from quickrpc.promise import from_future, PromiseCancelledError
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        p = from_future(executor.submit(lambda: 42))
+        assert p.result(timeout=1) == 42
+        # set by an unknown thread; no deadlock check, also for derived promises
+        p = from_future(executor.submit(time.sleep, 0.01))
+        assert p.then(lambda _: 43).result(timeout=1) == 43
+    future = concurrent.futures.Future()
+    p = from_future(future)
+    future.cancel()
+    with pytest.raises(PromiseCancelledError):
+        p.result()
+    async def main():
+        future = asyncio.get_running_loop().create_future()
+        p = from_future(future)
+        future.set_exception(MyError())
+        await asyncio.sleep(0)
+        return p
+    with pytest.raises(MyError):
+        asyncio.run(main()).result()
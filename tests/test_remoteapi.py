@@ -51,4 +51,330 @@ def test_incoming(tt, testmsg, stestmsg):
         call.icall('sender1', arg1='val1', secinfo={'user':'b'}),
         ]
     
-    
\ No newline at end of file
+    
+class MyOutApi(RemoteAPI):
+    @outgoing
+    def ocall(self, receivers, arg1=None):
+        pass
+
+    @outgoing(has_reply=True)
+    def ocall_reply(self, receivers, arg1=None):
+        pass
+
+def test_outgoing_batch(tt, testmsg):
+    tt.send = Mock()
+    tt.receiver_thread = None
+    a = MyOutApi(codec='jrpc', transport=tt)
+    with a.batch():
+        a.ocall(None, arg1=1)
+        with a.batch():
+            promise = a.ocall_reply(['r1'], arg1=2)
+        a.ocall(None, arg1=3)
+        a.ocall(None, arg1=4)
+        assert not tt.send.called
+    # in call order, i.e. the calls to None are not joined across the one to r1
+    assert len(tt.send.mock_calls) == 3
+    (data1,), kwargs1 = tt.send.call_args_list[0]
+    (data2,), kwargs2 = tt.send.call_args_list[1]
+    (data3,), kwargs3 = tt.send.call_args_list[2]
+    assert kwargs1 == kwargs3 == {'receivers': None} and kwargs2 == {'receivers': ['r1']}
+    assert data3.startswith(b'[') and data3.count(b'\0') == 1
+
+    # decoded on the other side as individual calls
+    m = Mock()
+    b = MyOutApi(codec='jrpc', transport=MyTransport(), invert=True)
+    b.ocall.connect(m.ocall)
+    b.transport.receive('sender1', data1 + data3)
+    assert m.mock_calls == [call.ocall('sender1', arg1=1), call.ocall('sender1', arg1=3), call.ocall('sender1', arg1=4)]
+
+    # reply goes to the pending promise
+    reply = a.codec.encode_reply(a.codec.decode(data2)[0][0], 'ok')
+    tt.receive('r1', reply)
+    assert promise.result(timeout=0) == 'ok'
+
+    with pytest.raises(KeyError):
+        with a.batch():
+            a.ocall(None, arg1=5)
+            raise KeyError()
+    assert len(tt.send.mock_calls) == 3
+
+def test_dispatch_table(tt):
+    tt.send = Mock()
+    a = MyOutApi(codec='jrpc', transport=tt)
+    # outgoing methods are not dispatched
+    assert a._dispatch == {}
+    tt.receive('sender1', b'{"jsonrpc":"2.0", "method": "ocall", "params": {}, "id": 1}\0')
+    assert b'not marked as @incoming' in tt.send.call_args[0][0]
+    tt.receive('sender1', b'{"jsonrpc":"2.0", "method": "nosuch", "params": {}, "id": 2}\0')
+    assert b'not defined' in tt.send.call_args[0][0]
+
+    a.invert()
+    assert sorted(a._dispatch) == ['ocall', 'ocall_reply']
+    m = Mock(return_value=42)
+    a.ocall_reply.connect(m)
+    tt.receive('sender1', b'{"jsonrpc":"2.0", "method": "ocall_reply", "params": {"arg1": 5}, "id": 3}\0')
+    m.assert_called_once_with('sender1', arg1=5)
+    assert b'"result": 42' in tt.send.call_args[0][0] or b'"result":42' in tt.send.call_args[0][0]
+
+def test_trace(tt, testmsg):
+    tt.send = Mock()
+    class TraceApi(RemoteAPI):
+        @incoming
+        def icall(self, sender, arg1=None):
+            pass
+    a = TraceApi(codec='jrpc', transport=tt)
+    a.trace = Mock()
+    tt.receive('sender1', testmsg)
+    b = MyOutApi(codec='jrpc', transport=tt)
+    b.trace = a.trace
+    b.ocall(['r1'], arg1=2)
+    (direction, peer, msg), = a.trace.call_args_list[0][0:1]
+    assert (direction, peer, msg.method, msg.kwargs) == ('in', 'sender1', 'icall', {'arg1': 'val1'})
+    (direction, peer, msg), = a.trace.call_args_list[1][0:1]
+    assert (direction, peer, msg.method, msg.kwargs) == ('out', ['r1'], 'ocall', {'arg1': 2})
+
+def test_outgoing_without_validation(tt):
+    tt.send = Mock()
+    class CheckedApi(RemoteAPI):
+        @outgoing(allow_positional_args=True)
+        def ocall(self, receivers, arg1, arg2=None):
+            raise ValueError('body executed')
+    a = CheckedApi(codec='jrpc', transport=tt)
+    with pytest.raises(ValueError):
+        a.ocall(None, arg1=1)
+    a.validate_outgoing = False
+    a.ocall(None, 1, arg2=2)
+    (msg,), rest = a.codec.decode(tt.send.call_args[0][0])
+    assert (msg.method, msg.kwargs) == ('ocall', {'arg1': 1, 'arg2': 2})
+    for kwargs in [{}, {'arg1': 1, 'foo': 2}]:
+        with pytest.raises(TypeError):
+            a.ocall(None, **kwargs)
+
+def test_pending_reply_timeout_and_cancel(tt):
+    from quickrpc.remote_api import TooManyPendingCalls
+    from quickrpc.promise import PromiseTimeoutError, PromiseCancelledError
+    import time
+    tt.send = Mock()
+    # promises are set by the timer / this thread in this test
+    tt.receiver_thread = Mock()
+    a = MyOutApi(codec='jrpc', transport=tt)
+    a.reply_timeout = 0.05
+    expiring = a.ocall_reply(None)
+    with a.timeout(None):
+        waiting = a.ocall_reply(None)
+    with a.timeout(10):
+        cancelled = a.ocall_reply(None)
+    assert len(a._pending_replies) == 3
+    assert a.cancel(cancelled)
+    assert not a.cancel(cancelled)
+    with pytest.raises(PromiseCancelledError):
+        cancelled.result()
+    with pytest.raises(PromiseTimeoutError):
+        expiring.result(timeout=1.0)
+    time.sleep(0.05)
+    assert len(a._pending_replies) == 1
+    # late reply is dropped
+    tt.receive('r', b'{"jsonrpc": "2.0", "id": 1, "result": 5}\0')
+    tt.receive('r', b'{"jsonrpc": "2.0", "id": 2, "result": 6}\0')
+    assert waiting.result() == 6
+
+    a.max_pending_replies = 1
+    a.ocall_reply(None)
+    with pytest.raises(TooManyPendingCalls):
+        a.ocall_reply(None)
+
+def test_pending_replies_compaction():
+    import time
+    from quickrpc.remote_api import _PendingReplies
+    from quickrpc.promise import Promise
+    expire = Mock()
+    pending = _PendingReplies(expire)
+    for call_id in range(100):
+        pending.add(call_id, Promise(), 60)
+    for call_id in range(60):
+        pending.pop(call_id)
+    # dead entries never outnumber the live ones
+    assert len(pending._deadlines) <= 2 * len(pending)
+    for call_id in range(60, 100):
+        pending.pop(call_id)
+    assert pending._deadlines == []
+    # ... and the timer thread is not kept alive for nothing
+    time.sleep(0.05)
+    assert pending._thread is None
+    assert not expire.called
+
+def test_in_flight_window(tt):
+    from quickrpc.remote_api import TooManyPendingCalls
+    tt.send = Mock()
+    tt.receiver_thread = Mock()
+    a = MyOutApi(codec='jrpc', transport=tt)
+    a.max_in_flight = 3
+    a.max_in_flight_per_receiver = 1
+    a.in_flight_policy = 'raise'
+    p1 = a.ocall_reply(['r1'])
+    p2 = a.ocall_reply(['r2'])
+    with pytest.raises(TooManyPendingCalls):
+        a.ocall_reply(['r1'])
+    # notifications are not limited
+    a.ocall(['r1'])
+    assert len(tt.send.mock_calls) == 3
+
+    a.in_flight_policy = 'queue'
+    p3 = a.ocall_reply(['r1'])
+    p4 = a.ocall_reply(['r3'])
+    assert len(tt.send.mock_calls) == 3
+    # reply to p1 makes room for p3 and then p4
+    tt.receive('r1', b'{"jsonrpc": "2.0", "id": 1, "result": 1}\0')
+    assert p1.result() == 1
+    assert len(tt.send.mock_calls) == 5
+    assert b'"id": 4' in tt.send.call_args_list[3][0][0]
+    assert b'"id": 5' in tt.send.call_args_list[4][0][0]
+    # total limit reached
+    p6 = a.ocall_reply(['r4'])
+    assert len(tt.send.mock_calls) == 5
+    a.cancel(p6)
+    a.cancel(p2)
+    p7 = a.ocall_reply(['r4'])
+    assert b'"id": 7' in tt.send.call_args[0][0]
+    # blocking
+    import threading
+    a.in_flight_policy = 'block'
+    a.max_in_flight_per_receiver = None
+    a.max_in_flight = 1
+    a.cancel(p3)
+    a.cancel(p4)
+    a.cancel(p7)
+    p8 = a.ocall_reply(None)
+    t = threading.Thread(target=a.ocall_reply, args=(None,))
+    t.start()
+    t.join(0.05)
+    assert t.is_alive()
+    tt.receive('r1', b'{"jsonrpc": "2.0", "id": 8, "result": 8}\0')
+    t.join(1)
+    assert not t.is_alive()
+    assert b'"id": 9' in tt.send.call_args[0][0]
+
+def test_incoming_key(tt):
+    import threading, time
+    class KeyApi(RemoteAPI):
+        @incoming(key='account')
+        def book(self, sender, account, amount):
+            pass
+        @incoming(key=lambda sender, **kwargs: len(kwargs))
+        def other(self, sender, **kwargs):
+            pass
+    a = KeyApi(codec='jrpc', transport=tt, async_processing=4)
+    assert a._dispatch['book'][2] is not None
+    results = []
+    release = threading.Event()
+    def book(sender, account, amount):
+        if account == 'slow':
+            release.wait(1)
+        results.append((account, amount))
+    a.book.connect(book)
+    def msg(account, amount):
+        return ('{"jsonrpc":"2.0", "method": "book", "params": {"account": "%s", "amount": %d}}\0'%(account, amount)).encode()
+    # same sender, different accounts
+    for i in range(3):
+        tt.receive('sender1', msg('slow', i))
+        tt.receive('sender1', msg('fast', i))
+    time.sleep(0.1)
+    assert results == [('fast', i) for i in range(3)]
+    assert a.processing_stats()['pending'] == 2
+    release.set()
+    time.sleep(0.1)
+    assert [r for r in results if r[0] == 'slow'] == [('slow', i) for i in range(3)]
+
+def test_worker_pool_warm(tt):
+    import threading, time
+    class PoolApi(RemoteAPI):
+        @incoming
+        def icall(self, sender):
+            pass
+    a = PoolApi(codec='jrpc', transport=tt, async_processing=4)
+    release = threading.Event()
+    fast_done = threading.Event()
+    def icall(sender):
+        if sender == 'slow':
+            release.wait(1)
+        elif sender == 'fast':
+            fast_done.set()
+    a.icall.connect(icall)
+    tt.receive('warmup', b'{"jsonrpc":"2.0", "method": "icall", "params": {}}\0')
+    time.sleep(0.05)
+    assert a.processing_stats()['workers'] == 1
+    # two senders arrive while one worker is idle
+    tt.receive('slow', b'{"jsonrpc":"2.0", "method": "icall", "params": {}}\0')
+    tt.receive('fast', b'{"jsonrpc":"2.0", "method": "icall", "params": {}}\0')
+    assert fast_done.wait(0.2)
+    release.set()
+
+def test_in_flight_block_expired(tt):
+    import threading
+    from quickrpc.promise import PromiseTimeoutError
+    tt.send = Mock()
+    tt.receiver_thread = Mock()
+    a = MyOutApi(codec='jrpc', transport=tt)
+    a.max_in_flight = 1
+    p1 = a.ocall_reply(None)
+    promises = []
+    def blocked_call():
+        with a.timeout(0.1):
+            promises.append(a.ocall_reply(None))
+    t = threading.Thread(target=blocked_call)
+    t.start()
+    # the blocked call expires and gives up waiting, without being sent
+    t.join(1)
+    assert not t.is_alive()
+    with pytest.raises(PromiseTimeoutError):
+        promises[0].result()
+    assert len(tt.send.mock_calls) == 1
+    assert a._window.calls == {1: (None,)}
+    tt.receive('r1', b'{"jsonrpc": "2.0", "id": 1, "result": 1}\0')
+    assert a._window.calls == {}
+    # a late reply to a call that timed out frees its slot as well
+    with a.timeout(0.05):
+        p3 = a.ocall_reply(None)
+    with pytest.raises(PromiseTimeoutError):
+        p3.result()
+    assert a._window.calls == {}
+    a._window.take(3, (None,))
+    tt.receive('r1', b'{"jsonrpc": "2.0", "id": 3, "result": 1}\0')
+    assert a._window.calls == {}
+    a.ocall_reply(None)
+    assert len(tt.send.mock_calls) == 3
+
+def test_disconnect_mid_frame():
+    import weakref
+    from quickrpc.transports import Transport, MuxTransport, ReceiveBuffer
+    class T(Transport): pass
+    t = T()
+    a = MyApi(codec='jrpc', transport=t)
+    m = Mock()
+    a.icall.connect(m.icall)
+    frame = b'{"jsonrpc":"2.0", "method": "icall", "params": {"arg1": "val1"} }\0'
+    buf = ReceiveBuffer()
+    buf.append(frame[:20])
+    buf.deliver(t, 'sender1')
+    # decoder state lives with the connection's buffer...
+    storage = weakref.ref(buf._buf)
+    assert storage().decoder is not None
+    buf.append(frame[20:])
+    buf.deliver(t, 'sender1')
+    assert m.icall.call_count == 1
+    buf.append(frame[:20])
+    buf.deliver(t, 'sender1')
+    # ... and goes away with it, when the connection closes mid-frame
+    del buf
+    assert storage() is None
+    a.icall.disconnect(m.icall)
+
+    # mux transports drop the undecoded data of a removed transport's peers
+    mux = MuxTransport()
+    child = T()
+    mux.add_transport(child, start=False)
+    child.received('peer', b'partial')
+    assert 'peer' in mux._routes
+    mux.leftovers['peer'] = ReceiveBuffer()
+    mux.remove_transport(child, stop=False)
+    assert mux.leftovers == {}
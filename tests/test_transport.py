@@ -1,8 +1,8 @@
 import pytest
-from time import time
+from time import time, sleep
 from unittest.mock import Mock, call
 
-from quickrpc.transports import Transport, MuxTransport, RestartingTransport, TransportError
+from quickrpc.transports import Transport, MuxTransport, RestartingTransport, TransportError, FillLevel
 
 
 class MyVal: pass
@@ -86,6 +86,38 @@ def test_mux_receive(mux_tr, my_tr):
     mux_tr.stop()
     assert my_recv.mock_calls == [call.r('sender', b'data')]
     
+def test_mux_routing(mux_tr):
+    t1, t2 = MyTransport(), MyTransport()
+    t1.send = Mock(return_value=None)
+    t2.send = Mock(return_value=None)
+    mux_tr.set_on_received(Mock(return_value=b''))
+    mux_tr += t1
+    mux_tr += t2
+    # unknown receivers are offered to everyone
+    mux_tr.send(b'a', receivers=['peer1'])
+    assert t1.send.mock_calls == t2.send.mock_calls == [call(b'a', receivers=['peer1'])]
+    t1.received('peer1', b'')
+    t2.received('peer2', b'')
+    t1.send.reset_mock()
+    t2.send.reset_mock()
+    mux_tr.send(b'b', receivers=['peer1'])
+    mux_tr.send(b'c', receivers=['peer2', 'peer3'])
+    mux_tr.send(b'd')
+    assert t1.send.mock_calls == [call(b'b', receivers=['peer1']), call(b'c', receivers=['peer3']), call(b'd', receivers=None)]
+    assert t2.send.mock_calls == [call(b'c', receivers=['peer2']), call(b'c', receivers=['peer3']), call(b'd', receivers=None)]
+    # routes to a removed transport are forgotten
+    in_flight = t2._on_received
+    mux_tr.remove_transport(t2, stop=False)
+    assert mux_tr._routes == {'peer1': t1}
+    # a receive that was in flight during removal does not bring the route back
+    in_flight('peer2', b'')
+    assert mux_tr._routes == {'peer1': t1}
+    # the oldest routes make room for new ones
+    mux_tr.max_routes = 2
+    for peer in ['peer3', 'peer4', 'peer1']:
+        t1.received(peer, b'')
+    assert list(mux_tr._routes) == ['peer4', 'peer1']
+
 def test_mux_with_failure(mux_tr, my_tr, my_ftr):
     mux_tr += my_ftr
     mux_tr += my_tr
@@ -99,3 +131,73 @@ def test_mux_with_failure(mux_tr, my_tr, my_ftr):
     assert len(excinfo.value.exceptions) == 1
     assert isinstance(excinfo.value.exceptions[0], MyTransportError)
     
+
+def test_mux_stop_is_immediate(mux_tr):
+    mux_tr.start()
+    t0 = time()
+    mux_tr.stop()
+    assert time() - t0 < 0.2
+
+def test_restarting_transport_restarts(my_tr):
+    rtr = RestartingTransport(my_tr, check_interval=0.05)
+    rtr.start()
+    # MyTransport.run() returns immediately, so the child keeps being restarted.
+    wait_until = time() + 2
+    while my_tr.mock_calls.count(call.open()) < 2 and time() < wait_until:
+        sleep(0.01)
+    t0 = time()
+    rtr.stop()
+    assert time() - t0 < 0.2
+    assert my_tr.mock_calls.count(call.open()) >= 2
+
+def test_fill_level_hysteresis():
+    on_pause, on_resume = Mock(), Mock()
+    fill = FillLevel(high=10, low=4, on_pause=on_pause, on_resume=on_resume)
+    fill.add(10)
+    assert not fill.paused
+    fill.add(1)
+    assert fill.paused and on_pause.call_count == 1
+    promise = fill.resumed()
+    fill.remove(5)
+    assert fill.paused and not on_resume.called
+    fill.remove(2)
+    assert not fill.paused and on_resume.call_count == 1
+    assert promise.result(timeout=0) == True
+    assert fill.wait(timeout=0)
+
+def test_mux_pauses_reading_above_watermark(mux_tr, my_tr):
+    my_tr.pause_reading = Mock()
+    my_tr.resume_reading = Mock()
+    mux_tr.recv_high_watermark = 5
+    mux_tr.add_transport(my_tr)
+    mux_tr.set_on_received(Mock(return_value=b''))
+    my_tr.received('foo', b'123456')
+    assert mux_tr.recv_buffered == 6
+    assert my_tr.pause_reading.call_count == 1
+    mux_tr.start()
+    try:
+        start = time()
+        while mux_tr.recv_buffered and time() - start < 2:
+            sleep(0.01)
+        assert mux_tr.recv_buffered == 0
+        assert my_tr.resume_reading.call_count == 1
+    finally:
+        mux_tr.stop()
+
+def test_receive_buffer_consumes_and_grows(my_tr):
+    from quickrpc.transports import ReceiveBuffer, accepts_buffer
+    seen = []
+    @accepts_buffer
+    def on_received(sender, data):
+        seen.append(bytes(data))
+        # consume complete lines only
+        return bytes(data).rfind(b'\n') + 1
+    my_tr.set_on_received(on_received)
+    buf = ReceiveBuffer(size=4)
+    buf.append(b'ab\ncd')
+    buf.deliver(my_tr, 'x')
+    assert len(buf) == 2
+    buf.append(b'e' * 100 + b'\n')
+    buf.deliver(my_tr, 'x')
+    assert len(buf) == 0
+    assert seen == [b'ab\ncd', b'cd' + b'e' * 100 + b'\n']